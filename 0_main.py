@@ -15,12 +15,16 @@ from pcraster.framework import DynamicFramework
 
 # The calculation script (engine) is imported from the following module.
 from dynamic_calc_framework import CalcFramework
+from parallel_calc_framework import ParallelCalcFramework
 
 # time object
 from currTimeStep import ModelTime
 
 # utility module:
 import virtualOS as vos
+import pcraster_csf
+import variable_expressions
+import instrumentation
 
 # variable dictionaries:
 import efas_variable_list as varDict
@@ -35,10 +39,13 @@ logger = logging.getLogger(__name__)
 efas_variable_name = ["pd","pr","rg","ta","tn","tx","ws"]
 
 # obtain efas_variable_code from the system argurment
+# - several codes separated by commas (e.g. "pd,pr,rg,ta,tn,tx,ws") are converted in one pass over the time steps
 try:
    efas_variable_name = sys.argv[1]
 except:
    pass
+efas_variable_names = efas_variable_name
+if isinstance(efas_variable_names, str): efas_variable_names = efas_variable_name.split(",")
 
 # file name of the clone map defining the scope of output
 cloneMapFileName = None # "/scratch/edwin/input/forcing/hyperhydro_wg1/EFAS/clone_maps/RhineMeuse3min.clone.map"
@@ -48,50 +55,122 @@ except:
    pass
 
 # output folder
-output = {}
-output['folder']        = None # "/scratch/edwin/input/forcing/hyperhydro_wg1/EFAS/netcdf_latlon/3min/"
-output['variable_name'] = varDict.netcdf_short_name[efas_variable_name] 
-output['file_name']     = output['variable_name']+"_efas_rhine-meuse"+".nc"
-output['unit']          = varDict.netcdf_unit[efas_variable_name]
-output['long_name']     = varDict.netcdf_long_name[efas_variable_name] 
-output['description']   = varDict.description[efas_variable_name]      
+output_folder = None # "/scratch/edwin/input/forcing/hyperhydro_wg1/EFAS/netcdf_latlon/3min/"
 
 # change output folder based on system argument
 try:
-   output['folder'] = sys.argv[3]+"/"
+   output_folder = sys.argv[3]+"/"
 except:
    pass
 
+def output_dictionary(efas_variable_name):
+    output = {}
+    output['efas_variable_name'] = efas_variable_name
+    output['variable_name'] = varDict.netcdf_short_name[efas_variable_name] 
+    output['file_name']     = output['variable_name']+"_efas_rhine-meuse"+".nc"
+    output['unit']          = varDict.netcdf_unit[efas_variable_name]
+    output['long_name']     = varDict.netcdf_long_name[efas_variable_name] 
+    output['description']   = varDict.description[efas_variable_name]      
+    # number of time steps that are collected in memory and written to the netcdf file at once 
+    output['buffer_size']   = 100
+    # writing in a background thread: the maximum number of pending writes (None or 0: no write-behind)
+    output['write_behind']  = 4
+    # preallocated layout: a fixed time dimension of nrOfTimeSteps with all time values written at the start
+    # (a file made with it cannot be extended with new days by resume)
+    output['preallocate']   = False
+    # netcdf format and compression; for NETCDF4, the chunk shapes can be optimized for "map", "timeseries" or "balanced" access
+    # - "zarr": a zarr directory store (see the module outputZarr), with the chunking and a numcodecs compressor configuration
+    #   (e.g. {'id': 'zlib', 'level': 4}; None: blosc/zstd); in the parallel run, the workers write the stores themselves
+    #   if shard_size is a multiple of the time steps per chunk
+    output['format']        = "NETCDF3_CLASSIC"
+    output['zlib']          = False
+    output['complevel']     = None
+    output['shuffle']       = True
+    output['chunking']      = None
+    output['compressor']    = None
+    if output['format'] == "zarr": output['file_name'] = output['variable_name']+"_efas_rhine-meuse"+".zarr"
+    # put output at different folder
+    output['folder']        = output_folder + output['variable_name']+"/"
+    return output
+
+outputs = [output_dictionary(code) for code in efas_variable_names]
+
 # directory where the original pcraster files are stored
 pcraster_files = {}
 pcraster_files['directory'] = "/scratch/edwin/input/forcing/hyperhydro_wg1/EFAS/source/pcraster/"
-pcraster_files['file_name'] = efas_variable_name # "pr"
-
-# put output at different folder
-output['folder'] += output['variable_name']+"/"
+pcraster_files['file_name'] = efas_variable_names[0] # "pr"
 
-# prepare the output directory
-try:
-    os.makedirs(output['folder'])
-except:
-    os.system('rm -r ')
-    pass
+# prepare the output directories
+for output in outputs:
+    try:
+        os.makedirs(output['folder'])
+    except:
+        os.system('rm -r ')
+        pass
+output = outputs[0]
 
 startDate     = "1990-01-01" # YYYY-MM-DD
 endDate       = None
 nrOfTimeSteps = 9070         # based on the last file provided by Ad 
+                             # (None: all days for which the input maps are available, e.g. to append new days with "append")
 
 # projection/coordinate sy
 inputEPSG  = "EPSG:3035" 
 outputEPSG = "EPSG:4326"
 resample_method = "near"
+# resampling/reprojection engine: "gdalwarp" (gdal command line tools), "gdal" (gdal python bindings, in memory) or "numpy" (in-process)
+# - use "numpy" only if compare_warp_engines.py shows no differences with gdalwarp for the clone and input maps
+warp_engine = "gdalwarp"
+
+# number of worker processes (1: serial run using the pcraster DynamicFramework)
+nrOfWorkers = 1
+try:
+   nrOfWorkers = int(sys.argv[4])
+except:
+   pass
+# number of time steps calculated by a worker at once (in the parallel run)
+shard_size = 100
+
+# resume/append: continue existing output files (e.g. after an interrupted run, or to add new days by increasing nrOfTimeSteps);
+# the files must start at startDate, the run starts at the first missing day (False: the output files are created again)
+# - "append": resume until the last day for which the input maps are available (nrOfTimeSteps = None)
+resume = False
+try:
+   resume = sys.argv[5] in ["resume", "append"]
+   if sys.argv[5] == "append": nrOfTimeSteps = None
+except:
+   pass
+
+# number of time steps that are read ahead in a background thread (in the serial run with the warp engine "numpy"; 0: no reading ahead)
+prefetch_depth = 2
+
+# per-stage timing and counters (see the module instrumentation): at the end of the run, a summary is logged
+# and written to the log folder (stage_timing.json); in the parallel run, only the main process is measured
+stage_timing = False
 
 ###########################################################################################################
 
+def get_nr_of_time_steps():
+
+    # the number of time steps of the run (nrOfTimeSteps or, if None, the number of days for which all input maps are available)
+    if nrOfTimeSteps != None or endDate != None: return nrOfTimeSteps
+    codes = []
+    for output in outputs:
+        expression = output.get('expression', varDict.expression[output['efas_variable_name']])
+        codes += variable_expressions.getCompiledExpression(expression).inputs
+    nrOfAvailable = min([pcraster_csf.count_maps(pcraster_files['directory']+"/"+code) for code in set(codes)])
+    if nrOfAvailable == 0:
+        msg = "No input maps are available in "+str(pcraster_files['directory'])
+        logger.error(msg)
+        raise ValueError(msg)
+    logger.info('Input maps are available for '+str(nrOfAvailable)+' time steps.')
+    return nrOfAvailable
+
 def main():
     
-    # prepare logger and its directory
+    # prepare logger and its directory (for several variables, in the main output folder)
     log_file_location = output['folder']+"/log/"
+    if len(outputs) > 1: log_file_location = output_folder+"/log/"
     try:
         os.makedirs(log_file_location)
     except:
@@ -99,19 +178,43 @@ def main():
         os.system(cmd)
         pass
     vos.initialize_logging(log_file_location)
+    instrumentation.enable(stage_timing)
     
     # time object
     modelTime = ModelTime() # timeStep info: year, month, day, doy, hour, etc
-    modelTime.getStartEndTimeSteps(startDate,endDate,nrOfTimeSteps)
+    modelTime.getStartEndTimeSteps(startDate,endDate,get_nr_of_time_steps())
     
+    # parallel run: the time steps are distributed over worker processes
+    if nrOfWorkers > 1:
+        calc_arguments = {'cloneMapFileName': cloneMapFileName,\
+                          'pcraster_files'  : pcraster_files,\
+                          'modelTime'       : modelTime,\
+                          'output'          : outputs,\
+                          'inputEPSG'       : inputEPSG,\
+                          'outputEPSG'      : outputEPSG,\
+                          'resample_method' : resample_method,\
+                          'warp_engine'     : warp_engine,\
+                          'resume'          : resume}
+        parallel_framework = ParallelCalcFramework(calc_arguments, nrOfWorkers, shard_size)
+        parallel_framework.run()
+        instrumentation.report(log_file_location+"/stage_timing.json")
+        return
+
     calculationModel = CalcFramework(cloneMapFileName,\
                                      pcraster_files, \
                                      modelTime, \
-                                     output, inputEPSG, outputEPSG, resample_method)
-
-    dynamic_framework = DynamicFramework(calculationModel,modelTime.nrOfTimeSteps)
+                                     outputs, inputEPSG, outputEPSG, resample_method, warp_engine,\
+                                     prefetch_depth = prefetch_depth,\
+                                     resume = resume)
+
+    # resume: the run starts at the first missing time step
+    if calculationModel.first_time_step > modelTime.nrOfTimeSteps:
+        logger.info('All time steps are already written.')
+        return
+    dynamic_framework = DynamicFramework(calculationModel,modelTime.nrOfTimeSteps,calculationModel.first_time_step)
     dynamic_framework.setQuiet(True)
     dynamic_framework.run()
+    instrumentation.report(log_file_location+"/stage_timing.json")
 
 if __name__ == '__main__':
     sys.exit(main())
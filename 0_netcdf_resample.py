@@ -3,6 +3,7 @@
 
 import os
 import sys
+import copy
 
 import numpy as np
 
@@ -11,12 +12,14 @@ from pcraster.framework import DynamicFramework
 
 # classes used in this script
 from dynamic_resample_framework import ResampleFramework
+from chunked_resample_framework import ChunkedResampleFramework
 
 # time object
 from currTimeStep import ModelTime
 
 # utility module:
 import virtualOS as vos
+import instrumentation
 
 # variable dictionaries:
 import efas_variable_list as varDict
@@ -76,8 +79,24 @@ output_cell_size_in_arc_minutes = np.round(output_netcdf['cell_resolution'] * 60
 important_information  = "The dataset was first resampled to "+str(input_cell_size_in_arc_minutes)+" arc minute resolution "
 important_information += "and then aggregated to "+str(input_cell_size_in_arc_minutes)+" arc minute resolution."  
 #
+# netcdf format ("zarr": a zarr directory store, see the module outputZarr)
 output_netcdf['format'] = "NETCDF3_CLASSIC"
 output_netcdf['zlib']   = False
+# NETCDF4 only: deflate level, shuffle filter and chunk shapes ("map", "timeseries" or "balanced")
+output_netcdf['complevel'] = None
+output_netcdf['shuffle']   = True
+output_netcdf['chunking']  = None
+# zarr only: a numcodecs compressor configuration (e.g. {'id': 'zlib', 'level': 4}; None: blosc/zstd); the chunk shapes are 
+# given by output_netcdf['chunking'] ("map" if None)
+output_netcdf['compressor'] = None
+if output_netcdf['format'] == "zarr": output_netcdf['file_name'] = output_netcdf['file_name'][:-len(".nc")]+".zarr"
+# number of time steps that are collected in memory and written to the netcdf file at once 
+output_netcdf['buffer_size'] = 100
+# writing in a background thread: the maximum number of pending writes (None or 0: no write-behind)
+output_netcdf['write_behind'] = 4
+# preallocated layout (opt-in): a fixed time dimension of all time steps, with all time values written at the start
+# (False: an unlimited time dimension, as before)
+output_netcdf['preallocate'] = False
 output_netcdf['netcdf_attribute'] = {}
 output_netcdf['netcdf_attribute']['institution']  = "European Commission - JRC and Department of Physical Geography, Utrecht University"
 output_netcdf['netcdf_attribute']['title'      ]  = "EFAS-Meteo 5km for Rhine-Meuse - resampled to "+str(output_cell_size_in_arc_minutes)+" arc minute resolution. "
@@ -92,6 +111,27 @@ output_netcdf['netcdf_attribute']['comment'    ] += "The original data provided
 output_netcdf['netcdf_attribute']['comment'    ] += important_information
 output_netcdf['netcdf_attribute']['description']  = varDict.description[efas_variable_name]
 
+# resampling mode (for upscaling): 
+# - "dynamic": one day per DynamicFramework time step
+# - "numpy"  : one day per time step as in "dynamic", but with numpy arrays only (no pcraster objects and no pcr.setclone)
+# - "chunked": the input is read, upscaled and written in time chunks of (at most) chunk_time_steps days 
+#              and (approximately) memory_limit MB
+resample_mode    = "dynamic"
+chunk_time_steps = 366
+memory_limit     = 2048
+
+# pyramid mode (chunked mode only): a list of output resolutions in arc minutes (e.g. [5., 30.]) that are all made 
+# in one read pass of the input file; every level gets its own output file, with the resolution in its name
+# (None: only the output resolution output_netcdf['cell_resolution'])
+pyramid_cell_sizes_in_arc_minutes = None
+
+# number of time steps that are read ahead in a background thread (not for downscaling in the pcraster mode; 0: no reading ahead)
+prefetch_depth = 2
+
+# per-stage timing and counters (see the module instrumentation): at the end of the run, a summary is logged
+# and written to the output folder (stage_timing.json)
+stage_timing = False
+
 # make an output folder
 cleanOutputFolder = False
 try:
@@ -106,20 +146,64 @@ try:
 except:
     os.system('rm -r '+str(output_netcdf['folder'])+"/tmp/*")
 
+def pyramid_output(cell_size_in_arc_minutes):
+
+    # the output dictionary of a pyramid level
+    output = copy.deepcopy(output_netcdf)
+    output['cell_resolution'] = cell_size_in_arc_minutes/60.
+    output['file_name'] = output['folder']+"/"+output['variable_name']+"_efas_rhine-meuse_"+str(cell_size_in_arc_minutes)+"min"+\
+                          os.path.splitext(output_netcdf['file_name'])[1]
+    output['netcdf_attribute']['title'] = "EFAS-Meteo 5km for Rhine-Meuse - resampled to "+str(cell_size_in_arc_minutes)+" arc minute resolution. "
+    return output
+
 def main():
     
+    # prepare logger and its directory (in the output folder)
+    log_file_location = output_netcdf['folder']+"/log/"
+    try:
+        os.makedirs(log_file_location)
+    except:
+        pass
+    vos.initialize_logging(log_file_location)
+    instrumentation.enable(stage_timing)
+
     # time object
     modelTime = ModelTime() # timeStep info: year, month, day, doy, hour, etc
     modelTime.getStartEndTimeSteps(startDate,endDate)
     
     # resample netcdf
-    resampleModel = ResampleFramework(input_netcdf,\
-                                      output_netcdf,\
-                                      modelTime,\
-                                      tmpDir)
-    dynamic_framework = DynamicFramework(resampleModel, modelTime.nrOfTimeSteps)
-    dynamic_framework.setQuiet(True)
-    dynamic_framework.run()
+    if pyramid_cell_sizes_in_arc_minutes != None:
+        resampleModel = ChunkedResampleFramework(input_netcdf,\
+                                                 [pyramid_output(cell_size) for cell_size in pyramid_cell_sizes_in_arc_minutes],\
+                                                 modelTime,\
+                                                 chunk_time_steps,\
+                                                 memory_limit)
+        resampleModel.run()
+    elif resample_mode == "chunked" and output_netcdf['cell_resolution'] > input_netcdf['cell_resolution']:
+        resampleModel = ChunkedResampleFramework(input_netcdf,\
+                                                 output_netcdf,\
+                                                 modelTime,\
+                                                 chunk_time_steps,\
+                                                 memory_limit)
+        resampleModel.run()
+    elif resample_mode == "numpy":
+        resampleModel = ResampleFramework(input_netcdf,\
+                                          output_netcdf,\
+                                          modelTime,\
+                                          tmpDir,\
+                                          prefetch_depth,\
+                                          numpy_mode = True)
+        resampleModel.run()
+    else:
+        resampleModel = ResampleFramework(input_netcdf,\
+                                          output_netcdf,\
+                                          modelTime,\
+                                          tmpDir,\
+                                          prefetch_depth)
+        dynamic_framework = DynamicFramework(resampleModel, modelTime.nrOfTimeSteps)
+        dynamic_framework.setQuiet(True)
+        dynamic_framework.run()
+    instrumentation.report(output_netcdf['folder']+"/stage_timing.json")
                                       
 
 if __name__ == '__main__':
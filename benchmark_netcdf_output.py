@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Benchmark for the netcdf output options of OutputNetcdf (format, compression and chunk shapes).
+#      For every setup, a synthetic daily cube at the Rhine-Meuse 2.5 arc minute grid is written.
+#      Reported are: the write time, the file size, and the read latency for
+#                    a map (one time step) and for a cell time series (all time steps).
+#
+#      Usage: python benchmark_netcdf_output.py [number_of_time_steps] [output_folder]
+
+import os
+import sys
+import time
+import datetime
+import shutil
+import tempfile
+
+import numpy as np
+import netCDF4 as nc
+
+from outputNetcdf import OutputNetcdf
+
+# number of time steps (days)
+nrOfTimeSteps = 730
+try:
+   nrOfTimeSteps = int(sys.argv[1])
+except:
+   pass
+
+# output folder (by default, a temporary folder that is removed afterwards)
+output_folder = None
+try:
+   output_folder = sys.argv[2]+"/"
+except:
+   pass
+
+# the grid of clone_maps/RhineMeuse2.5min.clone.map
+mapattr_dict = {'cellsize': 2.5/60., 'rows': 156, 'cols': 204, 'xUL': 3.5, 'yUL': 52.5}
+
+# number of (random) maps and cell time series read for the latency measurements
+nrOfReads = 20
+
+# setups: name, netcdf format, zlib, complevel, shuffle, chunking, fixed time dimension (True, or "preallocated":
+#         with all time values written at the start, see OutputNetcdf.createNetCDF)
+setups = [["netcdf3_classic",      "NETCDF3_CLASSIC", False, None, True,  None,         False         ],
+          ["netcdf3_preallocated", "NETCDF3_CLASSIC", False, None, True,  None,         "preallocated"],
+          ["netcdf4_map",          "NETCDF4",         True,  4,    True,  "map",        True          ],
+          ["netcdf4_timeseries",   "NETCDF4",         True,  4,    True,  "timeseries", True          ],
+          ["netcdf4_balanced",     "NETCDF4",         True,  4,    True,  "balanced",   True          ]]
+
+def synthetic_field(time_step, rows, cols):
+    # a smooth field with noise, rounded to 0.1 (like precipitation values in mm.day-1), with a missing value corner
+    y, x = np.mgrid[0:rows, 0:cols]
+    field = 5.0 + 5.0 * np.sin(x / 15.0 + time_step / 7.0) * np.cos(y / 11.0 - time_step / 5.0)
+    field = field + np.random.RandomState(time_step).gamma(0.5, 2.0, size = (rows, cols))
+    field = np.round(field, 1).astype(np.float32)
+    field[:rows // 5, :cols // 5] = 1e20
+    return field
+
+def benchmark(setup, folder, fields):
+
+    name, netcdf_format, zlib, complevel, shuffle, chunking, fixed_time = setup
+    file_name = folder + name + ".nc"
+
+    output = OutputNetcdf(mapattr_dict,\
+                          netcdf_format = netcdf_format,\
+                          netcdf_zlib = zlib,\
+                          netcdf_attribute_description = "synthetic benchmark data",\
+                          netcdf_buffer_size = 100,\
+                          netcdf_complevel = complevel,\
+                          netcdf_shuffle = shuffle,\
+                          netcdf_chunking = chunking)
+
+    # writing
+    start = time.time()
+    nrOfTimes = None
+    startTime = None
+    if fixed_time: nrOfTimes = len(fields)
+    if fixed_time == "preallocated": startTime = datetime.datetime(1990,1,1)
+    output.createNetCDF(file_name, "precipitation", "mm.day-1", nrOfTimeSteps = nrOfTimes, startTime = startTime)
+    for i in range(len(fields)):
+        timeStamp = datetime.datetime(1990,1,1) + datetime.timedelta(days = i)
+        output.data2NetCDF(file_name, "precipitation", fields[i], timeStamp)
+    output.close(file_name)
+    write_time = time.time() - start
+
+    file_size = os.path.getsize(file_name)
+
+    # reading (the file is opened for every read, as a downstream user would do)
+    random_state = np.random.RandomState(0)
+    rows = mapattr_dict['rows']
+    cols = mapattr_dict['cols']
+
+    start = time.time()
+    for i in range(nrOfReads):
+        f = nc.Dataset(file_name)
+        values = f.variables["precipitation"][random_state.randint(len(fields)),:,:]
+        f.close()
+    map_read_time = (time.time() - start) / nrOfReads
+
+    start = time.time()
+    for i in range(nrOfReads):
+        f = nc.Dataset(file_name)
+        values = f.variables["precipitation"][:,random_state.randint(rows // 5, rows),random_state.randint(cols // 5, cols)]
+        f.close()
+    timeseries_read_time = (time.time() - start) / nrOfReads
+
+    return write_time, file_size, map_read_time, timeseries_read_time
+
+def main():
+
+    folder = output_folder
+    if folder == None: folder = tempfile.mkdtemp() + "/"
+    try:
+        os.makedirs(folder)
+    except:
+        pass
+
+    fields = [synthetic_field(i, mapattr_dict['rows'], mapattr_dict['cols']) for i in range(nrOfTimeSteps)]
+
+    print("%d time steps at %d x %d cells" %(nrOfTimeSteps, mapattr_dict['rows'], mapattr_dict['cols']))
+    print("%-20s %12s %14s %16s %22s" %("setup", "write (s)", "size (MB)", "map read (ms)", "time series read (ms)"))
+    for setup in setups:
+        write_time, file_size, map_read_time, timeseries_read_time = benchmark(setup, folder, fields)
+        print("%-20s %12.2f %14.2f %16.2f %22.2f" %(setup[0], write_time, file_size / 1024.**2,\
+                                                   map_read_time * 1000., timeseries_read_time * 1000.))
+
+    if output_folder == None: shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    sys.exit(main())
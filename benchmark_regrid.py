@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Benchmark for virtualOS.regridToCoarse (vectorized block reduction) against the former
+#      block by block implementation (regrid_to_coarse_loop, kept here as the reference).
+#      Cases: 2.5 arc minute maps upscaled to 5 arc minutes (factor 2) and to 30 arc minutes (factor 12),
+#             for the Rhine-Meuse grid and for a pan-European grid.
+#      For every case, it is also checked that both implementations give bitwise identical results
+#      (the same dtype and the same bytes, e.g. also for the float32 precision of ma.average and ma.median).
+#
+#      Usage: python benchmark_regrid.py [number_of_repetitions]
+
+import sys
+import time
+
+import numpy as np
+
+import numpy.ma as ma
+
+import virtualOS as vos
+
+# number of repetitions per case (the fastest time is reported)
+nrOfRepetitions = 3
+try:
+   nrOfRepetitions = int(sys.argv[1])
+except:
+   pass
+
+# grids at 2.5 arc minutes: name, rows, cols
+grids = [["Rhine-Meuse",  156,  204],
+         ["pan-European", 1200, 1680]]
+
+# upscaling factors: name, factor
+factors = [["2.5min to 5min",  2],
+           ["2.5min to 30min", 12]]
+
+modes = ['average', 'median', 'sum', 'min', 'max']
+
+def synthetic_field(rows, cols):
+    # precipitation like values (float32) with about 30 percent missing values
+    random_state = np.random.RandomState(0)
+    field = random_state.gamma(0.5, 2.0, size = (rows, cols)).astype(np.float32)
+    field[random_state.rand(rows, cols) < 0.3] = vos.MV
+    return field
+
+def regrid_to_coarse_loop(fine,fac,mode,missValue):
+    # the former (block by block) implementation of virtualOS.regridToCoarse
+    nr,nc = np.shape(fine)
+    coarse = np.zeros(nr/fac * nc / fac).reshape(nr/fac,nc/fac) + vos.MV
+    nr,nc = np.shape(coarse)
+    for r in range(0,nr):
+        for c in range(0,nc):
+            ar = fine[r * fac : fac * (r+1),c * fac: fac * (c+1)]
+            m = np.ma.masked_values(ar,missValue)
+            if ma.count(m) == 0:
+                coarse[r,c] = vos.MV
+            else:
+                if mode == 'average':
+                    coarse [r,c] = ma.average(m)
+                elif mode == 'median': 
+                    coarse [r,c] = ma.median(m)
+                elif mode == 'sum':
+                    coarse [r,c] = ma.sum(m)
+                elif mode =='min':
+                    coarse [r,c] = ma.min(m)
+                elif mode == 'max':
+                    coarse [r,c] = ma.max(m)
+    return coarse
+
+def bitwise_differences(reference, result):
+    # the number of cells that are not bitwise identical (all cells if the shapes or dtypes differ)
+    reference = np.asarray(reference); result = np.asarray(result)
+    if reference.shape != result.shape or reference.dtype != result.dtype: return reference.size
+    view_dtype = np.dtype('u'+str(reference.dtype.itemsize))
+    return int(np.sum(reference.view(view_dtype) != result.view(view_dtype)))
+
+def timing(function, arguments):
+    best = None
+    for i in range(nrOfRepetitions):
+        start = time.time()
+        result = function(*arguments)
+        duration = time.time() - start
+        if best == None or duration < best: best = duration
+    return best, result
+
+def main():
+
+    print("best of "+str(nrOfRepetitions)+" repetitions")
+    print("%-14s %-16s %-8s %12s %12s %9s %12s" %("grid", "case", "mode", "loop (ms)", "vector (ms)", "speedup", "differences"))
+    nrOfDifferences = 0
+    for grid_name, rows, cols in grids:
+        field = synthetic_field(rows, cols)
+        for case_name, factor in factors:
+            for mode in modes:
+                loop_time,   loop_result   = timing(regrid_to_coarse_loop, (field, factor, mode, vos.MV))
+                vector_time, vector_result = timing(vos.regridToCoarse,    (field, factor, mode, vos.MV))
+                differences = bitwise_differences(loop_result, vector_result)
+                nrOfDifferences += differences
+                print("%-14s %-16s %-8s %12.2f %12.2f %9.1f %12d" %(grid_name, case_name, mode,\
+                                                                     loop_time * 1000., vector_time * 1000.,\
+                                                                     loop_time / max(vector_time, 1e-9),\
+                                                                     differences))
+    if nrOfDifferences > 0:
+        print("The results are not bitwise identical.")
+        return 1
+    print("All results are bitwise identical.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
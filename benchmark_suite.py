@@ -0,0 +1,438 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Benchmark suite with synthetic EFAS-like data.
+#      The data are generated first (in a temporary folder):
+#      - a daily pcraster series ("pr") on the EPSG:3035 5 km grid that covers the output grid,
+#      - a 2.5 arc minute cell area map (also used as the clone map), and
+#      - a 2.5 arc minute lat/lon netcdf cube (the resampled pcraster series, as made by 0_main.py).
+#      Every stage is then timed separately (seconds per call, i.e. per day):
+#      map read, reprojection, data2NetCDF, regridToCoarse, area weighted (areatotal) upscaling,
+#      and the end-to-end cost per day of 0_main.py (CalcFramework, and ParallelCalcFramework with several
+#      worker processes, with its speedup against the serial run) and 0_netcdf_resample.py
+#      (ChunkedResampleFramework and ResampleFramework).
+#      The results are written to a json file. With a baseline (a json file of an earlier run),
+#      every stage is compared to the baseline and regressions are flagged.
+#
+#      Usage: python benchmark_suite.py [grid] [number_of_days] [result_file] [baseline_file]
+#             grid: "rhine-meuse" (default) or "pan-european"
+
+import os
+import sys
+import time
+import json
+import shutil
+import datetime
+import platform
+import multiprocessing
+import tempfile
+import traceback
+
+import numpy as np
+
+import virtualOS as vos
+import pcraster_csf
+import reprojection
+import efas_variable_list as varDict
+from outputNetcdf import OutputNetcdf
+from upscaling import AreaWeightedUpscaler
+from currTimeStep import ModelTime
+
+import logging
+logger = logging.getLogger(__name__)
+
+# output grids at 2.5 arc minutes: xUL, yUL, rows, cols (the Rhine-Meuse grid is the one of clone_maps/RhineMeuse2.5min.clone.map)
+grids = {"rhine-meuse" : {'xUL':   3.5, 'yUL': 52.5, 'rows':  156, 'cols':  204},
+         "pan-european": {'xUL': -25.0, 'yUL': 72.0, 'rows': 1200, 'cols': 1680}}
+
+grid_name = "rhine-meuse"
+try:
+   grid_name = sys.argv[1]
+except:
+   pass
+
+# number of days (time steps) of the synthetic data
+nrOfDays = 30
+try:
+   nrOfDays = int(sys.argv[2])
+except:
+   pass
+
+# json files with the results and (optionally) the baseline
+result_file = "benchmark_"+grid_name+".json"
+try:
+   result_file = sys.argv[3]
+except:
+   pass
+baseline_file = None
+try:
+   baseline_file = sys.argv[4]
+except:
+   pass
+
+# a stage is flagged as a regression if its median time per call is more than this fraction above the baseline
+regression_tolerance = 0.25
+
+# the settings of the scripts
+startDate           = "1990-01-01"
+inputEPSG           = "EPSG:3035"
+outputEPSG          = "EPSG:4326"
+resample_method     = "near"
+source_cellsize     = 5000.
+input_resolution    = 2.5/60.
+upscaled_resolution = 30./60.
+efas_variable_name  = "pr"
+
+# the parallel runs of 0_main.py: numbers of worker processes and the number of time steps per shard
+parallel_workers    = [2, 4]
+parallel_shard_size = 5
+
+def synthetic_data(folder, grid):
+
+    # the synthetic data set; returns a dictionary with its file names and grids
+    data = {}
+    data['folder'] = folder
+    cellsize = input_resolution
+
+    # the 2.5 arc minute cell area map (m2), also used as the clone map
+    lat_top = grid['yUL'] - np.arange(grid['rows']) * cellsize
+    cell_area = (6371007.2**2) * np.radians(cellsize) * \
+                (np.sin(np.radians(lat_top)) - np.sin(np.radians(lat_top - cellsize)))
+    cell_area = np.repeat(cell_area[:,np.newaxis], grid['cols'], axis = 1)
+    data['cell_area'] = folder+"cellarea2.5min.map"
+    pcraster_csf.write_map(data['cell_area'], cell_area, grid['xUL'], grid['yUL'], cellsize)
+
+    # the EPSG:3035 5 km grid that covers the output grid (with a margin of one cell)
+    lon = grid['xUL'] + np.linspace(0.0, grid['cols'] * cellsize, 50)
+    lat = grid['yUL'] - np.linspace(0.0, grid['rows'] * cellsize, 50)
+    lon, lat = np.meshgrid(lon, lat)
+    x, y = reprojection.lonlat2laea(lon, lat)
+    xUL = (np.floor(x.min() / source_cellsize) - 1) * source_cellsize
+    yUL = (np.ceil (y.max() / source_cellsize) + 1) * source_cellsize
+    rows = int(np.ceil((yUL - y.min()) / source_cellsize)) + 1
+    cols = int(np.ceil((x.max() - xUL) / source_cellsize)) + 1
+    data['source'] = {'xUL': xUL, 'yUL': yUL, 'rows': rows, 'cols': cols, 'cellsize': source_cellsize}
+
+    # the daily pcraster series: precipitation like values, with missing values in a 'sea' corner
+    data['directory'] = folder+"pcraster/"
+    os.makedirs(data['directory'])
+    row, col = np.mgrid[0:rows, 0:cols]
+    sea = (row + col) < (rows + cols) // 6
+    for day in range(1, nrOfDays + 1):
+        random_state = np.random.RandomState(day)
+        values = random_state.gamma(0.5, 4.0, size = (rows, cols)) * (1.0 + np.sin(col / 20.0 + day / 3.0))
+        values = np.round(values, 1).astype(np.float32)
+        values[sea] = np.nan
+        pcraster_csf.write_map(pcraster_csf.generate_name_t(data['directory']+efas_variable_name, day),\
+                               values, xUL, yUL, source_cellsize)
+
+    # the 2.5 arc minute netcdf cube (the pcraster series resampled to the output grid)
+    data['netcdf'] = folder+"netcdf2.5min.nc"
+    variable_name = varDict.netcdf_short_name[efas_variable_name]
+    mapattr_dict = {'xUL': grid['xUL'], 'yUL': grid['yUL'], 'rows': grid['rows'], 'cols': grid['cols'], 'cellsize': cellsize}
+    output = OutputNetcdf(mapattr_dict, netcdf_attribute_description = "synthetic benchmark data", netcdf_buffer_size = 100)
+    output.createNetCDF(data['netcdf'], variable_name, varDict.netcdf_unit[efas_variable_name])
+    for day in range(1, nrOfDays + 1):
+        values = vos.readPCRmapCloneToNumpy(pcraster_csf.generate_name_t(data['directory']+efas_variable_name, day),\
+                                            data['cell_area'], inputEPSG, outputEPSG, resample_method)
+        output.data2NetCDF(data['netcdf'], variable_name, np.ma.filled(values.astype(np.float32), vos.MV), get_time_stamp(day))
+    output.close(data['netcdf'])
+    return data
+
+def get_time_stamp(day):
+    return datetime.datetime(1990, 1, 1) + datetime.timedelta(days = day - 1)
+
+def get_model_time():
+    modelTime = ModelTime()
+    modelTime.getStartEndTimeSteps(startDate, None, nrOfDays)
+    return modelTime
+
+def statistics(durations, calls = None):
+    # statistics of the durations (seconds) per call
+    durations = np.asarray(durations, dtype = np.float64)
+    if calls != None: durations = np.repeat(durations / calls, calls)
+    return {'calls' : int(durations.size),\
+            'total' : float(durations.sum()),\
+            'mean'  : float(durations.mean()),\
+            'median': float(np.median(durations)),\
+            'min'   : float(durations.min()),\
+            'max'   : float(durations.max())}
+
+def benchmark_stages(data, grid):
+
+    stages = {}
+    file_names = [pcraster_csf.generate_name_t(data['directory']+efas_variable_name, day) for day in range(1, nrOfDays + 1)]
+
+    # map read (the memory-mapped pcraster map, copied to memory)
+    durations = []
+    for file_name in file_names:
+        start = time.time()
+        values = pcraster_csf.read_map(file_name, header = vos.readMapHeader(file_name))
+        values = np.ma.array(values, copy = True)
+        durations.append(time.time() - start)
+    stages['map_read'] = statistics(durations)
+
+    # reprojection (EPSG:3035 to the 2.5 arc minute grid), the nearest neighbour index is calculated only once
+    # (it is removed from the cache first, it was also used for making the synthetic netcdf cube)
+    reprojection.regridder_cache.clear()
+    start = time.time()
+    regridder = reprojection.getRegridder(vos.getMapAttributesALL(file_names[0], arcDegree = False),\
+                                          vos.getMapAttributesALL(data['cell_area']),\
+                                          data['cell_area'], inputEPSG, outputEPSG, resample_method)
+    stages['reprojection_setup'] = statistics([time.time() - start])
+    durations = []
+    fields = []
+    for file_name in file_names:
+        values = pcraster_csf.read_map(file_name, header = vos.readMapHeader(file_name))
+        start = time.time()
+        field = np.ma.masked_array(regridder.regrid(values.data, 0), mask = regridder.regrid(np.ma.getmaskarray(values), True))
+        durations.append(time.time() - start)
+        fields.append(np.ma.filled(field.astype(np.float32), vos.MV))
+    stages['reprojection'] = statistics(durations)
+
+    # data2NetCDF (with the buffering of 0_main.py, without write-behind; the final close is included)
+    file_name = data['folder']+"data2netcdf.nc"
+    mapattr_dict = {'xUL': grid['xUL'], 'yUL': grid['yUL'], 'rows': grid['rows'], 'cols': grid['cols'], 'cellsize': input_resolution}
+    output = OutputNetcdf(mapattr_dict, netcdf_attribute_description = "synthetic benchmark data", netcdf_buffer_size = 100)
+    output.createNetCDF(file_name, "precipitation", "mm.day-1")
+    durations = []
+    for day in range(1, nrOfDays + 1):
+        start = time.time()
+        output.data2NetCDF(file_name, "precipitation", fields[day - 1], get_time_stamp(day))
+        if day == nrOfDays: output.close(file_name)
+        durations.append(time.time() - start)
+    # - with buffering, the writing happens at every buffer_size-th call: the cost is spread over all calls
+    stages['data2NetCDF'] = statistics([sum(durations)], nrOfDays)
+
+    # regridToCoarse (2.5 to 30 arc minutes, average)
+    factor = int(round(upscaled_resolution / input_resolution))
+    durations = []
+    for field in fields:
+        start = time.time()
+        coarse = vos.regridToCoarse(field, factor, "average", vos.MV)
+        durations.append(time.time() - start)
+    stages['regridToCoarse'] = statistics(durations)
+
+    # area weighted upscaling (the replacement of the pcr.areatotal calls of ResampleFramework), 2.5 to 30 arc minutes
+    cell_area = vos.readPCRmapCloneToNumpy(data['cell_area'], data['cell_area'])
+    start = time.time()
+    upscaler = AreaWeightedUpscaler(np.ma.filled(np.ma.asarray(cell_area, dtype = np.float64), np.nan), factor,\
+                                    int(round(float(grid['rows']) / factor)), int(round(float(grid['cols']) / factor)))
+    stages['areatotal_upscaling_setup'] = statistics([time.time() - start])
+    durations = []
+    for field in fields:
+        start = time.time()
+        coarse = upscaler.upscale(np.ma.masked_values(field, vos.MV))
+        durations.append(time.time() - start)
+    stages['areatotal_upscaling'] = statistics(durations)
+
+    return stages
+
+def main_output(data, name):
+
+    # the output dictionary of 0_main.py
+    output = {}
+    output['efas_variable_name'] = efas_variable_name
+    output['variable_name'] = varDict.netcdf_short_name[efas_variable_name]
+    output['file_name']     = name+".nc"
+    output['unit']          = varDict.netcdf_unit[efas_variable_name]
+    output['long_name']     = varDict.netcdf_long_name[efas_variable_name]
+    output['description']   = varDict.description[efas_variable_name]
+    output['buffer_size']   = 100
+    output['write_behind']  = 4
+    output['folder']        = data['folder']+name+"/"
+    return output
+
+def end_to_end_main(data, grid):
+
+    # 0_main.py (serial run): the pcraster series converted to a 2.5 arc minute netcdf file
+    from pcraster.framework import DynamicFramework
+    from dynamic_calc_framework import CalcFramework
+
+    output = main_output(data, "main")
+
+    start = time.time()
+    calculationModel = CalcFramework(data['cell_area'],\
+                                     {'directory': data['directory'], 'file_name': efas_variable_name},\
+                                     get_model_time(),\
+                                     [output], inputEPSG, outputEPSG, resample_method, "numpy",\
+                                     prefetch_depth = 2)
+    dynamic_framework = DynamicFramework(calculationModel, nrOfDays)
+    dynamic_framework.setQuiet(True)
+    dynamic_framework.run()
+    return statistics([time.time() - start], nrOfDays)
+
+def end_to_end_main_parallel(data, grid, nrOfWorkers):
+
+    # 0_main.py (parallel run with nrOfWorkers worker processes, see ParallelCalcFramework), for the scaling against the serial run
+    from parallel_calc_framework import ParallelCalcFramework
+
+    output = main_output(data, "main_parallel_"+str(nrOfWorkers))
+    calc_arguments = {'cloneMapFileName': data['cell_area'],\
+                      'pcraster_files'  : {'directory': data['directory'], 'file_name': efas_variable_name},\
+                      'modelTime'       : get_model_time(),\
+                      'output'          : [output],\
+                      'inputEPSG'       : inputEPSG,\
+                      'outputEPSG'      : outputEPSG,\
+                      'resample_method' : resample_method,\
+                      'warp_engine'     : "numpy"}
+
+    start = time.time()
+    ParallelCalcFramework(calc_arguments, nrOfWorkers, parallel_shard_size).run()
+    return statistics([time.time() - start], nrOfDays)
+
+def resample_dictionaries(data, grid, name):
+
+    # the input and output dictionaries of 0_netcdf_resample.py (2.5 to 30 arc minutes)
+    input_netcdf = {}
+    input_netcdf['file_name']       = data['netcdf']
+    input_netcdf['variable_name']   = varDict.netcdf_short_name[efas_variable_name]
+    input_netcdf['clone_file']      = data['cell_area']
+    input_netcdf['cell_resolution'] = input_resolution
+    input_netcdf['cell_area']       = data['cell_area']
+
+    output_netcdf = {}
+    output_netcdf['cell_resolution'] = upscaled_resolution
+    output_netcdf['folder']          = data['folder']+name+"/"
+    output_netcdf['file_name']       = output_netcdf['folder']+"resampled.nc"
+    output_netcdf['variable_name']   = input_netcdf['variable_name']
+    output_netcdf['variable_unit']   = varDict.netcdf_unit[efas_variable_name]
+    output_netcdf['long_name']       = varDict.netcdf_long_name[efas_variable_name]
+    output_netcdf['format']          = "NETCDF3_CLASSIC"
+    output_netcdf['zlib']            = False
+    output_netcdf['buffer_size']     = 100
+    output_netcdf['write_behind']    = 4
+    output_netcdf['netcdf_attribute'] = {}
+    for key in ['institution', 'title', 'source', 'history', 'references', 'comment', 'description']:
+        output_netcdf['netcdf_attribute'][key] = "synthetic benchmark data"
+    os.makedirs(output_netcdf['folder'])
+    return input_netcdf, output_netcdf
+
+def end_to_end_resample_chunked(data, grid):
+
+    # 0_netcdf_resample.py with resample_mode "chunked" (the default for upscaling)
+    from chunked_resample_framework import ChunkedResampleFramework
+
+    input_netcdf, output_netcdf = resample_dictionaries(data, grid, "resample_chunked")
+    start = time.time()
+    resampleModel = ChunkedResampleFramework(input_netcdf, output_netcdf, get_model_time(), 366, 2048)
+    resampleModel.run()
+    return statistics([time.time() - start], nrOfDays)
+
+def end_to_end_resample_dynamic(data, grid):
+
+    # 0_netcdf_resample.py with resample_mode "dynamic" (one day per DynamicFramework time step)
+    from pcraster.framework import DynamicFramework
+    from dynamic_resample_framework import ResampleFramework
+
+    input_netcdf, output_netcdf = resample_dictionaries(data, grid, "resample_dynamic")
+    start = time.time()
+    modelTime = get_model_time()
+    resampleModel = ResampleFramework(input_netcdf, output_netcdf, modelTime, output_netcdf['folder']+"tmp/", 2)
+    dynamic_framework = DynamicFramework(resampleModel, modelTime.nrOfTimeSteps)
+    dynamic_framework.setQuiet(True)
+    dynamic_framework.run()
+    return statistics([time.time() - start], nrOfDays)
+
+def compare(results, baseline):
+
+    # compare the median time per call of every stage with the baseline; returns the names of the regressed stages
+    regressions = []
+    print("")
+    print("%-38s %14s %14s %9s" %("stage (median per call)", "baseline (ms)", "current (ms)", "ratio"))
+    for name in sorted(results['stages'].keys()):
+        if name not in baseline['stages'].keys() or 'median' not in baseline['stages'][name] or\
+                                                    'median' not in results['stages'][name]: continue
+        base    = baseline['stages'][name]['median']
+        current = results['stages'][name]['median']
+        ratio = current / max(base, 1e-12)
+        flag = ""
+        if ratio > 1.0 + regression_tolerance:
+            flag = "REGRESSION"
+            regressions.append(name)
+        print("%-38s %14.3f %14.3f %9.2f %s" %(name, base * 1000., current * 1000., ratio, flag))
+    return regressions
+
+def main():
+
+    logging.basicConfig(level = logging.WARNING)
+
+    if grid_name not in grids.keys():
+        msg = "Unknown grid: "+str(grid_name)+" (use one of "+str(sorted(grids.keys()))+")"
+        logger.error(msg)
+        raise ValueError(msg)
+    grid = grids[grid_name]
+
+    folder = tempfile.mkdtemp() + "/"
+    try:
+        start = time.time()
+        data = synthetic_data(folder, grid)
+        print("Synthetic data (%s, %d days): %d x %d source cells, %d x %d cells at 2.5 arc minutes (%.1f s)" \
+              %(grid_name, nrOfDays, data['source']['rows'], data['source']['cols'], grid['rows'], grid['cols'], time.time() - start))
+
+        results = {}
+        results['metadata'] = {'grid'         : grid_name,\
+                               'days'         : nrOfDays,\
+                               'source_grid'  : data['source'],\
+                               'output_grid'  : grid,\
+                               'python'       : platform.python_version(),\
+                               'numpy'        : np.__version__,\
+                               'machine'      : platform.node(),\
+                               'cpus'         : multiprocessing.cpu_count(),\
+                               'date'         : datetime.datetime.now().isoformat()}
+        results['stages'] = benchmark_stages(data, grid)
+
+        # end-to-end runs (a stage that cannot run here, e.g. without pcraster, is reported with its error)
+        end_to_end = [['end_to_end_0_main',                      end_to_end_main],\
+                      ['end_to_end_0_netcdf_resample_chunked',   end_to_end_resample_chunked],\
+                      ['end_to_end_0_netcdf_resample_dynamic',   end_to_end_resample_dynamic]]
+        for nrOfWorkers in parallel_workers:
+            end_to_end.append(['end_to_end_0_main_workers_'+str(nrOfWorkers),\
+                               lambda data, grid, nrOfWorkers = nrOfWorkers: end_to_end_main_parallel(data, grid, nrOfWorkers)])
+        for name, function in end_to_end:
+            try:
+                results['stages'][name] = function(data, grid)
+            except:
+                logger.warning('The stage '+name+' failed:\n'+traceback.format_exc())
+                results['stages'][name] = {'error': repr(sys.exc_info()[1])}
+    finally:
+        shutil.rmtree(folder)
+
+    print("%-38s %8s %14s %14s %14s" %("stage", "calls", "median (ms)", "min (ms)", "max (ms)"))
+    for name in sorted(results['stages'].keys()):
+        stage = results['stages'][name]
+        if 'error' in stage.keys():
+            print("%-38s %s" %(name, "failed: "+stage['error']))
+            continue
+        print("%-38s %8d %14.3f %14.3f %14.3f" %(name, stage['calls'], stage['median'] * 1000., stage['min'] * 1000., stage['max'] * 1000.))
+
+    # scaling of the parallel runs against the serial run (0_main.py)
+    serial = results['stages'].get('end_to_end_0_main', {})
+    for nrOfWorkers in parallel_workers:
+        parallel = results['stages'].get('end_to_end_0_main_workers_'+str(nrOfWorkers), {})
+        if 'total' not in serial.keys() or 'total' not in parallel.keys(): continue
+        print("0_main.py with %d workers: %.2f times the throughput of the serial run (%d cpus)" \
+              %(nrOfWorkers, serial['total'] / max(parallel['total'], 1e-12), multiprocessing.cpu_count()))
+
+    f = open(result_file, 'w')
+    try:
+        json.dump(results, f, indent = 2, sort_keys = True)
+    finally:
+        f.close()
+    print("Results: "+str(result_file))
+
+    if baseline_file != None:
+        f = open(baseline_file)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(results, baseline)
+        if len(regressions) > 0:
+            print("Regressions (more than %d percent slower): %s" %(int(regression_tolerance * 100), ", ".join(regressions)))
+            return 1
+        print("No regressions.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
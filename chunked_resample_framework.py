@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EHS: Time-chunked (whole-cube) version of the ResampleFramework run for upscaling.
+#      Instead of one netcdf read, one upscaling and one write per day, the input variable is read
+#      in large time chunks (e.g. one year), every (time, lat, lon) chunk is upscaled at once with the
+#      AreaWeightedUpscaler and the result is written as one slab. The chunk length is bounded by a memory limit.
+#      Pyramid mode: with a list of output dictionaries (e.g. 5 and 30 arc minutes), all levels are made from
+#      one read pass. The levels cascade: every level is upscaled from the coarsest finer level that it is
+#      a multiple of (e.g. 30 from 5 arc minutes, weighted by the areas with values), otherwise from the input.
+
+import datetime
+
+import numpy as np
+
+from outputNetcdf import makeOutput
+from upscaling import AreaWeightedUpscaler
+import virtualOS as vos
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+# approximate memory use per input cell and time step (bytes): the input values (float32), the mask
+# and the float64 temporaries of the upscaling
+bytes_per_input_cell = 48
+
+class ChunkedResampleFramework(object):
+
+    def __init__(self, input_netcdf,\
+                       output_netcdf,\
+                       modelTime,\
+                       chunk_time_steps = 366,\
+                       memory_limit = 2048):
+        object.__init__(self)
+
+        self.input_netcdf = input_netcdf
+        self.modelTime = modelTime
+
+        # output_netcdf can be a dictionary (one output) or a list of dictionaries (pyramid mode: one output per cell_resolution)
+        self.output_netcdfs = output_netcdf
+        if isinstance(self.output_netcdfs, dict): self.output_netcdfs = [self.output_netcdfs]
+        self.output_netcdfs = sorted(self.output_netcdfs, key = lambda output: output["cell_resolution"])
+        self.output_netcdf = self.output_netcdfs[0]
+
+        # input clone properties (from the header of the clone map, without pcraster)
+        attributes = vos.getMapAttributesALL(self.input_netcdf['clone_file'])
+        self.input_clone = {}
+        self.input_clone['cellsize'] = attributes['cellsize']
+        self.input_clone['rows']     = int(attributes['rows'])
+        self.input_clone['cols']     = int(attributes['cols'])
+        self.input_clone['xUL']      = round(attributes['xUL'], 2)
+        self.input_clone['yUL']      = round(attributes['yUL'], 2)
+
+        # cell area (m2) at the input resolution
+        cell_area = vos.readPCRmapCloneToNumpy(self.input_netcdf["cell_area"], self.input_netcdf['clone_file'])
+        cell_area = np.ma.filled(np.ma.asarray(cell_area, dtype = np.float64), np.nan)
+
+        # the levels (one for every output), from fine to coarse
+        self.levels = []
+        for output_netcdf in self.output_netcdfs:
+            self.levels.append(self.make_level(output_netcdf, cell_area))
+
+        # number of time steps per chunk, bounded by the memory limit (MB)
+        bytes_per_time_step = self.input_clone['rows'] * self.input_clone['cols'] * bytes_per_input_cell
+        self.chunk_time_steps = int(max(1, min(chunk_time_steps, memory_limit * 1024. * 1024. / bytes_per_time_step)))
+        logger.info('Resampling in chunks of '+str(self.chunk_time_steps)+' time steps.')
+
+    def make_level(self, output_netcdf, cell_area):
+
+        level = {}
+        level['output_netcdf'] = output_netcdf
+
+        # resampling factor: ratio between output and input resolutions
+        resample_factor = output_netcdf["cell_resolution"]/\
+                           self.input_netcdf['cell_resolution']
+        if resample_factor <= 1.0 or abs(resample_factor - round(resample_factor)) > 0.01:
+            msg = "The chunked resampling mode can only be used for upscaling with an integer factor (resample factor: "+str(resample_factor)+")."
+            logger.error(msg)
+            raise ValueError(msg)
+        level['resample_factor'] = round(resample_factor)
+
+        # output clone properties
+        output_netcdf['rows'    ] = int(round(float(self.input_clone['rows'])/float(level['resample_factor'])))
+        output_netcdf['cols'    ] = int(round(float(self.input_clone['cols'])/float(level['resample_factor'])))
+        output_netcdf['cellsize'] = output_netcdf["cell_resolution"]
+        output_netcdf['xUL'     ] = self.input_clone['xUL']
+        output_netcdf['yUL'     ] = self.input_clone['yUL']
+
+        # the source of this level: the coarsest finer level that this level is a multiple of, otherwise the input
+        level['source'] = None
+        for index in range(len(self.levels)):
+            factor = level['resample_factor'] / self.levels[index]['resample_factor']
+            if factor > 1.0 and abs(factor - round(factor)) < 0.01: level['source'] = index
+        source_area = cell_area
+        factor = level['resample_factor']
+        if level['source'] != None:
+            source_area = self.levels[level['source']]['upscaler'].upscaled_area()
+            factor = round(level['resample_factor'] / self.levels[level['source']]['resample_factor'])
+            logger.info('Pyramid: '+str(output_netcdf["cell_resolution"])+' from '+\
+                        str(self.levels[level['source']]['output_netcdf']["cell_resolution"])+' (factor '+str(factor)+').')
+
+        # area weighted upscaling operator, with the cell areas of the source
+        level['upscaler'] = AreaWeightedUpscaler(source_area,\
+                                                 factor,\
+                                                 output_netcdf['rows'],\
+                                                 output_netcdf['cols'])
+
+        # an object for netcdf reporting
+        level['output'] = makeOutput(mapattr_dict = output_netcdf,\
+                                     cloneMapFileName = None,\
+                                     netcdf_format = output_netcdf['format'],\
+                                     netcdf_zlib = output_netcdf['zlib'],\
+                                     netcdf_attribute_dict = output_netcdf['netcdf_attribute'],\
+                                     netcdf_attribute_description = None,\
+                                     netcdf_complevel = output_netcdf.get('complevel', None),\
+                                     netcdf_shuffle = output_netcdf.get('shuffle', True),\
+                                     netcdf_chunking = output_netcdf.get('chunking', None),\
+                                     netcdf_write_behind = output_netcdf.get('write_behind', None),\
+                                     zarr_compressor = output_netcdf.get('compressor', None))
+
+        # preparing the netcdf file at coarse resolution (preallocated layout: all time steps of the run, see OutputNetcdf.createNetCDF):
+        nrOfTimeSteps = None
+        if output_netcdf.get('preallocate', False) or output_netcdf['format'] == "zarr": nrOfTimeSteps = self.modelTime.nrOfTimeSteps
+        level['output'].createNetCDF(output_netcdf['file_name'],\
+                                     output_netcdf['variable_name'],\
+                                     output_netcdf['variable_unit'],\
+                                     nrOfTimeSteps = nrOfTimeSteps,\
+                                     startTime = self.modelTime.startTime)
+        return level
+
+    def get_chunks(self):
+
+        # the time steps 1 ... nrOfTimeSteps split into chunks of (at most) chunk_time_steps time steps
+        nrOfTimeSteps = self.modelTime.nrOfTimeSteps
+        return [(first, min(first + self.chunk_time_steps - 1, nrOfTimeSteps)) \
+                for first in range(1, nrOfTimeSteps + 1, self.chunk_time_steps)]
+
+    def get_time_stamp(self, time_step):
+
+        date = self.modelTime.startTime + datetime.timedelta(days=1 * (time_step - 1))
+        return datetime.datetime(date.year, date.month, date.day, 0)
+
+    @instrumentation.timed('ChunkedResampleFramework.read_chunk')
+    def read_chunk(self, time_stamps):
+
+        # read the input values of all time stamps in one (time, lat, lon) block
+        idx = vos.netcdfTimeIndexes(self.input_netcdf['file_name'], time_stamps)
+        first = int(idx.min())
+        last  = int(idx.max())
+        cube = vos.netcdf2NumpyClone(self.input_netcdf['file_name'],\
+                                     self.input_netcdf['variable_name'],\
+                                     slice(first, last + 1),\
+                                     self.input_netcdf['clone_file'])
+        # dates that are not available in the input file (see vos.netcdfTimeIndexes) are taken from the block
+        instrumentation.count('ChunkedResampleFramework.read_chunk', 'bytes_read', cube.nbytes)
+        if last - first + 1 != len(idx) or np.any(np.diff(idx) != 1): cube = cube[idx - first]
+        return cube
+
+    def run(self):
+
+        for first_time_step, last_time_step in self.get_chunks():
+
+            time_stamps = [self.get_time_stamp(time_step) for time_step in range(first_time_step, last_time_step + 1)]
+
+            # reading (once for all levels), upscaling using cell area, and writing, all for the whole chunk
+            cube = self.read_chunk(time_stamps)
+            upscaled = []
+            for level in self.levels:
+                # - a level made from a finer level is weighted by the areas with values of that level
+                if level['source'] == None:
+                    values, area = level['upscaler'].upscale(cube, return_area = True)
+                else:
+                    values, area = level['upscaler'].upscale(*upscaled[level['source']], return_area = True)
+                upscaled.append((values, area))
+                slab = np.ma.filled(values, vos.MV).astype(np.float32)
+                level['output'].slab2NetCDF(level['output_netcdf']['file_name'],\
+                                            level['output_netcdf']['variable_name'],\
+                                            slab, time_stamps, first_time_step - 1)
+            logger.info('Written: '+str(time_stamps[0].date())+' until '+str(time_stamps[-1].date()))
+
+        for level in self.levels:
+            level['output'].close(level['output_netcdf']['file_name'])
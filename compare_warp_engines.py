@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Cell by cell comparison of the in-process resampling (warp engine "numpy", see the module reprojection)
+#      against gdalwarp (warp engine "gdalwarp", see virtualOS.gdalwarpPCR) for a clone map and a set of pcraster maps.
+#      For every map, the number of cells with a different value or a different missing value mask is reported
+#      (with the largest difference and the first differing cells). The "numpy" engine should only be used
+#      (e.g. warp_engine in 0_main.py) if this comparison shows no differences for the real clone and input maps.
+#      Both engines transform every cell exactly (gdalwarpPCR runs gdalwarp with -et 0, without the linear approximation).
+#
+#      Usage: python compare_warp_engines.py clone_map input_map [input_map ...]
+#      (the projections and the method are the ones of 0_main.py: EPSG:3035 to EPSG:4326, near)
+
+import os
+import sys
+import shutil
+import tempfile
+
+import numpy as np
+
+import virtualOS as vos
+import pcraster_csf
+
+inputEPSG  = "EPSG:3035"
+outputEPSG = "EPSG:4326"
+resample_method = "near"
+
+# number of differing cells that are listed per map
+nrOfListedCells = 10
+
+def gdalwarp_values(input_map, cloneMapFileName, tmpDir):
+    # the result of gdalwarp (the same commands as the "gdalwarp" engine of virtualOS.readPCRmapClone)
+    output = tmpDir+'temp.map'
+    vos.gdalwarpPCR(input_map, output, cloneMapFileName, tmpDir, False, False, inputEPSG, outputEPSG, resample_method)
+    values = pcraster_csf.read_map(output)
+    return np.ma.masked_array(np.array(values.data, dtype = np.float64), mask = np.ma.getmaskarray(values).copy())
+
+def numpy_values(input_map, cloneMapFileName):
+    values = vos.readPCRmapCloneToNumpy(input_map, cloneMapFileName, inputEPSG, outputEPSG, resample_method)
+    return np.ma.masked_array(np.array(values.data, dtype = np.float64), mask = np.ma.getmaskarray(values).copy())
+
+def compare(reference, values):
+    # the cells with a different mask or (where both have values) a different value
+    mask_differs  = np.ma.getmaskarray(reference) != np.ma.getmaskarray(values)
+    both_valid    = ~np.ma.getmaskarray(reference) & ~np.ma.getmaskarray(values)
+    value_differs = both_valid & (reference.data != values.data)
+    max_difference = 0.0
+    if value_differs.any(): max_difference = float(np.abs(reference.data - values.data)[value_differs].max())
+    return mask_differs, value_differs, max_difference
+
+def main():
+
+    if len(sys.argv) < 3:
+        print("Usage: python compare_warp_engines.py clone_map input_map [input_map ...]")
+        return 2
+    cloneMapFileName = sys.argv[1]
+    input_maps = sys.argv[2:]
+
+    tmpDir = tempfile.mkdtemp(prefix = 'compare_warp_engines_')+"/"
+    nrOfDifferentMaps = 0
+    try:
+        print("%-40s %10s %12s %12s %14s" %("map", "cells", "mask diff", "value diff", "max diff"))
+        for input_map in input_maps:
+            reference = gdalwarp_values(input_map, cloneMapFileName, tmpDir)
+            values    = numpy_values(input_map, cloneMapFileName)
+            mask_differs, value_differs, max_difference = compare(reference, values)
+            print("%-40s %10d %12d %12d %14.6g" %(os.path.basename(input_map), reference.size,\
+                                                  mask_differs.sum(), value_differs.sum(), max_difference))
+            differs = mask_differs | value_differs
+            if not differs.any(): continue
+            nrOfDifferentMaps += 1
+            rows, cols = np.nonzero(differs)
+            for row, col in zip(rows[:nrOfListedCells], cols[:nrOfListedCells]):
+                print("    row %5d col %5d : gdalwarp %s, numpy %s" %(row, col, str(reference[row, col]), str(values[row, col])))
+    finally:
+        shutil.rmtree(tmpDir)
+
+    if nrOfDifferentMaps > 0:
+        print(str(nrOfDifferentMaps)+" of "+str(len(input_maps))+" maps differ: keep the warp engine gdalwarp.")
+        return 1
+    print("All "+str(len(input_maps))+" maps are identical.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,6 +27,7 @@ class ModelTime(object):
         # get nrOfTimeSteps if defined:
         if strEndTime == None and nrOfTimeSteps != None:
             self._nrOfTimeSteps = nrOfTimeSteps
+            self._endTime = self._startTime + datetime.timedelta(days=1 * (nrOfTimeSteps - 1))
 
         self._monthIdx = 0 # monthly indexes since the simulation starts
         self._annuaIdx = 0 #  yearly indexes since the simulation starts
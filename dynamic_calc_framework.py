@@ -4,12 +4,18 @@
 import os
 import sys
 import datetime
+import numpy as np
 
 import pcraster as pcr
 from pcraster.framework import DynamicModel
 
-from outputNetcdf import OutputNetcdf
+from outputNetcdf import makeOutput
 import virtualOS as vos
+import reprojection
+import variable_expressions
+import efas_variable_list as varDict
+from prefetch import Prefetcher
+import instrumentation
 
 import logging
 logger = logging.getLogger(__name__)
@@ -19,7 +25,12 @@ class CalcFramework(DynamicModel):
     def __init__(self, cloneMapFileName,\
                        pcraster_files, \
                        modelTime, \
-                       output, inputEPSG = None, outputEPSG = None, resample_method = None):
+                       output, inputEPSG = None, outputEPSG = None, resample_method = None,\
+                       warp_engine = "gdalwarp",\
+                       tmpDir = None,\
+                       create_netcdf = True,\
+                       prefetch_depth = 0,\
+                       resume = False):
         DynamicModel.__init__(self)
         
         # set the clone map
@@ -30,19 +41,33 @@ class CalcFramework(DynamicModel):
         self.modelTime = modelTime
         
         # output file name, folder name, etc. 
-        self.output = output
-        self.output['file_name'] = vos.getFullPath(self.output['file_name'], self.output['folder'])
+        # - output can be a dictionary (one variable) or a list of dictionaries (several variables converted in one pass)
+        self.outputs = output
+        if isinstance(self.outputs, dict): self.outputs = [self.outputs]
+        self.output = self.outputs[0]
+        for output in self.outputs:
+            output['file_name'] = vos.getFullPath(output['file_name'], output['folder'])
         
         # input and output projection/coordinate systems 
         self.inputEPSG  =  inputEPSG
         self.outputEPSG = outputEPSG
         self.resample_method = resample_method
+        
+        # resampling/reprojection engine: "gdalwarp" (gdal command line tools, default), "gdal" (gdal python bindings, in memory) 
+        # or "numpy" (in-process; see compare_warp_engines.py for a comparison against gdalwarp)
+        self.warp_engine = warp_engine
+        if self.warp_engine == "numpy" and not reprojection.is_supported(self.inputEPSG, self.outputEPSG, self.resample_method):
+            logger.warning("The in-process resampling does not support the method "+str(self.resample_method)+" ; gdalwarp is used.")
+            self.warp_engine = "gdalwarp"
+        if self.warp_engine == "gdal" and vos.gdal == None:
+            logger.warning("The gdal python bindings are not available for the in-memory resampling ; gdalwarp is used.")
+            self.warp_engine = "gdalwarp"
 
         # prepare temporary directory
-        self.tmpDir = output['folder']+"/tmp/"
+        self.tmpDir = tmpDir
+        if self.tmpDir == None: self.tmpDir = self.output['folder']+"/tmp/"
         try:
             os.makedirs(self.tmpDir)
-            os.system('rm -r '+tmpDir+"/*")
         except:
             pass
         
@@ -51,83 +76,152 @@ class CalcFramework(DynamicModel):
         # - the begining part of pcraster file names (e.g. "pr" for "pr000000.001")
         self.pcraster_file_name = self.pcraster_files['directory']+"/"+\
                                   self.pcraster_files['file_name']
+        
+        # expressions for the output variables (see efas_variable_list.expression), compiled only once;
+        # their inputs (efas variable codes, e.g. "tn" and "tx") are read only once per time step, 
+        # also if they are used by several output variables
+        self.expressions = {}
+        for output in self.outputs:
+            efas_variable_name = output.get('efas_variable_name', self.pcraster_files['file_name'])
+            self.expressions[output['variable_name']] = variable_expressions.getCompiledExpression(output.get('expression', varDict.expression[efas_variable_name]))
+
+        # reading ahead: the input maps of the next prefetch_depth time steps are read in a background thread (0: no reading ahead)
+        # - only with the warp engine "numpy" (numpy arrays only): the other engines use pcraster objects (global clone) and 
+        #   gdalwarpPCR uses the shared tmpDir, so they must not be used in the background thread
+        self.prefetcher = None
+        if prefetch_depth > 0 and self.warp_engine != "numpy":
+            logger.info('Reading ahead is only used with the warp engine numpy.')
+        if prefetch_depth > 0 and self.warp_engine == "numpy": self.prefetcher = Prefetcher(self.read_inputs, self.modelTime.nrOfTimeSteps, prefetch_depth)
+
+        # the first time step to be calculated (with resume, the first time step that is missing in the output files)
+        self.first_time_step = 1
+
+        # without creating netcdf files, e.g. for the worker processes of ParallelCalcFramework
+        if create_netcdf == False: return
 
-        # object for reporting
-        self.netcdf_report = OutputNetcdf(mapattr_dict = None,\
-                                          cloneMapFileName = cloneMapFileName,\
-                                          netcdf_format = "NETCDF3_CLASSIC",\
-                                          netcdf_zlib = False,\
-                                          netcdf_attribute_dict = None,\
-                                          netcdf_attribute_description = self.output['description'])       
-
-        # make a netcdf file
-        self.netcdf_report.createNetCDF(self.output['file_name'],\
-                                        self.output['variable_name'],\
-                                        self.output['unit'],\
-                                        self.output['long_name'])
+        # objects for reporting, one for every output variable
+        self.netcdf_reports = {}
+        first_time_steps = []
+        for output in self.outputs:
+            netcdf_report = makeOutput(mapattr_dict = None,\
+                                       cloneMapFileName = cloneMapFileName,\
+                                       netcdf_format = output.get('format', "NETCDF3_CLASSIC"),\
+                                       netcdf_zlib = output.get('zlib', False),\
+                                       netcdf_attribute_dict = None,\
+                                       netcdf_attribute_description = output['description'],\
+                                       netcdf_buffer_size = output.get('buffer_size', None),\
+                                       netcdf_complevel = output.get('complevel', None),\
+                                       netcdf_shuffle = output.get('shuffle', True),\
+                                       netcdf_chunking = output.get('chunking', None),\
+                                       netcdf_write_behind = output.get('write_behind', None),\
+                                       zarr_compressor = output.get('compressor', None))
+
+            # make a netcdf file, or (resume) continue an existing one: the run starts at the first time step 
+            # that is missing in (one of) the files; time steps that are already written are written again at their positions
+            if resume and os.path.exists(output['file_name']):
+                nrOfWritten = netcdf_report.openNetCDF(output['file_name'],\
+                                                       output['variable_name'],\
+                                                       output['unit'],\
+                                                       self.modelTime.startTime,\
+                                                       self.modelTime.nrOfTimeSteps)
+                first_time_steps.append(nrOfWritten + 1)
+            else:
+                # - preallocated layout (see OutputNetcdf.createNetCDF; always for zarr stores): all time steps of the run
+                nrOfTimeSteps = None
+                if output.get('preallocate', False) or output.get('format', None) == "zarr": nrOfTimeSteps = self.modelTime.nrOfTimeSteps
+                netcdf_report.createNetCDF(output['file_name'],\
+                                           output['variable_name'],\
+                                           output['unit'],\
+                                           output['long_name'],\
+                                           nrOfTimeSteps,\
+                                           self.modelTime.startTime)
+                first_time_steps.append(1)
+            self.netcdf_reports[output['variable_name']] = netcdf_report
+        self.first_time_step = min(first_time_steps)
+        if self.first_time_step > 1: logger.info('Resuming the run at the time step '+str(self.first_time_step)+'.')
         
     def initial(self): 
         pass
 
+    def read_map(self, pcraster_map_file_name):
+        
+        # reading a pcraster map (at the clone map) as a masked numpy array
+        if self.warp_engine == "numpy":
+            # - memory-mapped and resampled in-process, without any pcraster objects
+            return vos.readPCRmapCloneToNumpy(v = pcraster_map_file_name,\
+                                              cloneMapFileName = self.cloneMapFileName,\
+                                              inputEPSG = self.inputEPSG,\
+                                              outputEPSG = self.outputEPSG,\
+                                              method = self.resample_method)
+        if self.warp_engine == "gdal" and not vos.isSameClone(pcraster_map_file_name, self.cloneMapFileName):
+            # - warped in memory by the gdal python bindings, without any temporary files
+            if self.inputEPSG == self.outputEPSG or self.outputEPSG == None:
+                return vos.gdalwarpInMemory(pcraster_map_file_name, self.cloneMapFileName)
+            return vos.gdalwarpInMemory(pcraster_map_file_name, self.cloneMapFileName,\
+                                        inputEPSG = self.inputEPSG,\
+                                        outputEPSG = self.outputEPSG,\
+                                        method = self.resample_method)
+        pcr_map_values = vos.readPCRmapClone(v = pcraster_map_file_name,\
+                                             cloneMapFileName = self.cloneMapFileName,\
+                                             tmpDir = self.tmpDir,\
+                                             absolutePath = None, isLddMap = False,\
+                                             cover = None,\
+                                             isNomMap = False,\
+                                             inputEPSG = self.inputEPSG,\
+                                             outputEPSG = self.outputEPSG,\
+                                             method = self.resample_method,\
+                                             warpEngine = self.warp_engine)
+        return np.ma.masked_invalid(pcr.pcr2numpy(pcr_map_values, np.nan))
+
+    def read_inputs(self, timeStepPCR):
+        
+        # read all input maps needed for the time step timeStepPCR (every map only once)
+        inputs = {}
+        for output in self.outputs:
+            for code in self.expressions[output['variable_name']].inputs:
+                if code in inputs.keys(): continue
+                pcraster_map_file_name = pcr.framework.frameworkBase.generateNameT(self.pcraster_files['directory']+"/"+code,\
+                                                                                   timeStepPCR) 
+                inputs[code] = self.read_map(pcraster_map_file_name)
+        return inputs
+
+    def get_inputs(self, timeStepPCR):
+
+        # the input maps of the time step timeStepPCR (read ahead, if a prefetcher is used)
+        if self.prefetcher == None: return self.read_inputs(timeStepPCR)
+        return self.prefetcher.get(timeStepPCR)
+
+    def calculate(self, timeStepPCR):
+        
+        # the output values (as masked numpy arrays) of all output variables for the pcraster timestep timeStepPCR
+        inputs = self.get_inputs(timeStepPCR)
+        map_values = {}
+        for output in self.outputs:
+            map_values[output['variable_name']] = self.expressions[output['variable_name']].evaluate(inputs)
+        return map_values
+
+    @instrumentation.timed('CalcFramework.dynamic')
     def dynamic(self):
         
         # re-calculate current model time using current pcraster timestep value
         self.modelTime.update(self.currentTimeStep())
 
-        # for variables other than temperature and maximum temperature, just read them directly
-        if self.output['variable_name'] != "temperature" and self.output['variable_name'] != "maximum_temperature":
-            
-            pcraster_map_file_name = pcr.framework.frameworkBase.generateNameT(self.pcraster_file_name,\
-                                                                               self.modelTime.timeStepPCR) 
-            pcr_map_values = vos.readPCRmapClone(v = pcraster_map_file_name,\
-                                                 cloneMapFileName = self.cloneMapFileName,\
-                                                 tmpDir = self.tmpDir,\
-                                                 absolutePath = None, isLddMap = False,\
-                                                 cover = None,\
-                                                 isNomMap = False,\
-                                                 inputEPSG = self.inputEPSG,\
-                                                 outputEPSG = self.outputEPSG,\
-                                                 method = self.resample_method)
-
-        # for temperature and maximum temperature, we have to make sure that maximum temperature is higher than minimum temperature
-        if self.output['variable_name'] == "temperature" or self.output['variable_name'] == "maximum_temperature":
-            
-            min_map_file_name = pcr.framework.frameworkBase.generateNameT(self.pcraster_files['directory']+"/tn", self.modelTime.timeStepPCR)
-            max_map_file_name = pcr.framework.frameworkBase.generateNameT(self.pcraster_files['directory']+"/tx", self.modelTime.timeStepPCR)
-            min_map_values = vos.readPCRmapClone(v = min_map_file_name,\
-                                                 cloneMapFileName = self.cloneMapFileName,\
-                                                 tmpDir = self.tmpDir,\
-                                                 absolutePath = None, isLddMap = False,\
-                                                 cover = None,\
-                                                 isNomMap = False,\
-                                                 inputEPSG = self.inputEPSG,\
-                                                 outputEPSG = self.outputEPSG,\
-                                                 method = self.resample_method)
-            max_map_values = vos.readPCRmapClone(v = max_map_file_name,\
-                                                 cloneMapFileName = self.cloneMapFileName,\
-                                                 tmpDir = self.tmpDir,\
-                                                 absolutePath = None, isLddMap = False,\
-                                                 cover = None,\
-                                                 isNomMap = False,\
-                                                 inputEPSG = self.inputEPSG,\
-                                                 outputEPSG = self.outputEPSG,\
-                                                 method = self.resample_method)
-            
-            # make sure that maximum values are higher than minimum values
-            max_map_values = pcr.max(min_map_values, max_map_values)
-            
-            if self.output['variable_name'] == "temperature": pcr_map_values = 0.50*(min_map_values + \
-                                                                                     max_map_values)
-            if self.output['variable_name'] == "maximum_temperature": pcr_map_values = pcr.max(min_map_values, max_map_values)
-        
-        # for precipitation, converting the unit from mm.day-1 to m.day-1
-        if self.output['variable_name'] == "precipitation": pcr_map_values *= 0.001
+        # reading and calculating the output values
+        map_values = self.calculate(self.modelTime.timeStepPCR)
         
         # reporting
         timeStamp = datetime.datetime(self.modelTime.year,\
                                       self.modelTime.month,\
                                       self.modelTime.day,0)
-        self.netcdf_report.data2NetCDF(self.output['file_name'],\
-                                       self.output['variable_name'],\
-                                       pcr.pcr2numpy(pcr_map_values,vos.MV),\
-                                       timeStamp)
+        for output in self.outputs:
+            netcdf_report = self.netcdf_reports[output['variable_name']]
+            netcdf_report.data2NetCDF(output['file_name'],\
+                                      output['variable_name'],\
+                                      np.ma.filled(map_values[output['variable_name']], vos.MV),\
+                                      timeStamp, self.modelTime.timeStepPCR - 1)
+
+            # closing the file at the end of the run (this also writes the remaining buffered time steps)
+            if self.modelTime.isLastTimeStep(): netcdf_report.close(output['file_name'])
+
+        # stop reading ahead at the end of the run
+        if self.modelTime.isLastTimeStep() and self.prefetcher != None: self.prefetcher.stop()
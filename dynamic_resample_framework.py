@@ -10,15 +10,23 @@ import numpy as np
 import pcraster as pcr
 from pcraster.framework import DynamicModel
 
-from outputNetcdf import OutputNetcdf
+from outputNetcdf import makeOutput
 import virtualOS as vos
+from upscaling import AreaWeightedUpscaler
+from prefetch import Prefetcher
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
 
 class ResampleFramework(DynamicModel):
 
     def __init__(self, input_netcdf,\
                        output_netcdf,\
                        modelTime,\
-                       tmpDir = "/dev/shm/"):
+                       tmpDir = "/dev/shm/",\
+                       prefetch_depth = 0,\
+                       numpy_mode = False):
         DynamicModel.__init__(self) 
 
         self.input_netcdf = input_netcdf
@@ -26,17 +34,31 @@ class ResampleFramework(DynamicModel):
         self.tmpDir = tmpDir
         self.modelTime = modelTime
 
+        # numpy mode: reading, upscaling and writing with numpy (masked) arrays only, without pcraster objects
+        # and without pcr.setclone (global state), so that several resampling jobs can be run in one process (see run)
+        self.numpy_mode = numpy_mode
+
         # a dictionary contains input clone properties (based on the input netcdf file)
         #~ self.input_clone = vos.netcdfCloneAttributes(self.input_netcdf['file_name'],\
                                                      #~ np.round(self.input_netcdf['cell_resolution']*60.,1),\
                                                      #~ True)
-        pcr.setclone(self.input_netcdf['clone_file'])
-        self.input_clone = {}
-        self.input_clone['cellsize'] = pcr.clone().cellSize()
-        self.input_clone['rows']     = int(pcr.clone().nrRows()) 
-        self.input_clone['cols']     = int(pcr.clone().nrCols())
-        self.input_clone['xUL']      = round(pcr.clone().west(), 2)
-        self.input_clone['yUL']      = round(pcr.clone().north(), 2)
+        if self.numpy_mode:
+            # - from the header of the clone map
+            attributes = vos.getMapAttributesALL(self.input_netcdf['clone_file'])
+            self.input_clone = {}
+            self.input_clone['cellsize'] = attributes['cellsize']
+            self.input_clone['rows']     = int(attributes['rows'])
+            self.input_clone['cols']     = int(attributes['cols'])
+            self.input_clone['xUL']      = round(attributes['xUL'], 2)
+            self.input_clone['yUL']      = round(attributes['yUL'], 2)
+        else:
+            pcr.setclone(self.input_netcdf['clone_file'])
+            self.input_clone = {}
+            self.input_clone['cellsize'] = pcr.clone().cellSize()
+            self.input_clone['rows']     = int(pcr.clone().nrRows()) 
+            self.input_clone['cols']     = int(pcr.clone().nrCols())
+            self.input_clone['xUL']      = round(pcr.clone().west(), 2)
+            self.input_clone['yUL']      = round(pcr.clone().north(), 2)
 
         # resampling factor: ratio between output and input resolutions
         self.resample_factor = self.output_netcdf["cell_resolution"]/\
@@ -55,77 +77,131 @@ class ResampleFramework(DynamicModel):
             self.output_netcdf['xUL'     ] = self.input_clone['xUL']
             self.output_netcdf['yUL'     ] = self.input_clone['yUL']
 
-            # get the unique ids for the output resolution
-            # - use the clone for the output resolution (only for a temporary purpose)
-            pcr.setclone(self.output_netcdf['rows'    ],
-                         self.output_netcdf['cols'    ],
-                         self.output_netcdf['cellsize'],
-                         self.output_netcdf['xUL'     ],
-                         self.output_netcdf['yUL'     ])
-            # - unique_ids in a numpy object
-            cell_unique_ids = pcr.pcr2numpy(pcr.scalar(pcr.uniqueid(pcr.boolean(1.))),vos.MV)
-
             # the remaining pcraster calculations are performed at the input resolution
-            pcr.setclone(self.input_clone['rows'    ],
-                         self.input_clone['cols'    ],
-                         self.input_clone['cellsize'],
-                         self.input_clone['xUL'     ],
-                         self.input_clone['yUL'     ])
+            if not self.numpy_mode:
+                pcr.setclone(self.input_clone['rows'    ],
+                             self.input_clone['cols'    ],
+                             self.input_clone['cellsize'],
+                             self.input_clone['xUL'     ],
+                             self.input_clone['yUL'     ])
             
             # clone map file 
             self.clone_map_file = self.input_netcdf['clone_file']
             
-            # cell unique ids in a pcraster object
-            self.unique_ids = pcr.nominal(pcr.numpy2pcr(pcr.Scalar,
-                              vos.regridData2FinerGrid(self.resample_factor,cell_unique_ids, vos.MV), vos.MV))
-
             # cell area (m2)
-            self.cell_area = vos.readPCRmapClone(\
-                             self.input_netcdf["cell_area"],\
-                             self.clone_map_file,\
-                             self.tmpDir)
+            if self.numpy_mode:
+                cell_area = vos.readPCRmapCloneToNumpy(\
+                            self.input_netcdf["cell_area"],\
+                            self.clone_map_file)
+                cell_area = np.ma.filled(np.ma.asarray(cell_area, dtype = np.float64), np.nan)
+            else:
+                self.cell_area = vos.readPCRmapClone(\
+                                 self.input_netcdf["cell_area"],\
+                                 self.clone_map_file,\
+                                 self.tmpDir)
+                cell_area = pcr.pcr2numpy(self.cell_area, np.nan)
+
+            # area weighted upscaling operator (the zones and cell areas are fixed during the run)
+            self.upscaler = AreaWeightedUpscaler(cell_area,\
+                                                 self.resample_factor,\
+                                                 self.output_netcdf['rows'],\
+                                                 self.output_netcdf['cols'])
             
         else: # downscaling / resampling to smaller cell length
 
             # all pcraster calculations are performed at the output resolution
-            pcr.setclone(self.output_netcdf['rows'    ],
-                         self.output_netcdf['cols'    ],
-                         self.output_netcdf['cellsize'],
-                         self.output_netcdf['xUL'     ],
-                         self.output_netcdf['yUL'     ])
+            if not self.numpy_mode:
+                pcr.setclone(self.output_netcdf['rows'    ],
+                             self.output_netcdf['cols'    ],
+                             self.output_netcdf['cellsize'],
+                             self.output_netcdf['xUL'     ],
+                             self.output_netcdf['yUL'     ])
 
             # clone map file
             self.clone_map_file = self.output_netcdf['clone_file']
         
         # an object for netcdf reporting
-        self.output = OutputNetcdf(mapattr_dict = self.output_netcdf,\
-                                   cloneMapFileName = None,\
-                                   netcdf_format = self.output_netcdf['format'],\
-                                   netcdf_zlib = self.output_netcdf['zlib'],\
-                                   netcdf_attribute_dict = self.output_netcdf['netcdf_attribute'],\
-                                   netcdf_attribute_description = None)
+        self.output = makeOutput(mapattr_dict = self.output_netcdf,\
+                                 cloneMapFileName = None,\
+                                 netcdf_format = self.output_netcdf['format'],\
+                                 netcdf_zlib = self.output_netcdf['zlib'],\
+                                 netcdf_attribute_dict = self.output_netcdf['netcdf_attribute'],\
+                                 netcdf_attribute_description = None,\
+                                 netcdf_buffer_size = self.output_netcdf.get('buffer_size', None),\
+                                 netcdf_complevel = self.output_netcdf.get('complevel', None),\
+                                 netcdf_shuffle = self.output_netcdf.get('shuffle', True),\
+                                 netcdf_chunking = self.output_netcdf.get('chunking', None),\
+                                 netcdf_write_behind = self.output_netcdf.get('write_behind', None),\
+                                 zarr_compressor = self.output_netcdf.get('compressor', None))
         
-        # preparing the netcdf file at coarse resolution:
+        # the input is read as a numpy array (see read_input) in the numpy mode and for upscaling (the upscaler uses numpy arrays);
+        # pcraster objects are only needed for downscaling in the pcraster mode
+        self.read_numpy = self.numpy_mode or self.resample_factor > 1.0
+
+        # reading ahead: the input of the next prefetch_depth time steps is read in a background thread (0: no reading ahead)
+        # - only if the input is read as a numpy array: pcraster objects (e.g. pcr.numpy2pcr in vos.netcdf2PCRobjClone) depend 
+        #   on the global clone that is used by the main thread, so they must not be made in the background thread
+        self.prefetcher = None
+        if prefetch_depth > 0 and not self.read_numpy:
+            logger.info('Reading ahead is not used for downscaling in the pcraster mode.')
+        if prefetch_depth > 0 and self.read_numpy: self.prefetcher = Prefetcher(self.read_input, self.modelTime.nrOfTimeSteps, prefetch_depth)
+
+        # preparing the netcdf file at coarse resolution (preallocated layout: all time steps of the run, see OutputNetcdf.createNetCDF):
+        nrOfTimeSteps = None
+        if self.output_netcdf.get('preallocate', False) or self.output_netcdf['format'] == "zarr": nrOfTimeSteps = self.modelTime.nrOfTimeSteps
         self.output.createNetCDF(self.output_netcdf['file_name'],\
                                  self.output_netcdf['variable_name'],\
-                                 self.output_netcdf['variable_unit'])
+                                 self.output_netcdf['variable_unit'],\
+                                 nrOfTimeSteps = nrOfTimeSteps,\
+                                 startTime = self.modelTime.startTime)
         
     def initial(self): 
         pass
 
+    def read_input(self, timeStepPCR):
+
+        # the input value of the pcraster time step timeStepPCR (the netcdf library is not thread safe, see vos.netcdf_lock)
+        date = self.modelTime.startTime + datetime.timedelta(days=1 * (timeStepPCR - 1))
+        with vos.netcdf_lock:
+            if self.read_numpy:
+                # - as a masked array (missing values are masked)
+                idx = vos.netcdfTimeIndexes(self.input_netcdf['file_name'], [datetime.datetime(date.year, date.month, date.day)])
+                value = vos.netcdf2NumpyClone(self.input_netcdf['file_name'],\
+                                              self.input_netcdf['variable_name'],\
+                                              idx,\
+                                              self.clone_map_file)[0]
+                # - in the pcraster mode, with the single precision of a pcraster scalar map (as vos.netcdf2PCRobjClone)
+                if not self.numpy_mode: value = np.ma.asarray(value, dtype = np.float32)
+                return value
+            return vos.netcdf2PCRobjClone(ncFile  = self.input_netcdf['file_name'],
+                                          varName = self.input_netcdf['variable_name'],
+                                          dateInput = datetime.datetime(date.year, date.month, date.day),
+                                          useDoy = None,
+                                          cloneMapFileName = self.clone_map_file)
+
     def dynamic(self):
         
         # update model time using the current pcraster timestep value
         self.modelTime.update(self.currentTimeStep())
+        self.resample_time_step()
 
-        # reading
+    def run(self):
+
+        # numpy mode: the time loop without the pcraster DynamicFramework
+        for timeStepPCR in range(1, self.modelTime.nrOfTimeSteps + 1):
+            self.modelTime.update(timeStepPCR)
+            self.resample_time_step()
+
+    @instrumentation.timed('ResampleFramework.dynamic')
+    def resample_time_step(self):
+
+        # reading (read ahead, if a prefetcher is used)
         data_available = True
         if data_available:
-            input_value = vos.netcdf2PCRobjClone(ncFile  = self.input_netcdf['file_name'],
-                                                 varName = self.input_netcdf['variable_name'],
-                                                 dateInput = str(self.modelTime.fulldate),
-                                                 useDoy = None,
-                                                 cloneMapFileName = self.clone_map_file)
+            if self.prefetcher == None:
+                input_value = self.read_input(self.modelTime.timeStepPCR)
+            else:
+                input_value = self.prefetcher.get(self.modelTime.timeStepPCR)
             data_available = True  
         
         else:
@@ -137,16 +213,11 @@ class ResampleFramework(DynamicModel):
         # upscaling
         if data_available and self.resample_factor > 1.0:
         
-            # upscaling using cell area
-            cell_area = pcr.ifthen(pcr.defined(output_value), self.cell_area)
-            output_value_in_pcraster = \
-                            vos.getValDivZero(\
-                            pcr.areatotal(output_value*self.cell_area, self.unique_ids),\
-                            pcr.areatotal(self.cell_area, self.unique_ids), vos.smallNumber)
-            
-            # resample to the output clone resolution 
-            output_value = vos.regridToCoarse(pcr.pcr2numpy(output_value_in_pcraster, vos.MV),
-                                              self.resample_factor, "max", vos.MV)
+            # upscaling using cell area (area weighted average of the input cells that have values)
+            output_value = np.ma.filled(self.upscaler.upscale(output_value), vos.MV)
+
+        elif data_available and self.numpy_mode:
+            output_value = np.ma.filled(output_value, vos.MV)
 
         # reporting
         if data_available:
@@ -162,6 +233,8 @@ class ResampleFramework(DynamicModel):
                                     output_value,\
                                     timeStamp)
 
-        # closing the file at the end of
-        if self.modelTime.isLastTimeStep(): self.output.close(self.output_netcdf['file_name'])
+        # closing the file and stop reading ahead at the end of
+        if self.modelTime.isLastTimeStep():
+            if self.prefetcher != None: self.prefetcher.stop()
+            self.output.close(self.output_netcdf['file_name'])
 
@@ -6,6 +6,8 @@ netcdf_short_name = {}
 netcdf_unit       = {}
 netcdf_long_name  = {}
 description       = {}
+# expressions for calculating the netcdf variables from the efas (pcraster) input variables (see the module variable_expressions) 
+expression        = {}
 
 # pd Mean daily vapour pressure (hPa) 
 efas_variable_name = "pd"
@@ -13,6 +15,7 @@ netcdf_short_name[efas_variable_name] = 'vapour_pressure'
 netcdf_unit[efas_variable_name]       = 'hPa'
 netcdf_long_name[efas_variable_name]  = 'daily_mean_vapour_pressure'
 description[efas_variable_name]       = 'Mean daily vapour pressure (hPa).'
+expression[efas_variable_name]        = 'pd'
 
 # pr Daily precipitation (m) between 6 UTC on the day specified and 6 UTC on the next day 
 efas_variable_name = "pr"
@@ -20,6 +23,8 @@ netcdf_short_name[efas_variable_name] = 'precipitation'
 netcdf_unit[efas_variable_name]       = 'm.day-1'
 netcdf_long_name[efas_variable_name]  = 'daily_precipitation'
 description[efas_variable_name]       = 'Daily precipitation between 6 UTC on the day specified and 6 UTC on the next day.'
+# - converting the unit from mm.day-1 to m.day-1
+expression[efas_variable_name]        = 'pr * 0.001'
 
 # rg Downward_surface_solar_radiation) 
 efas_variable_name = "rg"
@@ -29,6 +34,7 @@ netcdf_long_name[efas_variable_name]  = 'calculated_downward_surface_solar_radia
 description[efas_variable_name]       = 'Downward surface solar radiation (J.m-2.day-1), see the references for the methodology. '
 description[efas_variable_name]      += 'Note that the unit is J/m2/day as given in the Lisvap manual p.18 (althoughh there is a tiny error it should be J m-2 d-1 instead of Jm-2 d): '
 description[efas_variable_name]      += 'https://ec.europa.eu/jrc/en/publication/eur-scientific-and-technical-research-reports/lisvap-evaporation-pre-processor-lisflood-water-balance-and-flood-simulation-model '
+expression[efas_variable_name]        = 'rg'
 
 # tn Daily minimum temperature (°C) between 18 UTC and 6 UTC (i.e. during the preceding night) at 2m 
 efas_variable_name = "tn"
@@ -36,6 +42,7 @@ netcdf_short_name[efas_variable_name] = 'minimum_temperature'
 netcdf_unit[efas_variable_name]       = 'degrees Celcius'
 netcdf_long_name[efas_variable_name]  = 'daily_minimum_temperature'
 description[efas_variable_name]       = 'Daily minimum temperature between 18 UTC and 6 UTC (i.e. during the preceding night) at 2m.'
+expression[efas_variable_name]        = 'tn'
 
 # tx Daily maximum temperature (°C) between 6 UTC and 18 UTC (i.e. during daytime) at 2m 
 efas_variable_name = "tx"
@@ -43,6 +50,8 @@ netcdf_short_name[efas_variable_name] = 'maximum_temperature'
 netcdf_unit[efas_variable_name]       = 'degrees Celcius'
 netcdf_long_name[efas_variable_name]  = 'daily_maximum_remperature'
 description[efas_variable_name]       = 'Daily maximum temperature between 6 UTC and 18 UTC (i.e. during daytime) at 2m.'
+# - making sure that maximum temperature is higher than minimum temperature
+expression[efas_variable_name]        = 'max(tn, tx)'
 
 # ta Daily mean temperature (°C) is calculated using ta=(tx+tn)/2 
 efas_variable_name = "ta"
@@ -50,6 +59,8 @@ netcdf_short_name[efas_variable_name] = 'temperature'
 netcdf_unit[efas_variable_name]       = 'degrees Celcius'
 netcdf_long_name[efas_variable_name]  = 'daily_mean_precipitation'
 description[efas_variable_name]       = 'Daily mean temperature (ta) ; calculated using ta = (tx+tn)/2 ; with tx and tn are the maximum and minimum temperature values.'
+# - with the corrected maximum temperature (see tx)
+expression[efas_variable_name]        = '(tn + max(tn, tx)) / 2.'
 
 # ws Mean daily wind speed at 10 metres (m/s) calculated from 3-hourly observations (0-24 UTC) 
 efas_variable_name = "ws"
@@ -57,4 +68,5 @@ netcdf_short_name[efas_variable_name] = 'wind_speed'
 netcdf_unit[efas_variable_name]       = 'm.s-1'
 netcdf_long_name[efas_variable_name]  = 'daily_mean_wind_speed'
 description[efas_variable_name]       = 'Mean daily wind speed at 10 m height (m/s) calculated from 3-hourly observations (0-24 UTC).'
+expression[efas_variable_name]        = 'ws'
 
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Per-stage timing and counters (e.g. for CalcFramework.dynamic, readPCRmapClone, netcdf2PCRobjClone
+#      and OutputNetcdf.slab2NetCDF). For every stage, the wall time of every call is collected, together with
+#      counters (e.g. bytes_read, bytes_written, subprocesses and cache hits/misses). At the end of a run,
+#      a summary (calls, total, p50, p95 and max per stage) is logged and written to a json file.
+#      The instrumentation is disabled by default; then, a timed call costs only one extra function call.
+#      The times of the stages are inclusive (e.g. CalcFramework.dynamic includes the reading and the writing).
+
+import time
+import json
+import functools
+import threading
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# instrumentation on/off (see enable)
+enabled = False
+
+# collected durations (seconds) and counters, per stage name
+durations = dict()
+counters  = dict()
+
+# stages can be timed in several threads (e.g. a prefetch.Prefetcher or the writer thread of OutputNetcdf)
+lock = threading.Lock()
+
+def enable(on = True):
+    global enabled
+    enabled = on
+
+def reset():
+    with lock:
+        durations.clear()
+        counters.clear()
+
+def add_duration(name, duration):
+    with lock:
+        if name not in durations.keys(): durations[name] = []
+        durations[name].append(duration)
+
+def count(name, counter, value = 1):
+    # add value to the counter of the stage name (e.g. count('netcdf2PCRobjClone', 'bytes_read', 4096))
+    if not enabled: return
+    with lock:
+        if name not in counters.keys(): counters[name] = {}
+        counters[name][counter] = counters[name].get(counter, 0) + value
+
+def timed(name):
+    # decorator: the wall time of every call of the function is collected as the stage name
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled: return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_duration(name, time.time() - start)
+        return wrapper
+    return decorator
+
+class Timer(object):
+
+    # context manager: the wall time of a block is collected as the stage name (see timer)
+    def __init__(self, name):
+        object.__init__(self)
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        add_duration(self.name, time.time() - self.start)
+        return False
+
+class NullTimer(object):
+
+    # context manager that does nothing (used if the instrumentation is disabled)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+null_timer = NullTimer()
+
+def timer(name):
+    if not enabled: return null_timer
+    return Timer(name)
+
+def summary():
+    # per stage: the number of calls, the total, p50, p95 and max durations (seconds) and the counters
+    with lock:
+        result = {}
+        for name in set(list(durations.keys()) + list(counters.keys())):
+            stage = {}
+            if name in durations.keys():
+                values = np.asarray(durations[name], dtype = np.float64)
+                stage['calls'] = int(values.size)
+                stage['total'] = float(values.sum())
+                stage['p50']   = float(np.percentile(values, 50))
+                stage['p95']   = float(np.percentile(values, 95))
+                stage['max']   = float(values.max())
+            stage['counters'] = dict(counters.get(name, {}))
+            result[name] = stage
+        return result
+
+def report(file_name = None):
+    # log the summary (through the handlers of virtualOS.initialize_logging) and write it to the json file file_name
+    if not enabled: return
+    stages = summary()
+    logger.info('Stage timing (seconds; the times of nested stages are included):')
+    logger.info("%-28s %8s %10s %10s %10s %10s  %s" %("stage", "calls", "total", "p50", "p95", "max", "counters"))
+    for name in sorted(stages.keys()):
+        stage = stages[name]
+        counter_text = ", ".join([key+"="+str(stage['counters'][key]) for key in sorted(stage['counters'].keys())])
+        if 'calls' not in stage.keys():
+            logger.info("%-28s %8s %10s %10s %10s %10s  %s" %(name, "-", "-", "-", "-", "-", counter_text))
+            continue
+        logger.info("%-28s %8d %10.3f %10.5f %10.5f %10.5f  %s" %(name, stage['calls'], stage['total'],\
+                                                                 stage['p50'], stage['p95'], stage['max'], counter_text))
+    if file_name == None: return
+    f = open(file_name, 'w')
+    try:
+        json.dump(stages, f, indent = 2, sort_keys = True)
+    finally:
+        f.close()
+    logger.info('Stage timing written to: '+str(file_name))
@@ -7,14 +7,77 @@ import datetime
 import time
 import re
 import subprocess
+import threading
+import traceback
 import netCDF4 as nc
 import numpy as np
 import pcraster as pcr
 import virtualOS as vos
+import instrumentation
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+logger = logging.getLogger(__name__)
 
 # the following dictionary is needed to avoid open and closing files
 filecache = dict()
 
+class NetcdfWriter(object):
+
+    # EHS: a writer thread with a bounded queue, for the write-behind mode of OutputNetcdf:
+    #      the (netcdf) calls are done by the writer thread, in their order, while the model continues.
+    #      An exception in the writer thread is raised again in the caller at its next call.
+
+    def __init__(self, queue_size, local):
+        object.__init__(self)
+
+        # local: the thread local state of the OutputNetcdf object (in the writer thread, its calls are done directly)
+        self.local  = local
+        self.queue  = queue.Queue(maxsize = max(1, int(queue_size)))
+        self.error  = None
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+
+        # (writer thread) do the calls in their order; after an error, the remaining calls are skipped
+        self.local.inside = True
+        while True:
+            item = self.queue.get()
+            try:
+                if item == None: return
+                function, args = item
+                if self.error is None:
+                    with vos.netcdf_lock: function(*args)
+            except:
+                logger.error('Writing to netcdf failed:\n'+traceback.format_exc())
+                self.error = sys.exc_info()[1]
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        # raise the exception of the writer thread (if any)
+        if self.error is not None: raise self.error
+
+    def submit(self, function, args):
+        # add a call to the queue (waits if the queue is full)
+        self.check()
+        self.queue.put((function, args))
+
+    def drain(self):
+        # wait until all calls are done
+        self.queue.join()
+        self.check()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
 class OutputNetcdf():
     
     def __init__(self, mapattr_dict,\
@@ -22,12 +85,44 @@ class OutputNetcdf():
                        netcdf_format = "NETCDF3_CLASSIC",\
                        netcdf_zlib = False,\
                        netcdf_attribute_dict = None,\
-                       netcdf_attribute_description = None):
+                       netcdf_attribute_description = None,\
+                       netcdf_buffer_size = None,\
+                       netcdf_complevel = None,\
+                       netcdf_shuffle = True,\
+                       netcdf_chunking = None,\
+                       netcdf_write_behind = None,\
+                       netcdf_time_type = "f8"):
         		
         # netcdf format and zlib setup
         self.format = netcdf_format
         self.zlib   = netcdf_zlib 
 
+        # number of time steps that are collected in memory before they are written as one slab (None or 1: no buffering)
+        self.buffer_size = netcdf_buffer_size
+        if self.buffer_size == None: self.buffer_size = 1
+        self.buffers = {}
+
+        # NETCDF4/HDF5 options: deflate level, shuffle filter and chunk shapes 
+        # - netcdf_chunking: None (netCDF library default), "map", "timeseries", "balanced" or a tuple (time, lat, lon)
+        self.complevel = netcdf_complevel
+        self.shuffle   = netcdf_shuffle
+        self.chunking  = netcdf_chunking
+        
+        # for files with a fixed time dimension: the index of the next time step to be written
+        self.next_time_index = {}
+
+        # for files with a preallocated time axis (see createNetCDF): the first time value and the written time steps;
+        # netcdf_time_type is the data type of its time values (days): "f8" or an integer type (e.g. "i4")
+        self.preallocated = {}
+        self.time_type = netcdf_time_type
+
+        # write-behind mode: the netcdf files are written by a writer thread (NetcdfWriter),
+        # netcdf_write_behind is the maximum number of calls in its queue (None or 0: synchronous writing)
+        self.write_behind = netcdf_write_behind
+        if self.write_behind == None: self.write_behind = 0
+        self.writer = None
+        self.local  = threading.local()
+
         # longitudes and latitudes
         if cloneMapFileName != None:\
            self.longitudes, self.latitudes, cellSizeInArcMin = self.set_latlon_based_on_cloneMapFileName(cloneMapFileName)
@@ -127,16 +222,98 @@ class OutputNetcdf():
 
         return longitudes, latitudes, cellSizeInArcMin  
 
-    def createNetCDF(self, ncFileName, varName, varUnits, longName=None):
+    def getChunkSizes(self, nrOfTimeSteps = None):
+
+        # chunk shapes (time, lat, lon) for NETCDF4 files, depending on the expected access pattern
+        if self.chunking == None or not self.format.startswith("NETCDF4"): return None
+        return self.calculateChunkSizes(self.chunking, nrOfTimeSteps)
+
+    def calculateChunkSizes(self, chunking, nrOfTimeSteps = None):
+
+        # chunk shapes (time, lat, lon) for the chunking "map", "timeseries", "balanced" or a tuple (time, lat, lon)
+        if isinstance(chunking, (tuple, list)): return tuple(chunking)
 
+        nrOfRows = len(self.latitudes)
+        nrOfCols = len(self.longitudes)
+        # - the number of time steps used for the chunk shapes (one year if the time dimension is unlimited)
+        nrOfTimes = nrOfTimeSteps
+        if nrOfTimes == None: nrOfTimes = 365
+        # - number of values per chunk (4 MiB of float32 values)
+        chunk_length = 1024 * 1024
+        
+        # map optimized: one chunk for every time step (a map is read from one chunk)
+        if chunking == "map":
+            return (1, nrOfRows, nrOfCols)
+        
+        # time series optimized: small spatial tiles, long in time (a cell time series is read from a few chunks)
+        if chunking == "timeseries":
+            tile = 16
+            rows = min(tile, nrOfRows)
+            cols = min(tile, nrOfCols)
+            return (max(1, min(nrOfTimes, chunk_length // (rows * cols))), rows, cols)
+        
+        # balanced: a map and a cell time series need (about) the same number of chunks 
+        # - spatial fraction per chunk r = (chunk_length / (nrOfTimes * nrOfRows * nrOfCols))^(1/4)
+        if chunking == "balanced":
+            fraction = (float(chunk_length) / (nrOfTimes * nrOfRows * nrOfCols)) ** 0.25
+            fraction = min(1.0, fraction)
+            rows  = max(1, int(round(fraction * nrOfRows)))
+            cols  = max(1, int(round(fraction * nrOfCols)))
+            times = max(1, min(nrOfTimes, chunk_length // (rows * cols)))
+            return (times, rows, cols)
+
+        msg = "Unknown netcdf chunking: "+str(chunking)
+        raise ValueError(msg)
+
+    def copyArgument(self, arg):
+        # (write-behind) the caller may change its arrays after the call, so the writer thread gets copies
+        if isinstance(arg, np.ndarray): return np.ma.array(arg, copy = True)
+        if isinstance(arg, dict): return dict([(key, self.copyArgument(value)) for key, value in arg.items()])
+        return arg
+
+    def callWriter(self, function, args, wait = False):
+
+        # EHS: the netcdf calls of this object go through this method (it returns False if the call must be done by the caller itself):
+        # - write-behind mode: the call is passed to the writer thread (wait: until it is done); numpy arrays are copied first
+        # - otherwise: the call is done while holding vos.netcdf_lock (the netcdf library is not thread safe)
+        if getattr(self.local, 'inside', False): return False
+        if self.write_behind > 0:
+            if self.writer == None: self.writer = NetcdfWriter(self.write_behind, self.local)
+            args = tuple([self.copyArgument(arg) for arg in args])
+            self.writer.submit(function, args)
+            if wait: self.writer.drain()
+            return True
+        with vos.netcdf_lock:
+            self.local.inside = True
+            try:
+                function(*args)
+            finally:
+                self.local.inside = False
+        return True
+
+    def createNetCDF(self, ncFileName, varName, varUnits, longName=None, nrOfTimeSteps=None, startTime=None):
+
+        # preallocated layout: with nrOfTimeSteps and startTime, the time dimension is fixed and all (daily) time values 
+        # are written at once; the time steps are then written at the positions of their time stamps (also out of order)
+        # and the number of leading written time steps is kept in the global attribute time_steps_written (see openNetCDF)
+        if self.callWriter(self.createNetCDF, (ncFileName, varName, varUnits, longName, nrOfTimeSteps, startTime), wait = True): return
+
+        self.next_time_index.pop(ncFileName, None)
+        self.preallocated.pop(ncFileName, None)
         rootgrp = nc.Dataset(ncFileName,'w',format= self.format)
 
-        #-create dimensions - time is unlimited, others are fixed
-        rootgrp.createDimension('time',None)
+        #-create dimensions - time is unlimited (unless nrOfTimeSteps is given), others are fixed
+        rootgrp.createDimension('time',nrOfTimeSteps)
         rootgrp.createDimension('lat',len(self.latitudes))
         rootgrp.createDimension('lon',len(self.longitudes))
 
-        date_time = rootgrp.createVariable('time','f4',('time',))
+        if nrOfTimeSteps == None:
+            date_time = rootgrp.createVariable('time','f4',('time',))
+        elif startTime != None:
+            date_time = rootgrp.createVariable('time',self.time_type,('time',))
+        else:
+            # fill values are needed to find the time steps that are not written yet
+            date_time = rootgrp.createVariable('time','f4',('time',),fill_value=vos.MV)
         date_time.standard_name = 'time'
         date_time.long_name = 'Days since 1901-01-01'
 
@@ -153,26 +330,174 @@ class OutputNetcdf():
         lon.long_name = 'longitude'
         lon.units = 'degrees_east'
 
-        lat[:]= self.latitudes
-        lon[:]= self.longitudes
+        attributeDictionary = self.attributeDictionary
+        for k, v in attributeDictionary.items(): setattr(rootgrp,k,v)
+        if nrOfTimeSteps != None and startTime != None: rootgrp.time_steps_written = np.int32(0)
+
+        # NETCDF3 with a fixed time dimension: the variable is defined last, and space for its attributes is reserved 
+        # in the header (a temporary attribute), otherwise the whole (filled) variable is moved for every attribute
+        reserve_header = nrOfTimeSteps != None and not self.format.startswith("NETCDF4")
+        if reserve_header: rootgrp.reserved_header_space = " " * 4096
 
         shortVarName = varName
         longVarName  = varName
         if longName != None: longVarName = longName
 
-        var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',),fill_value=vos.MV,zlib=self.zlib)
+        var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',),fill_value=vos.MV,zlib=self.zlib,\
+                                     **self.getCompressionArguments(nrOfTimeSteps))
+        if reserve_header: rootgrp.delncattr('reserved_header_space')
         var.standard_name = varName
         var.long_name = longVarName
         var.units = varUnits
 
-        attributeDictionary = self.attributeDictionary
-        for k, v in attributeDictionary.items(): setattr(rootgrp,k,v)
+        # the values are written after all definitions (in a NETCDF3 file, the variables with a fixed size
+        # would be moved and filled again for every definition after the first write)
+        lat[:]= self.latitudes
+        lon[:]= self.longitudes
+        if nrOfTimeSteps != None and startTime != None:
+            first = nc.date2num(datetime.datetime(startTime.year,startTime.month,startTime.day),date_time.units,date_time.calendar)
+            date_time[:] = first + np.arange(nrOfTimeSteps)
 
         rootgrp.sync()
         rootgrp.close()
 
+    def openNetCDF(self, ncFileName, varName, varUnits = None, startTime = None, nrOfTimeSteps = None):
+
+        # (resume/append) check an existing netcdf file, instead of creating it (see createNetCDF):
+        # - the grid (latitudes and longitudes) and the variable must match, the time stamps must be daily and,
+        #   if startTime is given, start at startTime; a fixed time dimension must have (at least) nrOfTimeSteps time steps
+        # - returns the number of written time steps (time steps with a time stamp); new time steps are appended after them
+        with vos.netcdf_lock:
+            rootgrp = nc.Dataset(ncFileName,'r')
+            try:
+                msg = None
+                if varName not in rootgrp.variables.keys():
+                    msg = "The variable "+str(varName)+" is not available in the existing file "+str(ncFileName)
+                elif rootgrp.variables[varName].dimensions != ('time','lat','lon'):
+                    msg = "The variable "+str(varName)+" in the existing file "+str(ncFileName)+" has the dimensions "+str(rootgrp.variables[varName].dimensions)
+                elif varUnits != None and getattr(rootgrp.variables[varName], 'units', None) != varUnits:
+                    msg = "The variable "+str(varName)+" in the existing file "+str(ncFileName)+" has the units "+str(getattr(rootgrp.variables[varName], 'units', None))
+                elif len(rootgrp.variables['lat']) != len(self.latitudes) or len(rootgrp.variables['lon']) != len(self.longitudes) or\
+                     not np.allclose(rootgrp.variables['lat'][:], self.latitudes, atol = 1e-4) or\
+                     not np.allclose(rootgrp.variables['lon'][:], self.longitudes, atol = 1e-4):
+                    msg = "The grid of the existing file "+str(ncFileName)+" does not match the output grid."
+                elif nrOfTimeSteps != None and not rootgrp.dimensions['time'].isunlimited() and len(rootgrp.dimensions['time']) < nrOfTimeSteps:
+                    msg = "The fixed time dimension of the existing file "+str(ncFileName)+" has only "+str(len(rootgrp.dimensions['time']))+" time steps"
+                if msg != None:
+                    logger.error(msg)
+                    raise ValueError(msg)
+
+                # the written time steps: all time steps before the first one without a time stamp
+                # (with a preallocated time axis: the attribute time_steps_written, see createNetCDF)
+                date_time = rootgrp.variables['time']
+                not_written = self.getTimeNotWritten(date_time)
+                nrOfWritten = len(not_written)
+                if np.any(not_written): nrOfWritten = int(np.argmax(not_written))
+                if 'time_steps_written' in rootgrp.ncattrs(): nrOfWritten = int(rootgrp.time_steps_written)
+                if nrOfWritten == 0: return 0
+
+                time_stamps = nc.num2date(date_time[:nrOfWritten], date_time.units, date_time.calendar)
+                first = datetime.date(time_stamps[0].year, time_stamps[0].month, time_stamps[0].day)
+                last  = datetime.date(time_stamps[-1].year, time_stamps[-1].month, time_stamps[-1].day)
+                if (startTime != None and first != startTime) or (last - first).days != nrOfWritten - 1:
+                    msg = "The time steps of the existing file "+str(ncFileName)+" ("+str(first)+" until "+str(last)+\
+                          ") do not continue a daily run from "+str(startTime)
+                    logger.error(msg)
+                    raise ValueError(msg)
+            finally:
+                rootgrp.close()
+
+        logger.info('Existing file '+str(ncFileName)+': '+str(nrOfWritten)+' time steps written ('+str(first)+' until '+str(last)+').')
+        return nrOfWritten
+
+    def getCompressionArguments(self, nrOfTimeSteps = None):
+
+        # optional arguments of createVariable for NETCDF4 files
+        arguments = {}
+        if not self.format.startswith("NETCDF4"): return arguments
+        if self.zlib:
+            arguments['shuffle'] = self.shuffle
+            if self.complevel != None: arguments['complevel'] = self.complevel
+        chunksizes = self.getChunkSizes(nrOfTimeSteps)
+        if chunksizes != None: arguments['chunksizes'] = chunksizes
+        return arguments
+
+    def getNextTimeIndex(self, ncFileName, timeStamp = None):
+
+        # the index of the next time step to be written
+        rootgrp = self.getRootGroup(ncFileName)
+        if rootgrp.dimensions['time'].isunlimited(): return len(rootgrp.variables['time'])
+
+        # - for a preallocated time axis: the position of the time stamp
+        preallocated = self.getPreallocatedTime(ncFileName)
+        if preallocated != None and timeStamp != None:
+            date_time = rootgrp.variables['time']
+            posCnt = int(round(nc.date2num(timeStamp,date_time.units,date_time.calendar) - preallocated['first']))
+            if posCnt < 0 or posCnt >= len(date_time):
+                msg = "The time stamp "+str(timeStamp)+" is not in the time axis of the file "+str(ncFileName)
+                logger.error(msg)
+                raise ValueError(msg)
+            return posCnt
+        if preallocated != None: return preallocated['written']
+        
+        # - for a fixed time dimension: the first time step without a time value
+        if ncFileName not in self.next_time_index.keys():
+            not_written = self.getTimeNotWritten(rootgrp.variables['time'])
+            if np.any(not_written):
+                self.next_time_index[ncFileName] = int(np.argmax(not_written))
+            else:
+                self.next_time_index[ncFileName] = len(not_written)
+        return self.next_time_index[ncFileName]
+
+    def getTimeNotWritten(self, date_time):
+
+        # the time steps without a valid time value: masked (fill value) or, for an unlimited time dimension
+        # (the time variable has no _FillValue, see createNetCDF), a default netcdf fill value or not finite 
+        values = date_time[:]
+        data = np.ma.getdata(values).astype(np.float64)
+        return np.ma.getmaskarray(values) | ~np.isfinite(data) | (np.abs(data) >= vos.MV)
+
+    def setTimeIndexWritten(self, ncFileName, posEnd, posStart = None):
+
+        # keep track of the written time steps (only needed for a fixed time dimension)
+        if ncFileName in self.next_time_index.keys():
+            self.next_time_index[ncFileName] = max(self.next_time_index[ncFileName], posEnd)
+
+        # - for a preallocated time axis: the number of leading written time steps is stored in the file
+        preallocated = self.getPreallocatedTime(ncFileName)
+        if preallocated == None: return
+        if posStart == None: posStart = posEnd - 1
+        written = preallocated['written']
+        preallocated['pending'].update(range(max(posStart, written), posEnd))
+        while written in preallocated['pending']:
+            preallocated['pending'].discard(written)
+            written += 1
+        if written != preallocated['written']:
+            preallocated['written'] = written
+            self.setTimeStepsWritten(ncFileName, written)
+
+    def setTimeStepsWritten(self, ncFileName, nrOfWritten):
+
+        # store the number of leading written time steps in the file (preallocated time axis)
+        self.getRootGroup(ncFileName).time_steps_written = np.int32(nrOfWritten)
+
+    def getPreallocatedTime(self, ncFileName):
+
+        # for a file with a preallocated time axis (see createNetCDF): its first time value, the number of leading 
+        # written time steps and the time steps written after them (pending); otherwise None
+        if ncFileName not in self.preallocated.keys():
+            rootgrp = self.getRootGroup(ncFileName)
+            self.preallocated[ncFileName] = None
+            if 'time_steps_written' in rootgrp.ncattrs():
+                self.preallocated[ncFileName] = {'first'  : float(rootgrp.variables['time'][0]),\
+                                                 'written': int(rootgrp.time_steps_written),\
+                                                 'pending': set()}
+        return self.preallocated[ncFileName]
+
     def changeAtrribute(self, ncFileName, attributeDictionary, closeFile = False):
 
+        if self.callWriter(self.changeAtrribute, (ncFileName, attributeDictionary, closeFile)): return
+
         if ncFileName in filecache.keys():
             #~ print "Cached: ", ncFileName
             rootgrp = filecache[ncFileName]
@@ -188,6 +513,8 @@ class OutputNetcdf():
 
     def addNewVariable(self, ncFileName, varName, varUnits, longName=None, closeFile = False):
 
+        if self.callWriter(self.addNewVariable, (ncFileName, varName, varUnits, longName, closeFile)): return
+
         if ncFileName in filecache.keys():
             #~ print "Cached: ", ncFileName
             rootgrp = filecache[ncFileName]
@@ -198,7 +525,8 @@ class OutputNetcdf():
 
         shortVarName = varName
 
-        var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',) ,fill_value=vos.MV,zlib=self.zlib)
+        var = rootgrp.createVariable(shortVarName,'f4',('time','lat','lon',) ,fill_value=vos.MV,zlib=self.zlib,\
+                                     **self.getCompressionArguments(len(rootgrp.dimensions['time'])))
         var.standard_name = varName
         var.long_name = varName
         var.units = varUnits
@@ -208,25 +536,117 @@ class OutputNetcdf():
 
     def data2NetCDF(self, ncFileName, shortVarName, varField, timeStamp, posCnt = None, closeFile = False):
 
+        if self.callWriter(self.data2NetCDF, (ncFileName, shortVarName, varField, timeStamp, posCnt, closeFile)): return
+
+        # buffered writing: collect time steps and write them as one slab (see slab2NetCDF)
+        if self.buffer_size > 1:
+            self.data2Buffer(ncFileName, shortVarName, varField, timeStamp, posCnt)
+            if closeFile == True: self.close(ncFileName)
+            return
+
+        # stage timing (see the module instrumentation): only the writing itself, in the thread that writes (see callWriter)
+        with instrumentation.timer('OutputNetcdf.data2NetCDF'):
+            rootgrp = self.getRootGroup(ncFileName)
+
+            # the values are written before their time stamp, so that a written time stamp (see openNetCDF) means a complete time step
+            if posCnt == None: posCnt = self.getNextTimeIndex(ncFileName, timeStamp)
+            rootgrp.variables[shortVarName][posCnt,:,:] = varField
+            if self.getPreallocatedTime(ncFileName) == None:
+                date_time = rootgrp.variables['time']
+                date_time[posCnt] = nc.date2num(timeStamp,date_time.units,date_time.calendar)
+            self.setTimeIndexWritten(ncFileName, posCnt + 1)
+
+            rootgrp.sync()
+            instrumentation.count('OutputNetcdf.data2NetCDF', 'bytes_written', varField.nbytes)
+        if closeFile == True: rootgrp.close()
+
+    def getRootGroup(self, ncFileName):
+
         if ncFileName in filecache.keys():
-            #~ print "Cached: ", ncFileName
             rootgrp = filecache[ncFileName]
         else:
-            #~ print "New: ", ncFileName
             rootgrp = nc.Dataset(ncFileName,'a')
             filecache[ncFileName] = rootgrp
+            self.setChunkCache(rootgrp)
+        return rootgrp
 
-        date_time = rootgrp.variables['time']
-        if posCnt == None: posCnt = len(date_time)
-        date_time[posCnt] = nc.date2num(timeStamp,date_time.units,date_time.calendar)
+    def setChunkCache(self, rootgrp, max_cache_size = 512 * 1024 * 1024):
 
-        rootgrp.variables[shortVarName][posCnt,:,:] = varField
+        # for chunked (NETCDF4) variables: a chunk cache that can hold all chunks of one time step,
+        # so that slabs can be written without re-reading/re-compressing partly written chunks
+        if not rootgrp.data_model.startswith("NETCDF4"): return
+        for var in rootgrp.variables.values():
+            chunking = var.chunking()
+            if chunking == 'contiguous' or len(chunking) != 3: continue
+            nrOfChunks = int(np.ceil(float(var.shape[1]) / chunking[1]) * np.ceil(float(var.shape[2]) / chunking[2]))
+            cache_size = nrOfChunks * int(np.prod(chunking)) * var.dtype.itemsize
+            var.set_var_chunk_cache(size = min(cache_size, max_cache_size), nelems = 2 * nrOfChunks + 1)
 
-        rootgrp.sync()
-        if closeFile == True: rootgrp.close()
+    def data2Buffer(self, ncFileName, shortVarName, varField, timeStamp, posCnt = None):
+
+        key = (ncFileName, shortVarName)
+        
+        # the position of this time step in the netcdf file
+        if key in self.buffers.keys() and self.buffers[key]['count'] > 0:
+            buffer_end = self.buffers[key]['start'] + self.buffers[key]['count']
+            if posCnt == None and self.getPreallocatedTime(ncFileName) != None: posCnt = self.getNextTimeIndex(ncFileName, timeStamp)
+            if posCnt == None: posCnt = buffer_end
+            # only contiguous time steps can be written as one slab
+            if posCnt != buffer_end: self.flush(ncFileName, shortVarName)
+        if posCnt == None: posCnt = self.getNextTimeIndex(ncFileName, timeStamp)
+        
+        # allocate the buffer (only once, it is re-used after every flush) 
+        if key not in self.buffers.keys():
+            self.buffers[key] = {}
+            self.buffers[key]['data']  = np.empty((self.buffer_size, len(self.latitudes), len(self.longitudes)), dtype = np.float32)
+            self.buffers[key]['time']  = [None] * self.buffer_size
+            self.buffers[key]['count'] = 0
+        buff = self.buffers[key]
+        if buff['count'] == 0: buff['start'] = posCnt
+        
+        buff['data'][buff['count'],:,:] = np.ma.filled(varField, vos.MV)
+        buff['time'][buff['count']]     = timeStamp
+        buff['count'] += 1
+
+        # write the slab if the buffer is full
+        if buff['count'] == self.buffer_size: self.flush(ncFileName, shortVarName)
+
+    def flush(self, ncFileName, shortVarName = None):
+
+        # write all buffered time steps of the file ncFileName (of the variable shortVarName or of all variables)
+        for key in self.buffers.keys():
+            if key[0] != ncFileName or (shortVarName != None and key[1] != shortVarName): continue
+            buff = self.buffers[key]
+            if buff['count'] == 0: continue
+            
+            self.slab2NetCDF(ncFileName, key[1], buff['data'][:buff['count'],:,:], buff['time'][:buff['count']], buff['start'])
+            buff['count'] = 0
+
+    def slab2NetCDF(self, ncFileName, shortVarName, varSlab, timeStamps, posStart, closeFile = False):
+
+        if self.callWriter(self.slab2NetCDF, (ncFileName, shortVarName, varSlab, list(timeStamps), posStart, closeFile)): return
+
+        # write several (contiguous) time steps at once: varSlab[i,:,:] for timeStamps[i] at the position posStart + i
+        # - stage timing (see the module instrumentation): the writing of the slab, in the thread that writes (see callWriter)
+        with instrumentation.timer('OutputNetcdf.slab2NetCDF'):
+            rootgrp = self.getRootGroup(ncFileName)
+
+            t0 = posStart
+            t1 = posStart + len(timeStamps)
+            rootgrp.variables[shortVarName][t0:t1,:,:] = varSlab
+            if self.getPreallocatedTime(ncFileName) == None:
+                date_time = rootgrp.variables['time']
+                date_time[t0:t1] = nc.date2num(list(timeStamps),date_time.units,date_time.calendar)
+            self.setTimeIndexWritten(ncFileName, t1, t0)
+
+            rootgrp.sync()
+            instrumentation.count('OutputNetcdf.slab2NetCDF', 'bytes_written', varSlab.nbytes)
+        if closeFile == True: self.close(ncFileName)
 
     def dataList2NetCDF(self, ncFileName, shortVarNameList, varFieldList, timeStamp, posCnt = None, closeFile = False):
 
+        if self.callWriter(self.dataList2NetCDF, (ncFileName, shortVarNameList, varFieldList, timeStamp, posCnt, closeFile)): return
+
         if ncFileName in filecache.keys():
             #~ print "Cached: ", ncFileName
             rootgrp = filecache[ncFileName]
@@ -236,17 +656,31 @@ class OutputNetcdf():
             filecache[ncFileName] = rootgrp
 
         date_time = rootgrp.variables['time']
-        if posCnt == None: posCnt = len(date_time)
+        if posCnt == None: posCnt = self.getNextTimeIndex(ncFileName, timeStamp)
 
         for shortVarName in shortVarNameList:
-            date_time[posCnt] = nc.date2num(timeStamp,date_time.units,date_time.calendar)
+            if self.getPreallocatedTime(ncFileName) == None:
+                date_time[posCnt] = nc.date2num(timeStamp,date_time.units,date_time.calendar)
             rootgrp.variables[shortVarName][posCnt,:,:] = varFieldList[shortVarName]
+        self.setTimeIndexWritten(ncFileName, posCnt + 1)
 
         rootgrp.sync()
         if closeFile == True: rootgrp.close()
 
     def close(self, ncFileName):
 
+        # write-behind: wait until everything is written and closed, then stop the writer thread
+        # (also if the writer thread failed: its error is raised after the thread is stopped)
+        if self.write_behind > 0 and not getattr(self.local, 'inside', False):
+            try:
+                self.callWriter(self.close, (ncFileName,), wait = True)
+            finally:
+                self.stopWriter(ncFileName)
+            return
+
+        # write the remaining buffered time steps
+        self.flush(ncFileName)
+
         if ncFileName in filecache.keys():
             #~ print "Cached: ", ncFileName
             rootgrp = filecache[ncFileName]
@@ -255,8 +689,35 @@ class OutputNetcdf():
             rootgrp = nc.Dataset(ncFileName,'a')
             filecache[ncFileName] = rootgrp
 
-        # closing the file 
+        # closing the file
         rootgrp.close()
 
         # remove ncFilename from filecache
         if ncFileName in filecache.keys(): filecache.pop(ncFileName, None)
+        self.next_time_index.pop(ncFileName, None)
+
+    def stopWriter(self, ncFileName):
+
+        # (write-behind) stop the writer thread; if the writer thread failed, the close call was skipped,
+        # so the file is closed here (without its remaining buffered time steps)
+        if self.writer == None: return
+        self.writer.stop()
+        self.writer = None
+        for key in self.buffers.keys():
+            if key[0] == ncFileName: self.buffers[key]['count'] = 0
+        self.next_time_index.pop(ncFileName, None)
+        if ncFileName not in filecache.keys(): return
+        with vos.netcdf_lock:
+            rootgrp = filecache.pop(ncFileName)
+            try:
+                rootgrp.close()
+            except:
+                logger.error('Closing '+str(ncFileName)+' failed.')
+
+def makeOutput(netcdf_format = "NETCDF3_CLASSIC", zarr_compressor = None, **arguments):
+    # the output object for netcdf_format: OutputZarr for "zarr", otherwise OutputNetcdf (arguments: as for OutputNetcdf)
+    # - the module outputZarr is only imported for zarr output
+    if netcdf_format == "zarr":
+        import outputZarr
+        return outputZarr.OutputZarr(netcdf_format = netcdf_format, zarr_compressor = zarr_compressor, **arguments)
+    return OutputNetcdf(netcdf_format = netcdf_format, **arguments)
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Zarr (local directory store) output, with the interface of OutputNetcdf (createNetCDF, data2NetCDF, slab2NetCDF, close).
+#      Every chunk of a zarr array is a separate file in the store, so that several processes can write disjoint
+#      (time) chunks of the same store at the same time (e.g. the worker processes of ParallelCalcFramework, see write_slab).
+#      The stores have the same grid, CF attributes (attributeDictionary) and time axis as the netcdf files; the dimension
+#      names are given in the attribute _ARRAY_DIMENSIONS (as used by xarray). The time axis is always preallocated
+#      (see OutputNetcdf.createNetCDF), unless the number of time steps is not known.
+#      Tested with zarr 2.3.2 / numcodecs 0.6.4 (the last releases for python 2.7); the zarr 3 api is not supported.
+
+import datetime
+
+import numpy as np
+import netCDF4 as nc
+
+from outputNetcdf import OutputNetcdf
+import virtualOS as vos
+import instrumentation
+
+# the zarr and numcodecs packages are only needed for zarr output
+try:
+    import zarr
+    import numcodecs
+except ImportError:
+    zarr = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# the following dictionary is needed to avoid opening the stores again
+storecache = dict()
+
+# default compressor (a numcodecs configuration)
+default_compressor = {'id': 'blosc', 'cname': 'zstd', 'clevel': 3, 'shuffle': 1}
+
+# time units and calendar (as in the netcdf files)
+time_units    = 'Days since 1901-01-01'
+time_calendar = 'standard'
+
+def write_values(array, varSlab, posStart):
+    # write the values of several time steps (varSlab[i,:,:] at the position posStart + i) to a zarr array
+    values = np.ma.filled(varSlab, vos.MV).astype(np.float32)
+    array[posStart:posStart + values.shape[0],:,:] = values
+    instrumentation.count('OutputZarr.slab2NetCDF', 'bytes_written', values.nbytes)
+
+def write_slab(storeName, shortVarName, varSlab, posStart):
+    # write the values of several time steps to an existing zarr store, without time stamps and without any bookkeeping
+    # (see OutputZarr.slabWritten), e.g. in a worker process; different processes must write different chunks
+    write_values(zarr.open_group(storeName, mode = 'r+')[shortVarName], varSlab, posStart)
+
+class OutputZarr(OutputNetcdf):
+
+    def __init__(self, mapattr_dict,\
+                       cloneMapFileName = None,\
+                       netcdf_format = "zarr",\
+                       netcdf_zlib = False,\
+                       netcdf_attribute_dict = None,\
+                       netcdf_attribute_description = None,\
+                       netcdf_buffer_size = None,\
+                       netcdf_complevel = None,\
+                       netcdf_shuffle = True,\
+                       netcdf_chunking = None,\
+                       netcdf_write_behind = None,\
+                       netcdf_time_type = "f8",\
+                       zarr_compressor = None):
+
+        if zarr == None:
+            msg = "The zarr and numcodecs packages are needed for zarr output."
+            logger.error(msg)
+            raise ImportError(msg)
+        if zarr.__version__.split('.')[0] != '2':
+            msg = "Zarr output needs a zarr 2 release (e.g. 2.3.2), not zarr "+str(zarr.__version__)+"."
+            logger.error(msg)
+            raise ImportError(msg)
+
+        # the netcdf arguments are used as for OutputNetcdf (netcdf_zlib, netcdf_complevel and netcdf_shuffle are not used)
+        # - netcdf_chunking: "map" (default), "timeseries", "balanced" or a tuple (time, lat, lon)
+        # - zarr_compressor: a numcodecs configuration (e.g. {'id': 'zlib', 'level': 4}), None (default_compressor) or False (no compression)
+        OutputNetcdf.__init__(self, mapattr_dict,\
+                                    cloneMapFileName,\
+                                    "zarr",\
+                                    netcdf_zlib,\
+                                    netcdf_attribute_dict,\
+                                    netcdf_attribute_description,\
+                                    netcdf_buffer_size,\
+                                    netcdf_complevel,\
+                                    netcdf_shuffle,\
+                                    netcdf_chunking,\
+                                    netcdf_write_behind,\
+                                    netcdf_time_type)
+        if self.chunking == None: self.chunking = "map"
+
+        self.compressor = None
+        if zarr_compressor == None: zarr_compressor = default_compressor
+        if zarr_compressor != False: self.compressor = numcodecs.get_codec(dict(zarr_compressor))
+
+    def getChunkSizes(self, nrOfTimeSteps = None):
+
+        # chunk shapes (time, lat, lon), bounded by the shape of the variable
+        chunks = self.calculateChunkSizes(self.chunking, nrOfTimeSteps)
+        if nrOfTimeSteps != None: chunks = (min(chunks[0], nrOfTimeSteps),) + tuple(chunks[1:])
+        return (max(1, chunks[0]), min(chunks[1], len(self.latitudes)), min(chunks[2], len(self.longitudes)))
+
+    def getTimeChunkLength(self, ncFileName, shortVarName):
+
+        # the number of time steps per chunk of the variable shortVarName (e.g. to find the slabs that can be written by write_slab)
+        return zarr.open_group(ncFileName, mode = 'r')[shortVarName].chunks[0]
+
+    def getRootGroup(self, ncFileName):
+
+        if ncFileName in storecache.keys():
+            root = storecache[ncFileName]
+        else:
+            root = zarr.open_group(ncFileName, mode = 'r+')
+            storecache[ncFileName] = root
+        return root
+
+    def createVariable(self, root, varName, varUnits, longName = None):
+
+        # a (time, lat, lon) float32 variable with the chunks and the compressor of this object
+        nrOfTimeSteps = root['time'].shape[0]
+        chunkTimeSteps = nrOfTimeSteps
+        if chunkTimeSteps == 0: chunkTimeSteps = None
+        var = root.create_dataset(varName,\
+                                  shape = (nrOfTimeSteps, len(self.latitudes), len(self.longitudes)),\
+                                  chunks = self.getChunkSizes(chunkTimeSteps),\
+                                  dtype = np.float32,\
+                                  compressor = self.compressor,\
+                                  fill_value = vos.MV)
+        longVarName = varName
+        if longName != None: longVarName = longName
+        var.attrs.update({'standard_name': varName, 'long_name': longVarName, 'units': varUnits,\
+                          '_ARRAY_DIMENSIONS': ['time', 'lat', 'lon']})
+        return var
+
+    def createNetCDF(self, ncFileName, varName, varUnits, longName=None, nrOfTimeSteps=None, startTime=None):
+
+        # a new zarr store ncFileName (a directory; an existing store is replaced)
+        # - with nrOfTimeSteps and startTime, all (daily) time values are written at once (preallocated time axis),
+        #   otherwise the time axis grows with every written time step
+        if self.callWriter(self.createNetCDF, (ncFileName, varName, varUnits, longName, nrOfTimeSteps, startTime), wait = True): return
+
+        self.preallocated.pop(ncFileName, None)
+        storecache.pop(ncFileName, None)
+        root = zarr.open_group(ncFileName, mode = 'w')
+        root.attrs.update(self.attributeDictionary)
+
+        lat = root.create_dataset('lat', data = np.asarray(self.latitudes, dtype = np.float32), compressor = None)
+        lat.attrs.update({'long_name': 'latitude', 'units': 'degrees_north', 'standard_name': 'latitude', '_ARRAY_DIMENSIONS': ['lat']})
+        lon = root.create_dataset('lon', data = np.asarray(self.longitudes, dtype = np.float32), compressor = None)
+        lon.attrs.update({'standard_name': 'longitude', 'long_name': 'longitude', 'units': 'degrees_east', '_ARRAY_DIMENSIONS': ['lon']})
+
+        if nrOfTimeSteps != None and startTime != None:
+            first = nc.date2num(datetime.datetime(startTime.year,startTime.month,startTime.day),time_units,time_calendar)
+            date_time = root.create_dataset('time', data = (first + np.arange(nrOfTimeSteps)).astype(self.time_type),\
+                                            chunks = (nrOfTimeSteps,), compressor = None)
+            root.attrs['time_steps_written'] = 0
+        else:
+            date_time = root.create_dataset('time', shape = (0,), chunks = (365,), dtype = np.float64, compressor = None)
+        date_time.attrs.update({'standard_name': 'time', 'long_name': time_units, 'units': time_units,\
+                                'calendar': time_calendar, '_ARRAY_DIMENSIONS': ['time']})
+
+        self.createVariable(root, varName, varUnits, longName)
+        storecache[ncFileName] = root
+
+    def openNetCDF(self, ncFileName, varName, varUnits = None, startTime = None, nrOfTimeSteps = None):
+
+        # (resume/append) check an existing zarr store, instead of creating it (see OutputNetcdf.openNetCDF)
+        # - returns the number of written time steps
+        root = zarr.open_group(ncFileName, mode = 'r')
+        msg = None
+        if varName not in root.array_keys():
+            msg = "The variable "+str(varName)+" is not available in the existing store "+str(ncFileName)
+        elif varUnits != None and root[varName].attrs.get('units', None) != varUnits:
+            msg = "The variable "+str(varName)+" in the existing store "+str(ncFileName)+" has the units "+str(root[varName].attrs.get('units', None))
+        elif root['lat'].shape[0] != len(self.latitudes) or root['lon'].shape[0] != len(self.longitudes) or\
+             not np.allclose(root['lat'][:], self.latitudes, atol = 1e-4) or\
+             not np.allclose(root['lon'][:], self.longitudes, atol = 1e-4):
+            msg = "The grid of the existing store "+str(ncFileName)+" does not match the output grid."
+        elif nrOfTimeSteps != None and 'time_steps_written' in root.attrs.keys() and root['time'].shape[0] < nrOfTimeSteps:
+            msg = "The preallocated time axis of the existing store "+str(ncFileName)+" has only "+str(root['time'].shape[0])+" time steps"
+        if msg != None:
+            logger.error(msg)
+            raise ValueError(msg)
+
+        nrOfWritten = root['time'].shape[0]
+        if 'time_steps_written' in root.attrs.keys(): nrOfWritten = int(root.attrs['time_steps_written'])
+        if nrOfWritten == 0: return 0
+
+        time_stamps = nc.num2date(root['time'][:nrOfWritten], time_units, time_calendar)
+        first = datetime.date(time_stamps[0].year, time_stamps[0].month, time_stamps[0].day)
+        last  = datetime.date(time_stamps[-1].year, time_stamps[-1].month, time_stamps[-1].day)
+        if (startTime != None and first != startTime) or (last - first).days != nrOfWritten - 1:
+            msg = "The time steps of the existing store "+str(ncFileName)+" ("+str(first)+" until "+str(last)+\
+                  ") do not continue a daily run from "+str(startTime)
+            logger.error(msg)
+            raise ValueError(msg)
+
+        logger.info('Existing store '+str(ncFileName)+': '+str(nrOfWritten)+' time steps written ('+str(first)+' until '+str(last)+').')
+        return nrOfWritten
+
+    def getNextTimeIndex(self, ncFileName, timeStamp = None):
+
+        # the index of the next time step to be written (with a preallocated time axis: the position of the time stamp)
+        preallocated = self.getPreallocatedTime(ncFileName)
+        if preallocated == None: return self.getRootGroup(ncFileName)['time'].shape[0]
+        if timeStamp == None: return preallocated['written']
+        posCnt = int(round(nc.date2num(timeStamp,time_units,time_calendar) - preallocated['first']))
+        if posCnt < 0 or posCnt >= self.getRootGroup(ncFileName)['time'].shape[0]:
+            msg = "The time stamp "+str(timeStamp)+" is not in the time axis of the store "+str(ncFileName)
+            logger.error(msg)
+            raise ValueError(msg)
+        return posCnt
+
+    def getPreallocatedTime(self, ncFileName):
+
+        # for a store with a preallocated time axis: its first time value, the number of leading written time steps
+        # and the time steps written after them (pending); otherwise None
+        if ncFileName not in self.preallocated.keys():
+            root = self.getRootGroup(ncFileName)
+            self.preallocated[ncFileName] = None
+            if 'time_steps_written' in root.attrs.keys():
+                self.preallocated[ncFileName] = {'first'  : float(root['time'][0]),\
+                                                 'written': int(root.attrs['time_steps_written']),\
+                                                 'pending': set()}
+        return self.preallocated[ncFileName]
+
+    def setTimeStepsWritten(self, ncFileName, nrOfWritten):
+
+        self.getRootGroup(ncFileName).attrs['time_steps_written'] = int(nrOfWritten)
+
+    def changeAtrribute(self, ncFileName, attributeDictionary, closeFile = False):
+
+        if self.callWriter(self.changeAtrribute, (ncFileName, attributeDictionary, closeFile)): return
+        self.getRootGroup(ncFileName).attrs.update(attributeDictionary)
+
+    def addNewVariable(self, ncFileName, varName, varUnits, longName=None, closeFile = False):
+
+        if self.callWriter(self.addNewVariable, (ncFileName, varName, varUnits, longName, closeFile)): return
+        self.createVariable(self.getRootGroup(ncFileName), varName, varUnits, longName)
+
+    def data2NetCDF(self, ncFileName, shortVarName, varField, timeStamp, posCnt = None, closeFile = False):
+
+        if self.callWriter(self.data2NetCDF, (ncFileName, shortVarName, varField, timeStamp, posCnt, closeFile)): return
+
+        # buffered writing: collect time steps and write them as one slab (see OutputNetcdf.data2Buffer)
+        if self.buffer_size > 1:
+            self.data2Buffer(ncFileName, shortVarName, varField, timeStamp, posCnt)
+        else:
+            if posCnt == None: posCnt = self.getNextTimeIndex(ncFileName, timeStamp)
+            self.slab2NetCDF(ncFileName, shortVarName, np.ma.filled(varField, vos.MV)[np.newaxis,:,:], [timeStamp], posCnt)
+        if closeFile == True: self.close(ncFileName)
+
+    def slab2NetCDF(self, ncFileName, shortVarName, varSlab, timeStamps, posStart, closeFile = False):
+
+        if self.callWriter(self.slab2NetCDF, (ncFileName, shortVarName, varSlab, list(timeStamps), posStart, closeFile)): return
+
+        # write several (contiguous) time steps at once: varSlab[i,:,:] for timeStamps[i] at the position posStart + i
+        with instrumentation.timer('OutputZarr.slab2NetCDF'):
+            root = self.getRootGroup(ncFileName)
+            t0 = posStart
+            t1 = posStart + len(timeStamps)
+
+            # - without a preallocated time axis, the time axis and the variables grow
+            nrOfTimes = root['time'].shape[0]
+            if self.getPreallocatedTime(ncFileName) == None and t1 > nrOfTimes:
+                for name in root.array_keys():
+                    if root[name].shape[0] == nrOfTimes and name not in ['lat', 'lon']:
+                        root[name].resize((t1,) + root[name].shape[1:])
+
+            write_values(root[shortVarName], varSlab, t0)
+            if self.getPreallocatedTime(ncFileName) == None:
+                root['time'][t0:t1] = nc.date2num(list(timeStamps),time_units,time_calendar)
+            self.setTimeIndexWritten(ncFileName, t1, t0)
+        if closeFile == True: self.close(ncFileName)
+
+    def slabWritten(self, ncFileName, timeStamps, posStart):
+
+        # register time steps that are written by another process (see write_slab), e.g. a worker of ParallelCalcFramework
+        if self.callWriter(self.slabWritten, (ncFileName, list(timeStamps), posStart)): return
+        self.setTimeIndexWritten(ncFileName, posStart + len(timeStamps), posStart)
+
+    def dataList2NetCDF(self, ncFileName, shortVarNameList, varFieldList, timeStamp, posCnt = None, closeFile = False):
+
+        if self.callWriter(self.dataList2NetCDF, (ncFileName, shortVarNameList, varFieldList, timeStamp, posCnt, closeFile)): return
+
+        if posCnt == None: posCnt = self.getNextTimeIndex(ncFileName, timeStamp)
+        for shortVarName in shortVarNameList:
+            self.slab2NetCDF(ncFileName, shortVarName, np.ma.filled(varFieldList[shortVarName], vos.MV)[np.newaxis,:,:], [timeStamp], posCnt)
+        if closeFile == True: self.close(ncFileName)
+
+    def close(self, ncFileName):
+
+        # write-behind: wait until everything is written, then stop the writer thread (also if it failed, see OutputNetcdf.close)
+        if self.write_behind > 0 and not getattr(self.local, 'inside', False):
+            try:
+                self.callWriter(self.close, (ncFileName,), wait = True)
+            finally:
+                self.stopWriter(ncFileName)
+                storecache.pop(ncFileName, None)
+            return
+
+        # write the remaining buffered time steps (a directory store does not need to be closed)
+        self.flush(ncFileName)
+        storecache.pop(ncFileName, None)
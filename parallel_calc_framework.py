@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# EHS: Parallel (multi-process) version of the CalcFramework run.
+#      The time steps are split into shards (blocks of contiguous days) that are calculated
+#      by a pool of worker processes. Every worker has its own CalcFramework object
+#      (and therefore its own temporary directory and reprojection state).
+#      The main process is the only writer: it writes the shards, in their order, as slabs
+#      to the netcdf file, so that the result is identical to the serial run.
+#      Zarr stores (see the module outputZarr) are written by the workers themselves, if every shard
+#      consists of whole time chunks; the main process then only keeps track of the written time steps.
+
+import os
+import copy
+import shutil
+import datetime
+import collections
+import multiprocessing
+
+import numpy as np
+
+from dynamic_calc_framework import CalcFramework
+import virtualOS as vos
+
+import logging
+logger = logging.getLogger(__name__)
+
+# the CalcFramework object of a worker process
+worker_model = None
+
+def initialize_worker(calc_arguments, workers_tmpDir):
+
+    global worker_model
+
+    # every worker has its own temporary directory (in workers_tmpDir, which is removed at the end of the run)
+    calc_arguments = copy.deepcopy(calc_arguments)
+    calc_arguments['tmpDir'] = workers_tmpDir+"worker_"+str(os.getpid())+"/"
+    calc_arguments['create_netcdf'] = False
+    worker_model = CalcFramework(**calc_arguments)
+
+def calculate_shard(shard):
+
+    # calculate the output values of the time steps first_time_step until last_time_step (included)
+    # - returns a slab (time, lat, lon) for every output variable, except for the variables of direct_outputs
+    #   (variable name: zarr store), which are written to their stores by this worker
+    first_time_step, last_time_step, direct_outputs = shard
+    slabs = {}
+    for time_step in range(first_time_step, last_time_step + 1):
+        map_values = worker_model.calculate(time_step)
+        for variable_name in map_values.keys():
+            if variable_name not in slabs.keys():
+                slabs[variable_name] = np.empty((last_time_step - first_time_step + 1,) + map_values[variable_name].shape, dtype = np.float32)
+            slabs[variable_name][time_step - first_time_step,:,:] = np.ma.filled(map_values[variable_name], vos.MV)
+    if len(direct_outputs) > 0: import outputZarr   # only for zarr output
+    for variable_name in direct_outputs.keys():
+        outputZarr.write_slab(direct_outputs[variable_name], variable_name, slabs[variable_name], first_time_step - 1)
+        slabs[variable_name] = None
+    return first_time_step, last_time_step, slabs
+
+class ParallelCalcFramework(object):
+
+    def __init__(self, calc_arguments, nrOfWorkers = None, shard_size = 100):
+        object.__init__(self)
+
+        # calc_arguments: a dictionary with the (keyword) arguments of CalcFramework
+        self.calc_arguments = calc_arguments
+        self.modelTime = calc_arguments['modelTime']
+
+        # number of worker processes (by default, all cores) and number of time steps per shard
+        self.nrOfWorkers = nrOfWorkers
+        if self.nrOfWorkers == None: self.nrOfWorkers = multiprocessing.cpu_count()
+        self.shard_size = shard_size
+
+    def get_shards(self, first_time_step = 1):
+
+        # the time steps first_time_step ... nrOfTimeSteps split into shards of (at most) shard_size time steps
+        nrOfTimeSteps = self.modelTime.nrOfTimeSteps
+        return [(first, min(first + self.shard_size - 1, nrOfTimeSteps)) \
+                for first in range(first_time_step, nrOfTimeSteps + 1, self.shard_size)]
+
+    def get_time_stamp(self, time_step):
+
+        date = self.modelTime.startTime + datetime.timedelta(days=1 * (time_step - 1))
+        return datetime.datetime(date.year, date.month, date.day, 0)
+
+    def run(self):
+
+        # the temporary directories of the workers of this run (in the temporary directory of CalcFramework)
+        tmpDir = self.calc_arguments.get('tmpDir', None)
+        if tmpDir == None:
+            output = self.calc_arguments['output']
+            if not isinstance(output, dict): output = output[0]
+            tmpDir = output['folder']+"/tmp/"
+        workers_tmpDir = tmpDir+"/workers_"+str(os.getpid())+"/"
+
+        # the worker processes are started (forked) before the model in the main process is made, 
+        # so that they do not inherit its open netcdf files and the writer threads of its netcdf reports
+        # (the workers use unmodified arguments)
+        worker_arguments = copy.deepcopy(self.calc_arguments)
+        pool = multiprocessing.Pool(self.nrOfWorkers, initialize_worker, (worker_arguments, workers_tmpDir))
+        try:
+            # the model in the main process creates the netcdf file and writes it
+            model = CalcFramework(**self.calc_arguments)
+
+            # zarr stores that are written by the workers: every shard must start at a time chunk
+            direct_outputs = {}
+            for output in model.outputs:
+                if output.get('format', None) != "zarr": continue
+                chunk_length = model.netcdf_reports[output['variable_name']].getTimeChunkLength(output['file_name'], output['variable_name'])
+                if self.shard_size % chunk_length == 0 and (model.first_time_step - 1) % chunk_length == 0:
+                    direct_outputs[output['variable_name']] = output['file_name']
+                else:
+                    logger.info('The zarr store '+str(output['file_name'])+' is written by the main process (shard size: '+\
+                                str(self.shard_size)+' ; time steps per chunk: '+str(chunk_length)+').')
+
+            # submit the shards; at most two shards per worker are pending, so that the memory use is bounded
+            # (with resume, the time steps that are already written are skipped)
+            shards  = collections.deque(self.get_shards(model.first_time_step))
+            pending = collections.deque()
+            while len(shards) > 0 or len(pending) > 0:
+                while len(shards) > 0 and len(pending) < 2 * self.nrOfWorkers:
+                    pending.append(pool.apply_async(calculate_shard, (shards.popleft() + (direct_outputs,),)))
+
+                # write the oldest shard (the shards are written in their order)
+                first_time_step, last_time_step, slabs = pending.popleft().get()
+                time_stamps = [self.get_time_stamp(time_step) for time_step in range(first_time_step, last_time_step + 1)]
+                for output in model.outputs:
+                    netcdf_report = model.netcdf_reports[output['variable_name']]
+                    if output['variable_name'] in direct_outputs.keys():
+                        netcdf_report.slabWritten(output['file_name'], time_stamps, first_time_step - 1)
+                        continue
+                    netcdf_report.slab2NetCDF(output['file_name'],\
+                                              output['variable_name'],\
+                                              slabs[output['variable_name']], time_stamps, first_time_step - 1)
+                logger.info('Written: '+str(time_stamps[0].date())+' until '+str(time_stamps[-1].date()))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(workers_tmpDir, ignore_errors = True)
+
+        for output in model.outputs:
+            model.netcdf_reports[output['variable_name']].close(output['file_name'])
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Native reader (and a simple writer) for PCRaster (CSF version 2) map files, without using pcraster or mapattr.
+#      See the CSF format description in the PCRaster (libcsf) source: csf.h and csftypes.h
+
+import os
+import struct
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# signature of a CSF file (the first 27 bytes)
+CSF_SIGNATURE = b"RUU CROSS SYSTEM MAP FORMAT"
+
+# header sizes/offsets (in bytes)
+MAIN_HEADER_OFFSET   = 0
+RASTER_HEADER_OFFSET = 64
+DATA_OFFSET          = 256
+
+# cell representations and their numpy types
+cell_representation_dtype = {0x00: 'u1',  # CR_UINT1
+                             0x04: 'i1',  # CR_INT1
+                             0x11: 'u2',  # CR_UINT2
+                             0x15: 'i2',  # CR_INT2
+                             0x22: 'u4',  # CR_UINT4
+                             0x26: 'i4',  # CR_INT4
+                             0x5A: 'f4',  # CR_REAL4
+                             0xDB: 'f8'}  # CR_REAL8
+
+# value scales
+value_scale_name = {0xE0: 'boolean',
+                    0xE2: 'nominal',
+                    0xF2: 'ordinal',
+                    0xEB: 'scalar',
+                    0xFB: 'directional',
+                    0xF0: 'ldd',
+                    0xF8: 'ldd'}
+
+def _byte_order(header):
+    # the main header stores the value 1 (uint32) written in the byte order of the file
+    if struct.unpack('<I', header[46:50])[0] == 1: return '<'
+    if struct.unpack('>I', header[46:50])[0] == 1: return '>'
+    raise ValueError("Unknown byte order in the CSF header.")
+
+def read_header(fileName):
+    # read the main and raster headers of a CSF file and return them in a dictionary
+    f = open(fileName, 'rb')
+    try:
+        header = f.read(DATA_OFFSET)
+    finally:
+        f.close()
+
+    if len(header) < DATA_OFFSET or not header.startswith(CSF_SIGNATURE):
+        raise ValueError("The file "+str(fileName)+" is not a PCRaster (CSF) map.")
+
+    bo = _byte_order(header)
+
+    # main header
+    version, gis_file_id, projection, attr_table, data_type = struct.unpack(bo+'HIHIH', header[32:46])
+
+    # raster header
+    value_scale, cell_representation = struct.unpack(bo+'HH', header[64:68])
+    x_ul, y_ul, nr_rows, nr_cols, cell_size_x, cell_size_y, angle = struct.unpack(bo+'ddIIddd', header[84:132])
+
+    if cell_representation not in cell_representation_dtype.keys():
+        raise ValueError("Unknown cell representation "+hex(cell_representation)+" in the file "+str(fileName))
+
+    return {'version'            : version,
+            'projection'         : projection,
+            'byte_order'         : bo,
+            'value_scale'        : value_scale_name.get(value_scale, value_scale),
+            'cell_representation': cell_representation,
+            'dtype'              : np.dtype(bo + cell_representation_dtype[cell_representation]),
+            'xUL'                : x_ul,
+            'yUL'                : y_ul,
+            'rows'               : nr_rows,
+            'cols'               : nr_cols,
+            'cellsize'           : cell_size_x,
+            'cellsize_y'         : cell_size_y,
+            'angle'              : angle,
+            'data_offset'        : DATA_OFFSET}
+
+# missing values of the integer cell representations (for REAL4 and REAL8, missing values are NaN bit patterns)
+cell_representation_missing_value = {0x00: 255,
+                                     0x04: -128,
+                                     0x11: 65535,
+                                     0x15: -32768,
+                                     0x22: 4294967295,
+                                     0x26: -2147483648}
+
+def generate_name_t(name, time):
+    # the same file name convention as pcraster.framework.frameworkBase.generateNameT
+    # (e.g. "pr000000.001" for the name "pr" and the time step 1)
+    head, tail = os.path.split(name)
+    if "." in tail: raise ValueError("The file name "+str(tail)+" must not contain a dot.")
+    nr = "%d" % (time)
+    space = 11 - (len(tail) + len(nr))
+    if time < 0 or space < 0: raise ValueError("Cannot make a file name for "+str(name)+" and the time step "+str(time))
+    result = tail + space * "0" + nr
+    return os.path.join(head, result[:8] + "." + result[8:])
+
+def count_maps(name, first_time_step = 1):
+    # the number of time series maps name (e.g. "pr" for "pr000000.001") that exist without a gap from first_time_step
+    time_step = first_time_step
+    while os.path.exists(generate_name_t(name, time_step)): time_step += 1
+    return time_step - first_time_step
+
+def read_map(fileName, missing_value = None, header = None):
+    # EHS: read a pcraster map as a numpy array that is memory-mapped to the raster body of the file
+    # - missing_value = None: a masked array (no copy of the data, cells with CSF missing values are masked)
+    # - otherwise           : an array in which the CSF missing values are replaced by missing_value
+    if header == None: header = read_header(fileName)
+    values = np.memmap(fileName, dtype = header['dtype'], mode = 'r',\
+                       offset = header['data_offset'], shape = (header['rows'], header['cols']))
+    if header['dtype'].kind == 'f':
+        mask = np.isnan(values)
+    else:
+        mask = values == cell_representation_missing_value.get(header['cell_representation'])
+    if missing_value == None:
+        return np.ma.masked_array(values, mask = mask)
+    if header['dtype'].kind == 'f':
+        return np.where(mask, header['dtype'].type(missing_value), values)
+    return np.where(mask, missing_value, values)
+
+def iter_maps(name, first_time_step, last_time_step, missing_value = None):
+    # iterate over the time series maps name (e.g. "pr" for "pr000000.001"), from first_time_step until last_time_step (included)
+    # - yields (time step, values) with values as given by read_map
+    # - all maps in a series have the same header, so the header is only read once
+    header = None
+    for time_step in range(first_time_step, last_time_step + 1):
+        fileName = generate_name_t(name, time_step)
+        if header == None: header = read_header(fileName)
+        yield time_step, read_map(fileName, missing_value, header)
+
+def write_map(fileName, values, xUL, yUL, cellsize):
+    # write a (masked) numpy array as a scalar (REAL4) pcraster map, e.g. for synthetic test data;
+    # masked and nan values are missing values
+    values = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(values, dtype = np.float32)), np.nan).astype('<f4')
+    valid = values[np.isfinite(values)]
+
+    header = bytearray(DATA_OFFSET)
+    header[0:len(CSF_SIGNATURE)] = CSF_SIGNATURE
+    # main header: version 2, projection 1 (y decreases from top to bottom), data type 1 (raster), byte order
+    struct.pack_into('<HIHIHI', header, 32, 2, 0, 1, 0, 1, 1)
+    # raster header: value scale, cell representation, minimum and maximum values, location and cell size
+    struct.pack_into('<HH', header, RASTER_HEADER_OFFSET, 0xEB, 0x5A)
+    minimum = maximum = np.float32(np.nan)
+    if valid.size > 0: minimum, maximum = valid.min(), valid.max()
+    struct.pack_into('<f', header, 68, minimum)
+    struct.pack_into('<f', header, 76, maximum)
+    struct.pack_into('<ddIIddd', header, 84, xUL, yUL, values.shape[0], values.shape[1], cellsize, cellsize, 0.0)
+
+    f = open(fileName, 'wb')
+    try:
+        f.write(bytes(header))
+        f.write(values.tobytes())
+    finally:
+        f.close()
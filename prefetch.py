@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Read-ahead of the (daily) inputs of CalcFramework and ResampleFramework.
+#      While the time step t is calculated and written, a background thread reads the
+#      inputs of the time steps t+1 ... t+depth. The queue holds at most depth time steps,
+#      so the memory use is bounded. An error in the background thread is raised again
+#      in the main loop, when the inputs of the failed time step are requested.
+
+import sys
+import threading
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Prefetcher(object):
+
+    def __init__(self, read_function, last_time_step, depth = 2):
+        object.__init__(self)
+
+        # read_function(time_step): returns the inputs of a (pcraster) time step
+        self.read_function  = read_function
+        self.last_time_step = last_time_step
+        self.depth          = max(1, int(depth))
+
+        # the background thread is started at the first request (see get)
+        self.thread = None
+        self.next_time_step = None
+
+    def start(self, first_time_step):
+
+        # start reading ahead from first_time_step
+        logger.debug('Start reading ahead from the time step '+str(first_time_step)+' (depth: '+str(self.depth)+')')
+        self.next_time_step = first_time_step
+        self.queue      = queue.Queue(maxsize = self.depth)
+        self.stop_event = threading.Event()
+        self.thread     = threading.Thread(target = self.read_ahead, args = (first_time_step, self.queue, self.stop_event))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_ahead(self, first_time_step, read_queue, stop_event):
+
+        # (background thread) read the time steps first_time_step ... last_time_step in their order
+        for time_step in range(first_time_step, self.last_time_step + 1):
+            if stop_event.is_set(): return
+            try:
+                item = (time_step, self.read_function(time_step), None)
+            except:
+                logger.error('Reading the inputs of the time step '+str(time_step)+' failed:\n'+traceback.format_exc())
+                item = (time_step, None, sys.exc_info()[1])
+
+            # wait for space in the queue (but stop if requested)
+            while not stop_event.is_set():
+                try:
+                    read_queue.put(item, timeout = 0.1)
+                    break
+                except queue.Full:
+                    pass
+
+            # stop after an error
+            if item[2] is not None: return
+
+    def get(self, time_step):
+
+        # the inputs of time_step (if another time step was expected, reading ahead is restarted from time_step)
+        if self.thread == None or time_step != self.next_time_step:
+            self.stop()
+            self.start(time_step)
+        read_time_step, values, error = self.queue.get()
+        self.next_time_step = time_step + 1
+        if error is not None:
+            self.stop()
+            raise error
+        return values
+
+    def stop(self):
+
+        # stop the background thread (e.g. at the end of the run)
+        if self.thread == None: return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
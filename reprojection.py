@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: In-process replacement for the gdalwarp based resampling in virtualOS.gdalwarpPCR.
+#      For every cell of the clone (target) map, the index of the source cell is
+#      calculated only once (per source grid, clone map and method). Afterwards,
+#      every (daily) map is reprojected by a single numpy gather (take).
+
+import math
+
+import numpy as np
+
+import instrumentation
+
+import logging
+logger = logging.getLogger(__name__)
+
+# pyproj is only needed for projections other than EPSG:4326 and EPSG:3035
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+# resampling methods that are supported by this module (other methods must use gdalwarp)
+supported_methods = ["near", "default"]
+
+# cache of nearest neighbour indexes, one for every (source grid, clone map, projections, method)
+regridder_cache = dict()
+
+# GRS80 ellipsoid (used by EPSG:3035)
+GRS80_a = 6378137.0
+GRS80_f = 1.0 / 298.257222101
+
+# parameters of EPSG:3035 (ETRS89 / LAEA Europe)
+LAEA_lat_0 = 52.0
+LAEA_lon_0 = 10.0
+LAEA_x_0   = 4321000.0
+LAEA_y_0   = 3210000.0
+
+def _laea_q(sin_phi, e):
+    # authalic latitude function q (Snyder, 1987, eq. 3-12)
+    return (1.0 - e**2) * (sin_phi / (1.0 - e**2 * sin_phi**2) - \
+           (1.0 / (2.0 * e)) * np.log((1.0 - e * sin_phi) / (1.0 + e * sin_phi)))
+
+def lonlat2laea(lon, lat):
+    # EHS: forward Lambert Azimuthal Equal Area (ellipsoidal, EPSG method 9820)
+    #      from EPSG:4326 (longitude, latitude) to EPSG:3035 (easting, northing)
+    e = math.sqrt(2.0 * GRS80_f - GRS80_f**2)
+
+    phi   = np.radians(np.asarray(lat, dtype = np.float64))
+    lam   = np.radians(np.asarray(lon, dtype = np.float64))
+    phi_0 = math.radians(LAEA_lat_0)
+    lam_0 = math.radians(LAEA_lon_0)
+
+    q_p    = _laea_q(1.0, e)
+    q_0    = _laea_q(math.sin(phi_0), e)
+    q      = _laea_q(np.sin(phi), e)
+    beta_0 = math.asin(q_0 / q_p)
+    beta   = np.arcsin(np.clip(q / q_p, -1.0, 1.0))
+    R_q    = GRS80_a * math.sqrt(q_p / 2.0)
+    D      = GRS80_a * (math.cos(phi_0) / math.sqrt(1.0 - e**2 * math.sin(phi_0)**2)) / (R_q * math.cos(beta_0))
+
+    B = R_q * np.sqrt(2.0 / (1.0 + math.sin(beta_0) * np.sin(beta) + \
+                             math.cos(beta_0) * np.cos(beta) * np.cos(lam - lam_0)))
+
+    x = LAEA_x_0 + B * D * np.cos(beta) * np.sin(lam - lam_0)
+    y = LAEA_y_0 + (B / D) * (math.cos(beta_0) * np.sin(beta) - \
+                              math.sin(beta_0) * np.cos(beta) * np.cos(lam - lam_0))
+    return x, y
+
+def is_supported(inputEPSG, outputEPSG, method):
+    # check whether a reprojection can be done by this module
+    if method not in supported_methods: return False
+    if outputEPSG == None or inputEPSG == outputEPSG: return True
+    if inputEPSG == "EPSG:3035" and outputEPSG == "EPSG:4326": return True
+    return pyproj != None
+
+def transform_coordinates(x, y, fromEPSG, toEPSG):
+    # transform coordinates (x, y) from the projection fromEPSG to the projection toEPSG
+    if toEPSG == None or fromEPSG == None or fromEPSG == toEPSG: return x, y
+    if fromEPSG == "EPSG:4326" and toEPSG == "EPSG:3035": return lonlat2laea(x, y)
+    if pyproj == None:
+        msg = "The transformation from "+str(fromEPSG)+" to "+str(toEPSG)+" needs the python module pyproj."
+        logger.error(msg)
+        raise ImportError(msg)
+    transformer = pyproj.Transformer.from_crs(fromEPSG, toEPSG, always_xy = True)
+    return transformer.transform(x, y)
+
+class NearestNeighbourRegridder(object):
+
+    def __init__(self, source_attributes, target_attributes, inputEPSG = None, outputEPSG = None):
+        object.__init__(self)
+
+        # attributes of the source and target grids (from virtualOS.getMapAttributesALL)
+        self.source_rows = int(source_attributes['rows'])
+        self.source_cols = int(source_attributes['cols'])
+        self.target_rows = int(target_attributes['rows'])
+        self.target_cols = int(target_attributes['cols'])
+
+        # cell centre coordinates of the target (clone) grid, in the way gdalwarp -te -tr defines them
+        target_x = target_attributes['xUL'] + (np.arange(self.target_cols) + 0.5) * target_attributes['cellsize']
+        target_y = target_attributes['yUL'] - (np.arange(self.target_rows) + 0.5) * target_attributes['cellsize']
+        target_x, target_y = np.meshgrid(target_x, target_y)
+
+        # the same coordinates expressed in the source projection
+        source_x, source_y = transform_coordinates(target_x, target_y, outputEPSG, inputEPSG)
+
+        # source cells containing the target cell centres
+        col = np.floor((np.asarray(source_x) - source_attributes['xUL']) / source_attributes['cellsize'])
+        row = np.floor((source_attributes['yUL'] - np.asarray(source_y)) / source_attributes['cellsize'])
+        inside = (col >= 0) & (col < self.source_cols) & \
+                 (row >= 0) & (row < self.source_rows)
+
+        # target cells outside the source grid point to an extra (missing value) cell behind the last source cell
+        nr_of_source_cells = self.source_rows * self.source_cols
+        self.index = np.where(inside, row * self.source_cols + col, nr_of_source_cells).astype(np.intp)
+
+        logger.debug('Nearest neighbour index: '+str(int(np.sum(inside)))+' of '+str(inside.size)+' target cells are covered by the source grid.')
+
+    def regrid(self, source_values, missing_value):
+        # source values padded with one missing value cell, then gathered to the target grid
+        source_values = np.asarray(source_values)
+        padded = np.empty(source_values.size + 1, dtype = source_values.dtype)
+        padded[:-1] = source_values.ravel()
+        padded[-1]  = missing_value
+        return padded.take(self.index)
+
+def getRegridder(source_attributes, target_attributes, cloneMapFileName, inputEPSG = None, outputEPSG = None, method = "near"):
+    # return a (cached) regridder for the given source grid, clone map and method
+    key = (tuple(sorted(source_attributes.items())), str(cloneMapFileName),\
+           tuple(sorted(target_attributes.items())), inputEPSG, outputEPSG, method)
+    if key in regridder_cache.keys(): instrumentation.count('cache.regridder', 'hits')
+    if key not in regridder_cache.keys():
+        instrumentation.count('cache.regridder', 'misses')
+        logger.debug('Calculate the nearest neighbour index for the clone map: '+str(cloneMapFileName))
+        regridder_cache[key] = NearestNeighbourRegridder(source_attributes, target_attributes, inputEPSG, outputEPSG)
+    return regridder_cache[key]
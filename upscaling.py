@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Area weighted upscaling (e.g. from 2.5 to 5 or 30 arc minutes) with a precomputed operator.
+#      The zones (fine cell -> coarse cell) and the cell areas do not change during a run, so they are
+#      prepared only once. Every (daily) map is then upscaled by a sparse matrix-vector product
+#      (np.bincount over the zone indexes), renormalized with the area of the cells that have values.
+#      This replaces the two pcr.areatotal calls and the regridToCoarse(..., "max") per time step.
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+class AreaWeightedUpscaler(object):
+
+    def __init__(self, cell_area, factor, output_rows = None, output_cols = None):
+        object.__init__(self)
+
+        # cell_area: the cell areas at the fine (input) resolution, as a numpy array (nan or masked: no area)
+        # factor   : the (integer) ratio between the output and input cell sizes
+        cell_area = np.ma.filled(np.ma.masked_invalid(np.ma.asarray(cell_area, dtype = np.float64)), 0.0)
+        self.factor = int(round(factor))
+        self.input_rows, self.input_cols = cell_area.shape
+
+        # by default, incomplete blocks at the edges are ignored;
+        # with more output rows/cols, these blocks are upscaled with their available cells
+        self.output_rows = output_rows
+        if self.output_rows == None: self.output_rows = self.input_rows // self.factor
+        self.output_cols = output_cols
+        if self.output_cols == None: self.output_cols = self.input_cols // self.factor
+        self.nrOfZones = self.output_rows * self.output_cols
+
+        # fine cells that contribute to the output, their zones (index of the coarse cell) and areas
+        rows = np.arange(self.input_rows) // self.factor
+        cols = np.arange(self.input_cols) // self.factor
+        zones = rows[:,np.newaxis] * self.output_cols + cols[np.newaxis,:]
+        inside = (rows[:,np.newaxis] < self.output_rows) & (cols[np.newaxis,:] < self.output_cols) & (cell_area > 0.0)
+        self.cells = np.flatnonzero(inside)
+        self.zones = zones.ravel()[self.cells]
+        self.area  = cell_area.ravel()[self.cells]
+
+        logger.debug('Area weighted upscaling: '+str(self.cells.size)+' input cells to '+str(self.nrOfZones)+' output cells.')
+
+    def upscaled_area(self):
+        # the area of every output cell (the total area of its input cells)
+        return np.bincount(self.zones, self.area, minlength = self.nrOfZones).reshape(self.output_rows, self.output_cols)
+
+    def upscale(self, values, area = None, return_area = False):
+        # values: a (masked) numpy array (..., input_rows, input_cols), e.g. a map or a (time, lat, lon) cube;
+        #         nan values and masked cells are missing values
+        # area  : (optional) the cell areas per map, with the same shape as values, instead of the fixed cell areas
+        #         (e.g. the areas with values of an upscaled level, see return_area)
+        # - returns a masked array (..., output_rows, output_cols); output cells without any input value are masked
+        # - with return_area, also the area of the input cells with values, per output cell
+        data = np.ma.getdata(values)
+        leading_shape = data.shape[:-2]
+        nrOfMaps = int(np.prod(leading_shape))
+
+        data = data.reshape(nrOfMaps, self.input_rows * self.input_cols)[:,self.cells]
+        mask = np.ma.getmaskarray(values).reshape(nrOfMaps, self.input_rows * self.input_cols)[:,self.cells]
+        mask = mask | ~np.isfinite(data)
+
+        # the zones of all maps (every map has its own range of zones)
+        zones = self.zones
+        if nrOfMaps > 1: zones = (self.zones[np.newaxis,:] + self.nrOfZones * np.arange(nrOfMaps)[:,np.newaxis]).ravel()
+
+        if area is None:
+            weights = np.where(mask, 0.0, self.area[np.newaxis,:])
+        else:
+            area    = np.ma.filled(np.ma.asarray(area, dtype = np.float64), 0.0).reshape(nrOfMaps, self.input_rows * self.input_cols)[:,self.cells]
+            weights = np.where(mask, 0.0, area)
+        total_area = np.bincount(zones, weights.ravel(), minlength = nrOfMaps * self.nrOfZones)
+        total      = np.bincount(zones, (weights * np.where(mask, 0.0, data)).ravel(), minlength = nrOfMaps * self.nrOfZones)
+
+        upscaled = np.ma.masked_array(total / np.where(total_area > 0.0, total_area, 1.0), mask = total_area <= 0.0)
+        upscaled = upscaled.reshape(leading_shape + (self.output_rows, self.output_cols))
+        if return_area: return upscaled, total_area.reshape(leading_shape + (self.output_rows, self.output_cols))
+        return upscaled
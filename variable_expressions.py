@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# EHS: Expressions for derived variables and unit conversions (e.g. 'pr * 0.001' or '(tn + max(tn, tx)) / 2.'),
+#      see efas_variable_list.expression. Every expression is compiled only once; it is then evaluated
+#      (vectorized) on the (masked) numpy arrays of its input variables, without any extra reading.
+
+import ast
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# functions that can be used in expressions (cell-by-cell, missing values are propagated)
+functions = {'max' : np.ma.maximum,
+             'min' : np.ma.minimum,
+             'abs' : np.ma.absolute,
+             'sqrt': np.ma.sqrt,
+             'exp' : np.ma.exp,
+             'log' : np.ma.log}
+
+# syntax elements that are allowed in expressions
+allowed_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Num,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+if hasattr(ast, 'Constant'): allowed_nodes = allowed_nodes + (ast.Constant,)
+
+# cache of compiled expressions
+expression_cache = dict()
+
+class CompiledExpression(object):
+
+    def __init__(self, expression):
+        object.__init__(self)
+
+        self.expression = expression
+        tree = ast.parse(expression, mode = 'eval')
+
+        # check the expression and find its input variables (all names that are not functions)
+        self.inputs = []
+        for node in ast.walk(tree):
+            if not isinstance(node, allowed_nodes):
+                msg = "Not allowed in the expression '"+str(expression)+"': "+type(node).__name__
+                logger.error(msg)
+                raise ValueError(msg)
+            if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.func.id not in functions.keys()):
+                msg = "Unknown function in the expression '"+str(expression)+"'"
+                logger.error(msg)
+                raise ValueError(msg)
+            if isinstance(node, ast.Name) and node.id not in functions.keys() and node.id not in self.inputs:
+                self.inputs.append(node.id)
+
+        self.code = compile(tree, '<expression: '+str(expression)+'>', 'eval')
+
+    def evaluate(self, inputs):
+        # inputs: a dictionary with (masked) numpy arrays for (at least) all input variables of the expression
+        namespace = dict(functions)
+        for name in self.inputs: namespace[name] = inputs[name]
+        return eval(self.code, {'__builtins__': {}}, namespace)
+
+def getCompiledExpression(expression):
+    # return a (cached) compiled expression
+    if expression not in expression_cache.keys():
+        expression_cache[expression] = CompiledExpression(expression)
+    return expression_cache[expression]
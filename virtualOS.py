@@ -14,12 +14,23 @@ import re
 import math
 import sys
 import types
+import threading
 
 import netCDF4 as nc
 import numpy as np
 import numpy.ma as ma
 import pcraster as pcr
 
+import reprojection
+import pcraster_csf
+import instrumentation
+
+# the gdal python bindings are only needed for the in-memory warping (see gdalwarpInMemory)
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -30,6 +41,19 @@ smallNumber = 1E-39
 # file cache to minimize/reduce opening/closing files.  
 filecache = dict()
 
+# cache of map headers (attributes), per file name: (modification time, header)
+mapattr_cache = dict()
+
+# cache of decoded netcdf time axes, per file name (see NetcdfTimeIndex)
+timeindex_cache = dict()
+
+# cache of read windows, per (netcdf file, variable, clone map) (see getNetcdfReadWindow)
+cropwindow_cache = dict()
+
+# the netcdf (and hdf5) libraries are not thread safe: netcdf calls from different threads 
+# (e.g. a prefetch.Prefetcher and the main loop) must hold this lock
+netcdf_lock = threading.RLock()
+
 def initialize_logging(log_file_location, log_file_front_name = "log", debug_mode = True):
     """
     Initialize logging. Prints to both the console and a log file, at configurable levels
@@ -90,6 +114,7 @@ def initialize_logging(log_file_location, log_file_front_name = "log", debug_mod
     logger.info('Logging output to %s', log_filename)
     logger.info('Debugging output to %s', dbg_filename)
 
+@instrumentation.timed('netcdf2PCRobjCloneWithoutTime')
 def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
                                   cloneMapFileName  = None,\
                                   LatitudeLongitude = True,\
@@ -122,45 +147,12 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
         except:
             pass
     
-    sameClone = True
-    # check whether clone and input maps have the same attributes:
-    if cloneMapFileName != None:
-        # get the attributes of cloneMap
-        attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
-        cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
-        # check whether both maps have the same attributes 
-        if cellsizeClone != cellsizeInput: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
+    # crop to the clone map (if needed): the window is calculated from the coordinates only (and cached, as for 
+    # netcdf2PCRobjClone), so that only the window is read, e.g. a basin from a continental static map
+    rows, cols, factor, fillValue = getNetcdfReadWindow(ncFile, f, varName, cloneMapFileName)
+    cropData = f.variables[varName][rows,cols]
+    instrumentation.count('netcdf2PCRobjCloneWithoutTime', 'bytes_read', cropData.nbytes)
 
-    cropData = f.variables[varName][:,:]       # still original data
-    factor = 1                                 # needed in regridData2FinerGrid
-    if sameClone == False:
-        # crop to cloneMap:
-        minX    = min(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
-        xIdxSta = int(np.where(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        minY    = min(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
-        yIdxSta = int(np.where(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
-        cropData = f.variables[varName][yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
-        factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
-
-        if factor > 1: logger.debug('Resample: input cell size = '+str(float(cellsizeInput))+' ; output/clone cell size = '+str(float(cellsizeClone)))
-    
     # convert to PCR object and close f
     if specificFillValue != None:
         outPCR = pcr.numpy2pcr(pcr.Scalar, \
@@ -169,7 +161,7 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
     else:
         outPCR = pcr.numpy2pcr(pcr.Scalar, \
                   regridData2FinerGrid(factor,cropData,MV), \
-                  float(f.variables[varName]._FillValue))
+                  float(fillValue))
                   
     #~ # debug:
     #~ pcr.report(outPCR,"tmp.map")
@@ -181,6 +173,7 @@ def netcdf2PCRobjCloneWithoutTime(ncFile,varName,
     # PCRaster object
     return (outPCR)
 
+@instrumentation.timed('netcdf2PCRobjClone')
 def netcdf2PCRobjClone(ncFile,varName,dateInput,\
                        useDoy = None,
                        cloneMapFileName  = None,\
@@ -199,10 +192,12 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
     
     if ncFile in filecache.keys():
         f = filecache[ncFile]
+        instrumentation.count('netcdf2PCRobjClone', 'file_cache_hits')
         #~ print "Cached: ", ncFile
     else:
         f = nc.Dataset(ncFile)
         filecache[ncFile] = f
+        instrumentation.count('netcdf2PCRobjClone', 'file_cache_misses')
         #~ print "New: ", ncFile
     
     varName = str(varName)
@@ -233,14 +228,15 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
             idx = int(date.month) - 1
         else:
             nctime = f.variables['time']  # A netCDF time variable object.
+            time_index = getNetcdfTimeIndex(ncFile, nctime)  # decoded only once per file
             if useDoy == "yearly":
                 date  = datetime.datetime(date.year,int(1),int(1))
             if useDoy == "monthly":
                 date = datetime.datetime(date.year,date.month,int(1))
             if useDoy == "yearly" or useDoy == "monthly":
                 # if the desired year is not available, use the first year or the last year that is available
-                first_year_in_nc_file = findFirstYearInNCTime(nctime)
-                last_year_in_nc_file  =  findLastYearInNCTime(nctime)
+                first_year_in_nc_file = time_index.first_year
+                last_year_in_nc_file  = time_index.last_year
                 #
                 if date.year < first_year_in_nc_file:  
                     date = datetime.datetime(first_year_in_nc_file,date.month,date.day)
@@ -258,71 +254,20 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
                     msg += "The date "+str(date.year)+"-"+str(date.month)+"-"+str(date.day)+" is used."
                     msg += "\n"
                     logger.warning(msg)
-            try:
-                idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                  select='exact')
-            except:                                  
-                try:
-                    idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                      select='before')
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. The 'before' option is used while selecting netcdf time."
-                    msg += "\n"
-                except:
-                    idx = nc.date2index(date, nctime, calendar = nctime.calendar, \
-                                                      select='after')
-                    msg  = "\n"
-                    msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
-                    msg += "The date "+str(dateInput)+" is NOT available. The 'after' option is used while selecting netcdf time."
-                    msg += "\n"
+            idx, select = time_index.date2index(date, nctime)
+            if select != 'exact':
+                msg  = "\n"
+                msg += "WARNING related to the netcdf file: "+str(ncFile)+" ; variable: "+str(varName)+" !!!!!!"+"\n"
+                msg += "The date "+str(dateInput)+" is NOT available. The '"+select+"' option is used while selecting netcdf time."
+                msg += "\n"
                 logger.warning(msg)
                                                   
     idx = int(idx)                                                  
 
-    sameClone = True
-    # check whether clone and input maps have the same attributes:
-    if cloneMapFileName != None:
-        # get the attributes of cloneMap
-        attributeClone = getMapAttributesALL(cloneMapFileName)
-        cellsizeClone = attributeClone['cellsize']
-        rowsClone = attributeClone['rows']
-        colsClone = attributeClone['cols']
-        xULClone = attributeClone['xUL']
-        yULClone = attributeClone['yUL']
-        # get the attributes of input (netCDF) 
-        cellsizeInput = f.variables['lat'][0]- f.variables['lat'][1]
-        cellsizeInput = float(cellsizeInput)
-        rowsInput = len(f.variables['lat'])
-        colsInput = len(f.variables['lon'])
-        xULInput = f.variables['lon'][0]-0.5*cellsizeInput
-        yULInput = f.variables['lat'][0]+0.5*cellsizeInput
-        # check whether both maps have the same attributes 
-        if cellsizeClone != cellsizeInput: sameClone = False
-        if rowsClone != rowsInput: sameClone = False
-        if colsClone != colsInput: sameClone = False
-        if xULClone != xULInput: sameClone = False
-        if yULClone != yULInput: sameClone = False
-
-    cropData = f.variables[varName][int(idx),:,:]       # still original data
-    factor = 1                          # needed in regridData2FinerGrid
-
-    if sameClone == False:
-        
-        logger.debug('Crop to the clone map with lower left corner (x,y): '+str(xULClone)+' , '+str(yULClone))
-        # crop to cloneMap:
-        #~ xIdxSta = int(np.where(f.variables['lon'][:] == xULClone + 0.5*cellsizeInput)[0])
-        minX    = min(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput))) # ; print(minX)
-        xIdxSta = int(np.where(abs(f.variables['lon'][:] - (xULClone + 0.5*cellsizeInput)) == minX)[0])
-        xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
-        #~ yIdxSta = int(np.where(f.variables['lat'][:] == yULClone - 0.5*cellsizeInput)[0])
-        minY    = min(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput))) # ; print(minY)
-        yIdxSta = int(np.where(abs(f.variables['lat'][:] - (yULClone - 0.5*cellsizeInput)) == minY)[0])
-        yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
-        cropData = f.variables[varName][idx,yIdxSta:yIdxEnd,xIdxSta:xIdxEnd]
-
-        factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
-        if factor > 1: logger.debug('Resample: input cell size = '+str(float(cellsizeInput))+' ; output/clone cell size = '+str(float(cellsizeClone)))
+    # crop to the clone map (if needed); the window, the factor (needed in regridData2FinerGrid) and the fill value are cached
+    rows, cols, factor, fillValue = getNetcdfReadWindow(ncFile, f, varName, cloneMapFileName)
+    cropData = f.variables[varName][idx,rows,cols]
+    instrumentation.count('netcdf2PCRobjClone', 'bytes_read', cropData.nbytes)
 
     # convert to PCR object and close f
     if specificFillValue != None:
@@ -332,13 +277,178 @@ def netcdf2PCRobjClone(ncFile,varName,dateInput,\
     else:
         outPCR = pcr.numpy2pcr(pcr.Scalar, \
                   regridData2FinerGrid(factor,cropData,MV), \
-                  float(f.variables[varName]._FillValue))
+                  float(fillValue))
                   
     #f.close();
     f = None ; cropData = None 
     # PCRaster object
     return (outPCR)
 
+def getNetcdfCropWindow(f, cloneMapFileName = None):
+    # EHS: the window (hyperslab) of the netcdf file f that covers the clone map, and the refinement factor:
+    #      returns (yIdxSta, yIdxEnd, xIdxSta, xIdxEnd, factor) or None if the clone and the netcdf grid are the same
+    if cloneMapFileName == None: return None
+
+    # get the attributes of cloneMap
+    attributeClone = getMapAttributesALL(cloneMapFileName)
+    cellsizeClone = attributeClone['cellsize']
+    rowsClone = attributeClone['rows']
+    colsClone = attributeClone['cols']
+    xULClone = attributeClone['xUL']
+    yULClone = attributeClone['yUL']
+    # get the attributes of input (netCDF) 
+    lat = f.variables['lat'][:]
+    lon = f.variables['lon'][:]
+    cellsizeInput = float(lat[0]- lat[1])
+    rowsInput = len(lat)
+    colsInput = len(lon)
+    xULInput = lon[0]-0.5*cellsizeInput
+    yULInput = lat[0]+0.5*cellsizeInput
+    # check whether both maps have the same attributes 
+    sameClone = True
+    if cellsizeClone != cellsizeInput: sameClone = False
+    if rowsClone != rowsInput: sameClone = False
+    if colsClone != colsInput: sameClone = False
+    if xULClone != xULInput: sameClone = False
+    if yULClone != yULInput: sameClone = False
+    if sameClone: return None
+
+    logger.debug('Crop to the clone map with lower left corner (x,y): '+str(xULClone)+' , '+str(yULClone))
+    # crop to cloneMap:
+    minX    = min(abs(lon - (xULClone + 0.5*cellsizeInput)))
+    xIdxSta = int(np.where(abs(lon - (xULClone + 0.5*cellsizeInput)) == minX)[0])
+    xIdxEnd = int(math.ceil(xIdxSta + colsClone /(cellsizeInput/cellsizeClone)))
+    minY    = min(abs(lat - (yULClone - 0.5*cellsizeInput)))
+    yIdxSta = int(np.where(abs(lat - (yULClone - 0.5*cellsizeInput)) == minY)[0])
+    yIdxEnd = int(math.ceil(yIdxSta + rowsClone /(cellsizeInput/cellsizeClone)))
+
+    factor = int(round(float(cellsizeInput)/float(cellsizeClone)))
+    if factor > 1: logger.debug('Resample: input cell size = '+str(float(cellsizeInput))+' ; output/clone cell size = '+str(float(cellsizeClone)))
+
+    return yIdxSta, yIdxEnd, xIdxSta, xIdxEnd, factor
+
+def getNetcdfReadWindow(ncFile, f, varName, cloneMapFileName = None):
+    # EHS: the (cached) read window per (netcdf file, variable, clone map): 
+    #      returns the row and column slices, the refinement factor and the fill value of the variable
+    key = (ncFile, str(varName), cloneMapFileName)
+    if key in cropwindow_cache.keys(): instrumentation.count('cache.netcdf_read_window', 'hits')
+    if key not in cropwindow_cache.keys():
+        instrumentation.count('cache.netcdf_read_window', 'misses')
+        window = getNetcdfCropWindow(f, cloneMapFileName)
+        if window == None:
+            rows = slice(None); cols = slice(None); factor = 1
+        else:
+            yIdxSta, yIdxEnd, xIdxSta, xIdxEnd, factor = window
+            rows = slice(yIdxSta, yIdxEnd); cols = slice(xIdxSta, xIdxEnd)
+        cropwindow_cache[key] = (rows, cols, factor, getattr(f.variables[str(varName)], '_FillValue', None))
+    return cropwindow_cache[key]
+
+def netcdfTimeIndexes(ncFile, dates):
+    # EHS: the time indexes (in the netcdf file ncFile) of a list of dates; as in netcdf2PCRobjClone,
+    #      the 'before' or the 'after' time is used for a date that is not available.
+    #      (the netcdf calls hold netcdf_lock, e.g. while the writer thread of an OutputNetcdf is writing)
+    with netcdf_lock:
+        nctime = getNetcdfFile(ncFile).variables['time']
+        time_index = getNetcdfTimeIndex(ncFile, nctime)
+        idx = []
+        for date in dates:
+            i, select = time_index.date2index(datetime.datetime(date.year,date.month,date.day), nctime)
+            if select != 'exact': logger.warning("The date "+str(date.date())+" is NOT available in "+str(ncFile)+". The '"+select+"' option is used while selecting netcdf time.")
+            idx.append(i)
+    return np.asarray(idx, dtype = np.int64)
+
+def netcdf2NumpyClone(ncFile, varName, timeIndexes, cloneMapFileName = None):
+    # EHS: read several time steps (timeIndexes: a slice or a sorted list of time indexes) of the variable varName 
+    #      at the clone map, as one (time, lat, lon) masked array (one read for all time steps).
+    #      (the netcdf calls hold netcdf_lock, e.g. while the writer thread of an OutputNetcdf is writing)
+    with netcdf_lock:
+        f = getNetcdfFile(ncFile)
+        rows, cols, factor, fillValue = getNetcdfReadWindow(ncFile, f, varName, cloneMapFileName)
+        cube = f.variables[str(varName)][timeIndexes,rows,cols]
+    if factor > 1: cube = cube.repeat(factor, axis = 1).repeat(factor, axis = 2)
+    return np.ma.masked_array(cube)
+
+class NetcdfTimeIndex(object):
+    # EHS: the time axis of a netcdf file, decoded only once (see getNetcdfTimeIndex)
+    #      - the time values are kept as day offsets (integers, if possible) since the reference date of the time units;
+    #      - a date is found with a dictionary (exact) or with a binary search (before/after), as nc.date2index does.
+
+    def __init__(self, nctime):
+        object.__init__(self)
+
+        self.units    = nctime.units
+        self.calendar = getattr(nctime, 'calendar', 'standard')
+        values = np.asarray(nctime[:], dtype = np.float64)
+
+        # conversion of dates to day offsets in python (only for the gregorian calendars and the units days/hours/minutes/seconds since ...)
+        unit_in_days = {'days': 1., 'day': 1., 'd': 1., 'hours': 1./24., 'hour': 1./24., 'h': 1./24.,\
+                        'minutes': 1./1440., 'minute': 1./1440., 'seconds': 1./86400., 'second': 1./86400., 's': 1./86400.}
+        self.unit_in_days = unit_in_days.get(self.units.split()[0].lower(), None)
+        self.reference = None
+        if self.unit_in_days != None and self.calendar.lower() in ['standard', 'gregorian', 'proleptic_gregorian']:
+            reference = nc.num2date(0., self.units, self.calendar)
+            if reference.year > 1582 or self.calendar.lower() == 'proleptic_gregorian':
+                self.reference = datetime.datetime(reference.year, reference.month, reference.day,\
+                                                   reference.hour, reference.minute, reference.second)
+        if self.unit_in_days == None: self.unit_in_days = 1.
+
+        # day offsets, integers if all time values are whole days
+        self.days = values * self.unit_in_days
+        if np.all(self.days == np.round(self.days)): self.days = self.days.astype(np.int64)
+
+        # exact lookup (the first time step of every value) and binary search (only for increasing time values)
+        self.exact = {}
+        for i in range(len(self.days) - 1, -1, -1): self.exact[self.days[i]] = i
+        self.increasing = bool(np.all(np.diff(self.days) > 0))
+
+        # first and last years
+        self.first_year = nc.num2date(values[0],  self.units, self.calendar).year
+        self.last_year  = nc.num2date(values[-1], self.units, self.calendar).year
+
+    def date2days(self, date):
+        # the day offset of a date
+        if self.reference != None:
+            difference = date - self.reference
+            days = difference.days + difference.seconds / 86400.
+        else:
+            days = nc.date2num(date, self.units, self.calendar) * self.unit_in_days
+        if days == round(days): days = int(round(days))
+        return days
+
+    def date2index(self, date, nctime = None):
+        # the time index of a date and the selection that was used: 'exact', 'before' or 'after'
+        days = self.date2days(date)
+        if days in self.exact: return self.exact[days], 'exact'
+        if not self.increasing:
+            try:
+                return int(nc.date2index(date, nctime, calendar = self.calendar, select='before')), 'before'
+            except:
+                return int(nc.date2index(date, nctime, calendar = self.calendar, select='after')), 'after'
+        before = int(np.searchsorted(self.days, days, side = 'right')) - 1
+        if before >= 0: return before, 'before'
+        after = int(np.searchsorted(self.days, days, side = 'left'))
+        if after < len(self.days): return after, 'after'
+        raise ValueError("The date "+str(date)+" is outside the time axis.")
+
+def getNetcdfTimeIndex(ncFile, nctime):
+    # the (cached) time index of the netcdf file ncFile
+    if ncFile in timeindex_cache.keys(): instrumentation.count('cache.netcdf_time_index', 'hits')
+    if ncFile not in timeindex_cache.keys():
+        instrumentation.count('cache.netcdf_time_index', 'misses')
+        logger.debug('Decode the time axis of the file: '+str(ncFile))
+        timeindex_cache[ncFile] = NetcdfTimeIndex(nctime)
+    return timeindex_cache[ncFile]
+
+def getNetcdfFile(ncFile, LatitudeLongitude = True):
+    # the (cached) netcdf file object (with the variables 'lat' and 'lon', as in netcdf2PCRobjClone)
+    with netcdf_lock:
+        if ncFile not in filecache.keys(): filecache[ncFile] = nc.Dataset(ncFile)
+        f = filecache[ncFile]
+        if LatitudeLongitude == True and 'latitude' in f.variables.keys() and 'lat' not in f.variables.keys():
+            f.variables['lat'] = f.variables['latitude']
+            f.variables['lon'] = f.variables['longitude']
+    return f
+
 def netcdf2PCRobjCloneWindDist(ncFile,varName,dateInput,useDoy = None,
                        cloneMapFileName=None):
     # EHS (02 SEP 2013): This is a special function made by Niko Wanders (for his DA framework).
@@ -517,19 +627,34 @@ def writePCRmapToDir(v,outFileName,outDir):
     fullFileName = getFullPath(outFileName,outDir)
     pcr.report(v,fullFileName)
 
-def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,cover=None,isNomMap=False,inputEPSG="EPSG:4326",outputEPSG="EPSG:4326",method="near"):
+@instrumentation.timed('readPCRmapClone')
+def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,cover=None,isNomMap=False,inputEPSG="EPSG:4326",outputEPSG="EPSG:4326",method="near",warpEngine="gdalwarp"):
 	# v: inputMapFileName or floating values
 	# cloneMapFileName: If the inputMap and cloneMap have different clones,
 	#                   resampling will be done.   
+	# warpEngine: "gdalwarp" (using the gdal command line tools and temporary files in tmpDir),
+	#             "gdal" (using the gdal python bindings, in memory, see gdalwarpInMemory) or
+	#             "numpy" (in-process, see the module reprojection)
     logger.debug('read file/values: '+str(v))
     if v == "None":
         PCRmap = str("None")
     elif not re.match(r"[0-9.-]*$",v):
         if absolutePath != None: v = getFullPath(v,absolutePath)
+        if instrumentation.enabled: instrumentation.count('readPCRmapClone', 'bytes_read', os.path.getsize(v))
         # print(v)
         sameClone = isSameClone(v,cloneMapFileName)
         if sameClone == True:
             PCRmap = pcr.readmap(v)
+        elif warpEngine == "numpy" and reprojection.is_supported(inputEPSG, outputEPSG, method):
+            # resample in-process (without any temporary files):
+            PCRmap = regridPCRmapInProcess(v,cloneMapFileName,isLddMap,isNomMap,inputEPSG,outputEPSG,method)
+        elif warpEngine == "gdal":
+            # resample using the GDAL python bindings (in memory, without any temporary files):
+            if inputEPSG == outputEPSG or outputEPSG == None: 
+                values = gdalwarpInMemory(v,cloneMapFileName,isLddMap,isNomMap)
+            else:
+                values = gdalwarpInMemory(v,cloneMapFileName,isLddMap,isNomMap,inputEPSG,outputEPSG,method)
+            PCRmap = numpy2PCRmap(values,isLddMap,isNomMap)
         else:
             # resample using GDAL:
             output = tmpDir+'temp.map'
@@ -557,6 +682,37 @@ def readPCRmapClone(v,cloneMapFileName,tmpDir,absolutePath=None,isLddMap=False,c
     stderr = None; del stderr
     return PCRmap    
 
+@instrumentation.timed('readPCRmapCloneToNumpy')
+def readPCRmapCloneToNumpy(v,cloneMapFileName,inputEPSG="EPSG:4326",outputEPSG="EPSG:4326",method="near"):
+    # EHS: read a pcraster map as a masked numpy array at the clone map
+    #      - the map is memory-mapped (see the module pcraster_csf), no pcraster objects are used;
+    #      - if the map and the clone map are different, it is resampled in-process (see the module reprojection).
+    logger.debug('read file: '+str(v))
+    values = pcraster_csf.read_map(v, header = readMapHeader(v))
+    instrumentation.count('readPCRmapCloneToNumpy', 'bytes_read', values.nbytes)
+    if isSameClone(v,cloneMapFileName): return values
+    if inputEPSG == outputEPSG: inputEPSG = None; outputEPSG = None
+    regridder = reprojection.getRegridder(getMapAttributesALL(v, arcDegree = False),\
+                                          getMapAttributesALL(cloneMapFileName),\
+                                          cloneMapFileName, inputEPSG, outputEPSG, method)
+    return ma.masked_array(regridder.regrid(values.data, 0),\
+                           mask = regridder.regrid(ma.getmaskarray(values), True))
+
+def regridPCRmapInProcess(v,cloneMapFileName,isLddMap=False,isNomMap=False,inputEPSG="EPSG:4326",outputEPSG="EPSG:4326",method="near"):
+    # in-process alternative for gdalwarpPCR: the source cell index of every clone cell 
+    # is calculated only once and then applied to every map (see the module reprojection)
+    values = readPCRmapCloneToNumpy(v,cloneMapFileName,inputEPSG,outputEPSG,method)
+    return numpy2PCRmap(values,isLddMap,isNomMap)
+
+def numpy2PCRmap(values,isLddMap=False,isNomMap=False):
+    # a (masked) numpy array at the clone map as a pcraster map (scalar, ldd or nominal) 
+    PCRmap = pcr.numpy2pcr(pcr.Scalar, ma.filled(ma.masked_invalid(values).astype(np.float64), MV), MV)
+    if isLddMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) < 10., PCRmap)
+    if isLddMap == True: PCRmap = pcr.ldd(PCRmap)
+    if isNomMap == True: PCRmap = pcr.ifthen(pcr.scalar(PCRmap) >  0., PCRmap)
+    if isNomMap == True: PCRmap = pcr.nominal(PCRmap)
+    return PCRmap
+
 def readPCRmap(v):
 	# v : fileName or floating values
     if not re.match(r"[0-9.-]*$", v):
@@ -589,13 +745,19 @@ def isSameClone(inputMapFileName,cloneMapFileName):
     if yULClone != yULInput: sameClone = False
     return sameClone
 
+def runCommand(co, stage = None):
+    # run a (shell) command and return its output; the command is counted as a subprocess of the stage (see the module instrumentation)
+    if stage != None: instrumentation.count(stage, 'subprocesses')
+    return subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+
+@instrumentation.timed('gdalwarpPCR')
 def gdalwarpPCR(input,output,cloneOut,tmpDir,isLddMap=False,isNominalMap=False,inputEPSG="default",outputEPSG="default",method="default"):
     # 19 Mar 2013 created by Edwin H. Sutanudjaja
     # all input maps must be in PCRaster maps
     # 
     # remove temporary files:
     co = 'rm '+str(tmpDir)+'*.*'
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+    cOut,err = runCommand(co, 'gdalwarpPCR')
     # 
     # converting files to tif:
     co = 'gdal_translate -ot Float32 -a_nodata -3.4028234663852886e+38 '+str(input)+' '+str(tmpDir)+'tmp_inp.tif'
@@ -605,7 +767,7 @@ def gdalwarpPCR(input,output,cloneOut,tmpDir,isLddMap=False,isNominalMap=False,i
     msg = "Execute from the command line:\n\n"+co+"\n\n"
     logger.debug(msg)     
     
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+    cOut,err = runCommand(co, 'gdalwarpPCR')
     # 
     # get the attributes of PCRaster map:
     cloneAtt = getMapAttributesALL(cloneOut)
@@ -622,9 +784,12 @@ def gdalwarpPCR(input,output,cloneOut,tmpDir,isLddMap=False,isNominalMap=False,i
            str(tmpDir)+'tmp_inp.tif '+ \
            str(tmpDir)+'tmp_out.tif'
     if inputEPSG != "default" or outputEPSG != "default" or method != "default":
+        # - with the exact transformer (-et 0) instead of the default linear approximation (error threshold 0.125 cell), 
+        #   as the in-process reprojection (warp engine "numpy", see the module reprojection and compare_warp_engines.py)
         co = 'gdalwarp '+\
              '-s_srs '+inputEPSG+" "+\
              '-t_srs '+outputEPSG+" "+\
+             '-et 0 '+\
              te+tr+" "+\
              '-r '+method+\
              ' -srcnodata -3.4028234663852886e+38 -dstnodata -3.4028234663852886e+38 '+ \
@@ -632,7 +797,7 @@ def gdalwarpPCR(input,output,cloneOut,tmpDir,isLddMap=False,isNominalMap=False,i
              str(tmpDir)+'tmp_out.tif'
         msg = "Execute from the command line:\n\n"+co+"\n\n"
         logger.debug(msg)     
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+    cOut,err = runCommand(co, 'gdalwarpPCR')
     # 
     co = 'gdal_translate -of PCRaster -a_nodata -3.4028234663852886e+38 '+ \
               str(tmpDir)+'tmp_out.tif '+str(output)
@@ -640,23 +805,71 @@ def gdalwarpPCR(input,output,cloneOut,tmpDir,isLddMap=False,isNominalMap=False,i
     msg = "Execute from the command line:\n\n"+co+"\n\n"
     logger.debug(msg)     
 
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+    cOut,err = runCommand(co, 'gdalwarpPCR')
     # 
     co = 'mapattr -c '+str(cloneOut)+' '+str(output)
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+    cOut,err = runCommand(co, 'gdalwarpPCR')
     # 
     #~ co = 'aguila '+str(output)
     #~ print(co)
     #~ cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
     # 
     co = 'rm '+str(tmpDir)+'tmp*.*'
-    cOut,err = subprocess.Popen(co, stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
+    cOut,err = runCommand(co, 'gdalwarpPCR')
     co = None; cOut = None; err = None
     del co; del cOut; del err
     stdout = None; del stdout
     stderr = None; del stderr
     n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
 
+def gdalwarpInMemory(input,cloneOut,isLddMap=False,isNominalMap=False,inputEPSG="default",outputEPSG="default",method="default"):
+    # EHS: in-memory alternative for gdalwarpPCR, using the gdal python bindings:
+    #      the map is warped into a MEM dataset at the clone map and returned as a masked numpy array 
+    #      (no temporary files in tmpDir, no command line tools)
+    if gdal == None:
+        msg = "The gdal python bindings (osgeo.gdal) are needed for the in-memory warping (warpEngine gdal)."
+        logger.error(msg)
+        raise ImportError(msg)
+    
+    source = gdal.Open(str(input))
+    if source == None:
+        msg = "The map "+str(input)+" cannot be opened by gdal."
+        logger.error(msg)
+        raise ValueError(msg)
+    
+    # the extent and resolution of the clone map (as -te and -tr in gdalwarpPCR)
+    cloneAtt = getMapAttributesALL(cloneOut)
+    xmin = cloneAtt['xUL']
+    ymin = cloneAtt['yUL'] - cloneAtt['rows']*cloneAtt['cellsize']
+    xmax = cloneAtt['xUL'] + cloneAtt['cols']*cloneAtt['cellsize']
+    ymax = cloneAtt['yUL'] 
+    options = {'format'      : 'MEM',\
+               'outputBounds': (xmin, ymin, xmax, ymax),\
+               'xRes'        : cloneAtt['cellsize'],\
+               'yRes'        : cloneAtt['cellsize']}
+    if isLddMap == True or isNominalMap == True:
+        options['outputType'] = gdal.GDT_Int32
+    else:
+        options['outputType'] = gdal.GDT_Float32
+        options['srcNodata']  = -3.4028234663852886e+38
+        options['dstNodata']  = -3.4028234663852886e+38
+    if inputEPSG != "default" or outputEPSG != "default" or method != "default":
+        options['srcSRS']       = inputEPSG
+        options['dstSRS']       = outputEPSG
+        options['resampleAlg']  = method
+        options['errorThreshold'] = 0   # exact transformer (as -et 0 in gdalwarpPCR)
+    logger.debug('Warping in memory: '+str(input)+' '+str(options))
+    
+    warped = gdal.Warp('', source, **options)
+    band   = warped.GetRasterBand(1)
+    values = band.ReadAsArray()
+    nodata = band.GetNoDataValue()
+    mask = np.zeros(values.shape, dtype = bool)
+    if values.dtype.kind == 'f': mask = ~np.isfinite(values)
+    if nodata != None: mask = mask | (values == nodata)
+    band = None; warped = None; source = None
+    return ma.masked_array(values, mask = mask)
+
 def getFullPath(inputPath,absolutePath,completeFileName = True):
     # 19 Mar 2013 created by Edwin H. Sutanudjaja
     # Function: to get the full absolute path of a folder or a file
@@ -747,48 +960,49 @@ def isLastDayOfMonth(date):
     else:
         return False
 
-def getMapAttributesALL(cloneMap,arcDegree=True):
-    cOut,err = subprocess.Popen(str('mapattr -p %s ' %(cloneMap)), stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
-
-    if err !=None or cOut == []:
-        print "Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? "
+def readMapHeader(cloneMap):
+    # EHS: returns the CSF header of a pcraster map (see the module pcraster_csf) 
+    #      - without calling mapattr; 
+    #      - every file is parsed only once (as long as its modification time does not change)
+    try:
+        mtime = os.path.getmtime(cloneMap)
+        if cloneMap in mapattr_cache.keys() and mapattr_cache[cloneMap][0] == mtime:
+            instrumentation.count('cache.map_header', 'hits')
+            return mapattr_cache[cloneMap][1]
+        instrumentation.count('cache.map_header', 'misses')
+        header = pcraster_csf.read_header(cloneMap)
+    except (IOError, OSError, ValueError) as error:
+        print "Something wrong with reading the map attributes in virtualOS, maybe clone Map does not exist ? "
+        logger.error(str(error))
         sys.exit()
-    cellsize = float(cOut.split()[7])
+    mapattr_cache[cloneMap] = (mtime, header)
+    return header
+
+def getMapAttributesALL(cloneMap,arcDegree=True):
+    header = readMapHeader(cloneMap)
+    cellsize = float(header['cellsize'])
     if arcDegree == True: cellsize = round(cellsize * 360000.)/360000.
     mapAttr = {'cellsize': float(cellsize)        ,\
-               'rows'    : float(cOut.split()[3]) ,\
-               'cols'    : float(cOut.split()[5]) ,\
-               'xUL'     : float(cOut.split()[17]),\
-               'yUL'     : float(cOut.split()[19])}
-    co = None; cOut = None; err = None
-    del co; del cOut; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
+               'rows'    : float(header['rows'])  ,\
+               'cols'    : float(header['cols'])  ,\
+               'xUL'     : float(header['xUL'])   ,\
+               'yUL'     : float(header['yUL'])   }
     return mapAttr 
 
 def getMapAttributes(cloneMap,attribute,arcDegree=True):
-    cOut,err = subprocess.Popen(str('mapattr -p %s ' %(cloneMap)), stdout=subprocess.PIPE,stderr=open(os.devnull),shell=True).communicate()
-    #print cOut
-    if err !=None or cOut == []:
-        print "Something wrong with mattattr in virtualOS, maybe clone Map does not exist ? "
-        sys.exit()
-    #print cOut.split()
-    co = None; err = None
-    del co; del err
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
+    header = readMapHeader(cloneMap)
     if attribute == 'cellsize':
-        cellsize = float(cOut.split()[7])
+        cellsize = float(header['cellsize'])
         if arcDegree == True: cellsize = round(cellsize * 360000.)/360000.
         return cellsize  
     if attribute == 'rows':
-        return int(cOut.split()[3])
-        #return float(cOut.split()[3])
+        return int(header['rows'])
     if attribute == 'cols':
-        return int(cOut.split()[5])
-        #return float(cOut.split()[5])
+        return int(header['cols'])
     if attribute == 'xUL':
-        return float(cOut.split()[17])
+        return float(header['xUL'])
     if attribute == 'yUL':
-        return float(cOut.split()[19])
+        return float(header['yUL'])
     
 def getMapTotal(mapFile):
     ''' outputs the sum of all values in a map file '''
@@ -894,52 +1108,115 @@ def regridMapFile2FinerGrid (rescaleFac,coarse):
         return coarse
     return pcr.numpy2pcr(pcr.Scalar, regridData2FinerGrid(rescaleFac,pcr.pcr2numpy(coarse,MV),MV),MV)
     
-def regridData2FinerGrid(rescaleFac,coarse,MV):
-    if rescaleFac ==1:
-        return coarse
+def regridData2FinerGridView(rescaleFac,coarse):
+    # EHS: the finer grid as a read-only broadcast view (no copy) of coarse, with the shape (nr, rescaleFac, nc, rescaleFac):
+    #      the fine cell (row, col) is view[row // rescaleFac, row % rescaleFac, col // rescaleFac, col % rescaleFac].
+    #      Note that view.reshape(nr*rescaleFac, nc*rescaleFac) makes a copy (use regridData2FinerGrid for that).
+    rescaleFac = int(rescaleFac)
+    coarse = np.asarray(coarse)
     nr,nc = np.shape(coarse)
-    
-    fine= np.zeros(nr*nc*rescaleFac*rescaleFac).reshape(nr*rescaleFac,nc*rescaleFac) + MV
-    
- 
-    ii = -1
-    nrF,ncF = np.shape(fine)
-    for i in range(0 , nrF):
-            if i % rescaleFac == 0:
-                ii += 1
-            fine [i,:] = coarse[ii,:].repeat(rescaleFac)
-
-    nr = None; nc = None
-    del nr; del nc
-    nrF = None; ncF = None
-    del nrF; del ncF
-    n = gc.collect() ; del gc.garbage[:] ; n = None ; del n
-    return fine
+    return np.broadcast_to(coarse[:,np.newaxis,:,np.newaxis], (nr, rescaleFac, nc, rescaleFac))
 
-def regridToCoarse(fine,fac,mode,missValue):
+def regridData2FinerGrid(rescaleFac,coarse,MV,out=None):
+    # EHS: every coarse cell is repeated to (rescaleFac x rescaleFac) fine cells, in one copy from a broadcast view
+    #      (see regridData2FinerGridView); the data type of coarse is preserved (MV is not used anymore, all fine cells get a value).
+    # - out: optional preallocated (C-contiguous) output array with the shape (nr*rescaleFac, nc*rescaleFac), e.g. reused every time step
+    if rescaleFac ==1:
+        return coarse
+    rescaleFac = int(rescaleFac)
+    view = regridData2FinerGridView(rescaleFac,coarse)
+    nr = view.shape[0]; nc = view.shape[2]
+    if out is None:
+        out = np.empty((nr*rescaleFac,nc*rescaleFac), dtype = view.dtype)
+    elif out.shape != (nr*rescaleFac,nc*rescaleFac) or not out.flags['C_CONTIGUOUS']:
+        msg = "The output array of regridData2FinerGrid must be C-contiguous with the shape "+str((nr*rescaleFac,nc*rescaleFac))
+        logger.error(msg)
+        raise ValueError(msg)
+    out.reshape(view.shape)[...] = view
+    return out
+
+def _toBlocks(values, fac):
+    # (nr*fac, nc*fac) array to a (nr, nc, fac*fac) array of blocks (every block in row major order)
+    nr = values.shape[0] // fac; nc = values.shape[1] // fac
+    return values.reshape(nr, fac, nc, fac).swapaxes(1, 2).reshape(nr, nc, fac * fac)
+
+def regridToCoarse(fine,fac,mode,missValue,weights=None,edgeBlocks=False):
+    # EHS: vectorized block reduction, with the same results as the former block by block implementation (see benchmark_regrid.py):
+    #      fine is reshaped to (rows, cols, fac*fac) blocks that are all reduced at once along the last axis.
+    # - weights   : optional weights per fine cell (e.g. cell areas), only for the modes 'average' and 'sum'
+    # - edgeBlocks: if True, the incomplete blocks at the right and bottom edges are reduced as well (with their available cells);
+    #               by default, the remaining rows and columns are ignored (as in the former implementation)
+    fac = int(fac)
     nr,nc = np.shape(fine)
-    coarse = np.zeros(nr/fac * nc / fac).reshape(nr/fac,nc/fac) + MV
-    nr,nc = np.shape(coarse)
-    for r in range(0,nr):
-        for c in range(0,nc):
-            ar = fine[r * fac : fac * (r+1),c * fac: fac * (c+1)]
-            m = np.ma.masked_values(ar,missValue)
-            if ma.count(m) == 0:
-                coarse[r,c] = MV
-            else:
-                if mode == 'average':
-                    coarse [r,c] = ma.average(m)
-                elif mode == 'median': 
-                    coarse [r,c] = ma.median(m)
-                elif mode == 'sum':
-                    coarse [r,c] = ma.sum(m)
-                elif mode =='min':
-                    coarse [r,c] = ma.min(m)
-                elif mode == 'max':
-                    coarse [r,c] = ma.max(m)
-    return coarse    
-        
-    
+    if edgeBlocks:
+        nrC = -(-nr // fac); ncC = -(-nc // fac)
+    else:
+        nrC = nr // fac; ncC = nc // fac
+
+    # values (padded with missing values for the incomplete edge blocks) and their missing value mask (as in ma.masked_values)
+    values = ma.filled(fine, missValue)
+    if nrC * fac > nr or ncC * fac > nc:
+        padded = np.empty((nrC * fac, ncC * fac), dtype = values.dtype); padded[:] = missValue
+        padded[:nr,:nc] = values
+        values = padded
+    values = values[:nrC * fac,:ncC * fac]
+    if np.issubdtype(values.dtype, np.floating):
+        mask = np.isclose(values, missValue, rtol = 1e-5, atol = 1e-8)
+    else:
+        mask = values == missValue
+    values = _toBlocks(values, fac)
+    mask   = _toBlocks(mask, fac)
+    count  = fac * fac - np.sum(mask, axis = 2)
+
+    if weights is not None:
+        if mode not in ['average', 'sum']:
+            msg = "Weights can only be used for the modes 'average' and 'sum' in regridToCoarse, not for the mode: "+str(mode)
+            logger.error(msg)
+            raise ValueError(msg)
+        padded = np.zeros((nrC * fac, ncC * fac))
+        padded[:min(nr, nrC * fac),:min(nc, ncC * fac)] = np.asarray(weights)[:nrC * fac,:ncC * fac]
+        weights = np.where(mask, 0.0, _toBlocks(padded, fac))
+        coarse  = np.sum(weights * np.where(mask, 0.0, values), axis = 2)
+        if mode == 'average':
+            sum_of_weights = np.sum(weights, axis = 2)
+            count  = np.where(sum_of_weights > 0.0, count, 0)
+            coarse = coarse / np.where(sum_of_weights > 0.0, sum_of_weights, 1.0)
+
+    elif mode in ['average', 'sum']:
+        coarse = np.sum(np.where(mask, values.dtype.type(0), values), axis = 2)
+        if mode == 'average':
+            coarse = coarse.astype(np.float64) / np.maximum(count, 1)
+            # as in ma.average: blocks without missing values have the precision of the input values (np.mean)
+            if values.dtype.kind == 'f': coarse = np.where(count == fac * fac, coarse.astype(values.dtype), coarse)
+
+    elif mode in ['min', 'max']:
+        blocks = ma.masked_array(values, mask = mask)
+        if mode == 'min': coarse = ma.getdata(blocks.min(axis = 2))
+        if mode == 'max': coarse = ma.getdata(blocks.max(axis = 2))
+
+    elif mode == 'median':
+        # the missing values are sorted behind the valid values;
+        # the median is the middle value (odd count) or the mean of the two middle values (even count), as in ma.median
+        if values.dtype.kind == 'f':
+            high = np.inf
+        else:
+            high = np.iinfo(values.dtype).max
+        ordered = np.sort(np.where(mask, values.dtype.type(high), values), axis = 2)
+        h = np.minimum(count // 2, fac * fac - 1)[:,:,np.newaxis]
+        l = np.where(count[:,:,np.newaxis] % 2 == 1, h, np.maximum(h - 1, 0))
+        if values.dtype.kind == 'f':
+            coarse = (np.take_along_axis(ordered, l, axis = 2) + np.take_along_axis(ordered, h, axis = 2)) / values.dtype.type(2.)
+        else:
+            coarse = (np.take_along_axis(ordered, l, axis = 2).astype(np.float64) + np.take_along_axis(ordered, h, axis = 2)) / 2.
+        coarse = coarse[:,:,0]
+
+    else:
+        msg = "Unknown mode for regridToCoarse: "+str(mode)
+        logger.error(msg)
+        raise ValueError(msg)
+
+    return np.where(count == 0, MV, np.asarray(coarse, dtype = np.float64))
+
 def waterBalanceCheck(fluxesIn,fluxesOut,preStorages,endStorages,processName,PrintOnlyErrors,dateStr,threshold=1e-5,landmask=None):
     """ Returns the water balance for a list of input, output, and storage map files  """
     # modified by Edwin (22 Apr 2013)